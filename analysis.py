@@ -1,56 +1,263 @@
 """ Data Analysis """
 
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
-from sql_queries import sample_queries, sample_query_titles
+import psycopg2.pool
+from prettytable import PrettyTable
+from sql_queries import (sample_queries, sample_query_titles, sample_query_registry,
+                         get_page_query)
 import utilities
+import dialects
+import export
+import metrics
+import result_cache
+from result_cache import ResultCache
 
 
-def run_analysis_queries(cur: psycopg2.extensions.cursor):
+# queries run at the same time by run_analysis_queries_concurrently
+DEFAULT_CONCURRENCY = 4
+
+
+def print_query_result(title: str, query: str, headers_list: list, rows: list, limit: int):
+    """ Display the result of one sample query """
+
+    header_string = '\t'.join(headers_list)
+
+    headers_sizes_list = [len(header) for header in headers_list]
+    headers_underscore_list = [
+        '-' * header_size for header_size in headers_sizes_list]
+    header_underscore_string = '\t'.join(headers_underscore_list)
+
+    print('-----------------------------------')
+    print('')
+    print(title, f'(truncating display at {limit} rows of query results)')
+    print('')
+    print(query)
+    print('')
+    print(header_string)
+    print(header_underscore_string)
+
+    for row in rows:
+
+        padded_values_list = [str(val) + (' ' * (header_size - len(str(val))))
+                              for val, header_size in zip(row, headers_sizes_list)]
+
+        print('\t'.join(padded_values_list))
+
+    print('')
+
+
+def fetch_query_result(conn: psycopg2.extensions.connection, name: str, entry: dict,
+                       after: dict = None, cache: ResultCache = None) -> tuple:
+    """ Run a page of a sample query (see get_page_query) on a named (server side) cursor,
+    or take it from the cache, returns the query, its column names and the rows to display """
+
+    query, params = get_page_query(entry, after)
+
+    if cache is not None:
+        result = cache.get(query, params)
+        if result is not None:
+            headers_list, rows = result
+            return query, headers_list, rows
+
+    with metrics.span(entry['title'], conn) as span:
+        with conn.cursor(name) as cur:
+            cur.execute(dialects.translate(query, utilities.get_db_dialect()), params)
+
+            rows = cur.fetchmany(entry['limit'])
+            # named cursors only describe the result once rows are fetched
+            headers_list = [desc[0] for desc in cur.description]
+        span.rows = len(rows)
+    conn.commit()
+
+    if cache is not None:
+        cache.put(query, params, (headers_list, rows))
+
+    return query, headers_list, rows
+
+
+def get_next_page_key(entry: dict, headers_list: list, rows: list) -> dict:
+    """ The order_by values of the last row, where the next page starts,
+    None when there is no next page """
+
+    if 'order_by' not in entry or len(rows) < entry['limit']:
+        return None
+
+    last_row = dict(zip(headers_list, rows[-1]))
+    return {column: last_row[column] for column, _ in entry['order_by']}
+
+
+def get_result_cache(conn: psycopg2.extensions.connection) -> ResultCache:
+    """ Result cache for the data currently loaded """
+
+    return ResultCache(result_cache.get_data_version(conn))
+
+
+def run_analysis_queries(conn: psycopg2.extensions.connection, use_cache: bool = True):
     """ Run Sample Queries and Display Results """
 
-    for query, title in zip(sample_queries, sample_query_titles):
+    cache = get_result_cache(conn) if use_cache else None
+
+    for index, entry in enumerate(sample_query_registry):
+
+        query, headers_list, rows = fetch_query_result(conn, f"analysis_{index}", entry,
+                                                       cache=cache)
+        print_query_result(entry['title'], query, headers_list, rows, entry['limit'])
+
+    if cache is not None:
+        cache.print_stats()
+
+
+def page_through_query(conn: psycopg2.extensions.connection, entry: dict, pages: int,
+                       use_cache: bool = True):
+    """ Display up to pages pages of a sample query, each page starting
+    after the last row of the previous one """
+
+    cache = get_result_cache(conn) if use_cache else None
+
+    after = None
+    for page in range(pages):
+
+        query, headers_list, rows = fetch_query_result(conn, f"page_{page}", entry, after,
+                                                       cache)
+        print_query_result(f"{entry['title']}, page {page + 1}", query, headers_list, rows,
+                           entry['limit'])
+
+        after = get_next_page_key(entry, headers_list, rows)
+        if after is None:
+            break
+
+    if cache is not None:
+        cache.print_stats()
 
-        cur.execute(query)
 
-        headers_list = [desc[0] for desc in cur.description]
-        header_string = '\t'.join(headers_list)
+def run_pooled_query(pool: psycopg2.pool.ThreadedConnectionPool, name: str,
+                     entry: dict, cache: ResultCache = None) -> tuple:
+    """ Run the first page of a sample query on a pooled connection, returns the query,
+    its column names, the rows to display and the seconds it took """
 
-        headers_sizes_list = [len(header) for header in headers_list]
-        headers_underscore_list = [
-            '-' * header_size for header_size in headers_sizes_list]
-        header_underscore_string = '\t'.join(headers_underscore_list)
+    conn = pool.getconn()
+    start_time = time.time()
+    try:
+        query, headers_list, rows = fetch_query_result(conn, name, entry, cache=cache)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
 
-        print('-----------------------------------')
-        print('')
-        print(title, '(truncating display at 35 rows of query results)')
-        print('')
-        print(query)
-        print('')
-        print(header_string)
-        print(header_underscore_string)
+    return query, headers_list, rows, time.time() - start_time
 
-        count = 0
-        while True:
-            row = cur.fetchone()
-            if row is None or count == 35:
-                break
 
-            padded_values_list = [str(val) + (' ' * (header_size - len(str(val))))
-                                  for val, header_size in zip(row, headers_sizes_list)]
+def run_analysis_queries_concurrently(pool: psycopg2.pool.ThreadedConnectionPool,
+                                      max_workers: int = DEFAULT_CONCURRENCY,
+                                      use_cache: bool = True):
+    """ Run the sample queries, up to max_workers at a time on pooled connections
+    (the pool must allow that many), and display the results in the usual order,
+    followed by the latency of each query and the wall clock time saved over
+    running them one by one """
 
-            print('\t'.join(padded_values_list))
+    start_time = time.time()
 
-            count += 1
+    cache = None
+    if use_cache:
+        conn = pool.getconn()
+        try:
+            cache = get_result_cache(conn)
+        finally:
+            pool.putconn(conn)
 
-        print('')
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_pooled_query, pool, f"analysis_{index}", entry, cache)
+                   for index, entry in enumerate(sample_query_registry)]
+        results = [future.result() for future in futures]
 
+    wall_clock = time.time() - start_time
 
-def main():
+    for entry, (query, headers_list, rows, _) in zip(sample_query_registry, results):
+        print_query_result(entry['title'], query, headers_list, rows, entry['limit'])
+
+    latencies = PrettyTable()
+    latencies.field_names = ['Query', 'Seconds']
+    latencies.align['Query'] = 'l'
+    latencies.align['Seconds'] = 'r'
+    for title, (_, _, _, duration) in zip(sample_query_titles, results):
+        latencies.add_row([title, f"{duration:.3f}"])
+    print(latencies)
+
+    serial = sum(duration for _, _, _, duration in results)
+    print(f"Total wall clock time {wall_clock:.3f} seconds with {max_workers} connections, " +
+          f"one by one it would have been {serial:.3f} seconds, " +
+          f"saved {max(serial - wall_clock, 0):.3f} seconds.")
+
+    if cache is not None:
+        cache.print_stats()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """ Command line options """
+
+    parser = argparse.ArgumentParser(description='Run the sample queries')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='how many queries may run at the same time, each on its own '
+                             f'connection, 1 runs them one by one (default {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--query', type=int, choices=range(1, len(sample_query_registry) + 1),
+                        metavar='N',
+                        help='only display the Nth sample query, page by page (see --pages)')
+    parser.add_argument('--pages', type=int, default=1,
+                        help='pages of --query to display, each fetched as a top-K that '
+                             'starts after the last row of the previous page (default 1)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always run the queries, without the result cache')
+    parser.add_argument('--export', metavar='DIR',
+                        help='instead of displaying the first rows, stream the full results '
+                             'into files in DIR, one per query')
+    parser.add_argument('--format', choices=export.FORMATS, default='csv',
+                        help='file format of --export (default csv, parquet needs pyarrow)')
+    parser.add_argument('--chunk-rows', type=int, default=export.CHUNK_ROWS,
+                        help='rows fetched and written at a time by --export ' +
+                             f'(default {export.CHUNK_ROWS})')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
     """ Run Analysis queries as a stand alone program """
 
+    args = parse_args(argv)
+
+    if args.export:
+        conn = utilities.get_db_connection()
+        export.export_queries(conn, sample_queries, sample_query_titles,
+                              args.export, args.format, args.chunk_rows)
+        metrics.finish(conn, 'analysis')
+        conn.close()
+        return
+
+    if args.query:
+        conn = utilities.get_db_connection()
+        page_through_query(conn, sample_query_registry[args.query - 1], args.pages,
+                           not args.no_cache)
+        metrics.finish(conn, 'analysis')
+        conn.close()
+        return
+
+    if args.concurrency > 1:
+        pool = utilities.get_db_connection_pool(args.concurrency)
+        run_analysis_queries_concurrently(pool, args.concurrency, not args.no_cache)
+        conn = pool.getconn()
+        try:
+            metrics.finish(conn, 'analysis')
+        finally:
+            pool.putconn(conn)
+        pool.print_stats()
+        pool.closeall()
+        return
+
     conn = utilities.get_db_connection()
-    cur = conn.cursor()
-    run_analysis_queries(cur)
+    run_analysis_queries(conn, not args.no_cache)
+    metrics.finish(conn, 'analysis')
     conn.close()
 
 
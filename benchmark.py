@@ -0,0 +1,280 @@
+""" End to end benchmark of create_tables.py, etl.py and analysis.py on DuckDB
+
+For each scale a synthetic dataset is generated (synthetic_data.py) with a fixed seed,
+so every run of a scale loads the same files.  create_tables.py, etl.py --local-data
+--full-refresh and analysis.py then run in-process on DuckDB, each in its own process, in
+a work directory with its own dwh.cfg.  The wall time and peak memory of each process are
+measured, with the ETL throughput in records per second and the latency of every step
+(the spans of metrics.py).  The results are appended to a JSON Lines file with the git
+commit they were measured on and compared with the last results of another commit, so a
+regression between commits shows up.  Needs duckdb (pip install duckdb) """
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from prettytable import PrettyTable
+import synthetic_data
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+WORK_DIR = '.benchmark'
+RESULTS_PATH = 'benchmark_results.jsonl'
+
+# dataset of each scale, see synthetic_data.generate_dataset
+SCALES = {'small': {'songs': 500, 'users': 50, 'events_per_day': 500, 'days': 7},
+          'medium': {'songs': 5000, 'users': 500, 'events_per_day': 5000, 'days': 30},
+          'large': {'songs': 20000, 'users': 2000, 'events_per_day': 20000, 'days': 30}}
+
+SEED = 0
+
+# dwh.cfg of the work directories
+BENCHMARK_CONFIG = """[CLUSTER]
+dialect = duckdb
+duckdb_path = sparkify.duckdb
+
+[IAM_ROLE]
+arn =
+
+[METRICS]
+spans_path = spans.jsonl
+"""
+
+# a stage this much slower than the previous commit's is flagged
+DEFAULT_THRESHOLD = 0.2
+
+# steps listed in the report, the slowest first
+REPORT_STEPS = 10
+
+
+def get_commit() -> tuple:
+    """ Short hash of the checked out commit and whether tracked files were changed since """
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        changes = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                 cwd=REPO_DIR, capture_output=True, text=True,
+                                 check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+
+    return commit, bool(changes)
+
+
+def get_rss_mb(max_rss: int) -> float:
+    """ ru_maxrss in MB (bytes on macOS, kilobytes on Linux) """
+
+    if sys.platform == 'darwin':
+        return max_rss / 1024 / 1024
+    return max_rss / 1024
+
+
+def prepare_work_dir(work_dir: str, scale: str) -> str:
+    """ Empty work directory of a scale, with the benchmark dwh.cfg """
+
+    scale_dir = os.path.join(work_dir, scale)
+    if os.path.isdir(scale_dir):
+        shutil.rmtree(scale_dir)
+    os.makedirs(scale_dir)
+
+    with open(os.path.join(scale_dir, 'dwh.cfg'), 'w', encoding='utf-8') as config_file:
+        config_file.write(BENCHMARK_CONFIG)
+
+    return scale_dir
+
+
+def read_step_seconds(scale_dir: str, program: str) -> dict:
+    """ Seconds of each step (span) the program recorded, by name """
+
+    steps = {}
+    spans_path = os.path.join(scale_dir, 'spans.jsonl')
+    if not os.path.exists(spans_path):
+        return steps
+
+    with open(spans_path, encoding='utf-8') as spans_file:
+        for line in spans_file:
+            span = json.loads(line)
+            if span['program'] == program:
+                steps[span['name']] = steps.get(span['name'], 0.0) + span['seconds']
+
+    return steps
+
+
+def run_stage(scale_dir: str, program: str, args: list) -> dict:
+    """ Run a script in its own process in the work directory, returns its
+    seconds, peak memory and steps.  The output goes to <program>.log """
+
+    log_path = os.path.join(scale_dir, program + '.log')
+    command = [sys.executable, os.path.join(REPO_DIR, program + '.py')] + args
+
+    start_time = time.time()
+    with open(log_path, 'w', encoding='utf-8') as log_file:
+        process = subprocess.Popen(command, cwd=scale_dir, stdout=log_file,
+                                   stderr=subprocess.STDOUT)
+        # unlike wait(), wait4 returns the resource usage of this one process
+        _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - start_time
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    if process.returncode != 0:
+        raise RuntimeError(f"{program}.py failed (exit code {process.returncode}), " +
+                           f"see {log_path}")
+
+    return {'seconds': round(seconds, 3),
+            'peak_mb': round(get_rss_mb(usage.ru_maxrss), 1),
+            'steps': read_step_seconds(scale_dir, program)}
+
+
+def run_scale(work_dir: str, scale: str) -> dict:
+    """ Generate the dataset of a scale and run the pipeline on it, returns the result """
+
+    scale_dir = prepare_work_dir(work_dir, scale)
+    data_dir = os.path.join(scale_dir, 'data')
+
+    start_time = time.time()
+    dataset = synthetic_data.generate_dataset(data_dir, seed=SEED, **SCALES[scale])
+    print(f"{scale}: generated {dataset['songs']} songs and {dataset['events']} events " +
+          f"in {time.time() - start_time:.1f} seconds.")
+
+    stages = {}
+    stages['create_tables'] = run_stage(scale_dir, 'create_tables', [])
+    stages['etl'] = run_stage(scale_dir, 'etl', ['--local-data', 'data', '--full-refresh',
+                                                 '--no-analysis'])
+    stages['analysis'] = run_stage(scale_dir, 'analysis', ['--no-cache'])
+
+    records = dataset['songs'] + dataset['events']
+    stages['etl']['records_per_second'] = round(records / stages['etl']['seconds'], 1)
+
+    commit, dirty = get_commit()
+    return {'commit': commit,
+            'dirty': dirty,
+            'recorded_at': datetime.datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+            'scale': scale,
+            'dataset': dict(SCALES[scale], **dataset),
+            'stages': stages}
+
+
+def read_results(results_path: str) -> list:
+    """ The results recorded so far, oldest first """
+
+    if not os.path.exists(results_path):
+        return []
+
+    with open(results_path, encoding='utf-8') as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+
+def append_result(results_path: str, result: dict):
+    """ Add a result to the results file """
+
+    with open(results_path, 'a', encoding='utf-8') as results_file:
+        results_file.write(json.dumps(result) + '\n')
+
+
+def get_baseline(results: list, result: dict) -> dict:
+    """ The last result of the scale measured on another commit, None if there is none """
+
+    for earlier in reversed(results):
+        if (earlier['scale'] == result['scale'] and earlier['commit'] != result['commit']
+                and earlier['dataset'] == result['dataset']):
+            return earlier
+    return None
+
+
+def format_change(value: float, previous: float, threshold: float = None) -> str:
+    """ Relative change from the previous value, flagged when slower by more than threshold """
+
+    if not previous:
+        return ''
+    change = value / previous - 1
+    flag = ' slower' if threshold is not None and change > threshold else ''
+    return f"{change:+.0%}{flag}"
+
+
+def print_report(result: dict, baseline: dict, threshold: float) -> bool:
+    """ Print the stages and the slowest ETL steps, next to the baseline's.
+    Returns True if a stage is slower than the baseline by more than threshold """
+
+    against = f"commit {baseline['commit']}" if baseline else 'no earlier commit'
+    print(f"\n{result['scale']} ({result['dataset']['songs']} songs, " +
+          f"{result['dataset']['events']} events) on commit {result['commit']}" +
+          f"{' with changes' if result['dirty'] else ''}, compared with {against}")
+
+    previous_stages = baseline['stages'] if baseline else {}
+    report = PrettyTable()
+    report.field_names = ['Stage', 'Seconds', 'Time change', 'Peak MB', 'Memory change',
+                          'Records/s']
+    report.align['Stage'] = 'l'
+    regressed = False
+    for stage, values in result['stages'].items():
+        previous = previous_stages.get(stage, {})
+        change = format_change(values['seconds'], previous.get('seconds'), threshold)
+        regressed = regressed or change.endswith('slower')
+        report.add_row([stage, f"{values['seconds']:.3f}", change,
+                        f"{values['peak_mb']:.1f}",
+                        format_change(values['peak_mb'], previous.get('peak_mb')),
+                        values.get('records_per_second', '')])
+    print(report)
+
+    steps = result['stages']['etl']['steps']
+    previous_steps = previous_stages.get('etl', {}).get('steps', {})
+    report = PrettyTable()
+    report.field_names = ['ETL step', 'Seconds', 'Previous', 'Change']
+    report.align['ETL step'] = 'l'
+    for name in sorted(steps, key=steps.get, reverse=True)[:REPORT_STEPS]:
+        previous = previous_steps.get(name)
+        report.add_row([name, f"{steps[name]:.3f}",
+                        '' if previous is None else f"{previous:.3f}",
+                        format_change(steps[name], previous)])
+    print(report)
+
+    return regressed
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """ Command line options """
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0].strip())
+    parser.add_argument('--scales', nargs='+', choices=list(SCALES), default=['small'],
+                        help='dataset scales to run (default small)')
+    parser.add_argument('--results', default=RESULTS_PATH,
+                        help=f"JSON Lines file the results are added to (default {RESULTS_PATH})")
+    parser.add_argument('--work-dir', default=WORK_DIR,
+                        help='where the datasets, databases and logs are written ' +
+                             f"(default {WORK_DIR})")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='flag stages slower than on the previous commit by more than this '
+                             f"share (default {DEFAULT_THRESHOLD})")
+    parser.add_argument('--no-record', action='store_true',
+                        help='only compare, do not add the results to the results file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """ Benchmark the pipeline at each scale, exits with 1 if a stage regressed """
+
+    args = parse_args(argv)
+
+    results = read_results(args.results)
+    regressed = False
+    for scale in args.scales:
+        result = run_scale(args.work_dir, scale)
+        baseline = get_baseline(results, result)
+        regressed = print_report(result, baseline, args.threshold) or regressed
+
+        if not args.no_record:
+            append_result(args.results, result)
+        results.append(result)
+
+    if regressed:
+        print(f"\nA stage is more than {args.threshold:.0%} slower than on the previous commit.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
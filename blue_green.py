@@ -0,0 +1,189 @@
+""" Blue / green builds of the fact and dimension tables
+
+Instead of dropping the tables and refilling them while analysts query them, etl.py
+--shadow builds a new generation in <table>_next tables.  Their row counts are checked
+against the current tables, then one transaction renames the current tables to
+<table>_previous and the _next tables to the real names, so readers see either the old
+or the new generation, never a partial one.  The previous generation is kept until the
+next swap, etl.py --rollback swaps it back.  The same transaction keeps the control rows
+(loaded files and watermarks) of the replaced generation in <table>_previous, records
+those of the new one and a new data version, and a rollback restores the kept rows, so
+the next incremental run continues from the generation that is current """
+
+import psycopg2
+from prettytable import PrettyTable
+import utilities
+import dialects
+import result_cache
+from sql_queries import (generation_tables, required_generation_tables,
+                         shrinking_generation_tables, get_generation_create_queries,
+                         generation_control_tables,
+                         rename_generation_tables, NEXT_SUFFIX, PREVIOUS_SUFFIX, TABLE_DROP,
+                         TABLE_RENAME, TABLE_COUNT, TABLE_EXISTS, TABLE_SNAPSHOT, TABLE_DELETE,
+                         TABLE_RESTORE,
+                         USERS_CURRENT_VIEW_DROP, USERS_CURRENT_VIEW_CREATE)
+
+# share of the current rows a new generation must have at least, per table
+MIN_ROW_RATIO = 0.9
+
+
+class ValidationError(Exception):
+    """ The new generation does not look complete, it is not swapped in """
+
+
+class RollbackError(Exception):
+    """ There is no previous generation to roll back to """
+
+
+def sql(query: str) -> str:
+    """ The query rewritten for the SQL dialect of the database """
+
+    return dialects.translate(query, utilities.get_db_dialect())
+
+
+def create_next_tables(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection):
+    """ (Re)create empty _next tables with the DDL of the current ones """
+
+    for table in generation_tables:
+        cur.execute(sql(TABLE_DROP.format(table + NEXT_SUFFIX)))
+    for query in get_generation_create_queries():
+        cur.execute(sql(rename_generation_tables(query, NEXT_SUFFIX)))
+    conn.commit()
+
+
+def get_row_counts(cur: psycopg2.extensions.cursor, suffix: str = '') -> dict:
+    """ Rows of each generation table, with the suffix (e.g. _next) """
+
+    row_counts = {}
+    for table in generation_tables:
+        cur.execute(sql(TABLE_COUNT.format(table + suffix)))
+        row_counts[table] = cur.fetchone()[0]
+
+    return row_counts
+
+
+def get_missing_tables(cur: psycopg2.extensions.cursor, tables: list) -> list:
+    """ The tables that do not exist in the database """
+
+    missing_tables = []
+    for table in tables:
+        cur.execute(sql(TABLE_EXISTS), (table,))
+        if cur.fetchone()[0] == 0:
+            missing_tables.append(table)
+
+    return missing_tables
+
+
+def validate_next_tables(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection,
+                         min_row_ratio: float = MIN_ROW_RATIO):
+    """ Print the row counts of the new and the current generation, raises ValidationError
+    if a required table is empty or any table, other than the shrinking ones
+    (songplays_pending), has less than min_row_ratio of its rows """
+
+    next_counts = get_row_counts(cur, NEXT_SUFFIX)
+    current_counts = get_row_counts(cur)
+    conn.commit()
+
+    report = PrettyTable()
+    report.field_names = ['Table', 'Current rows', 'New rows', 'Check']
+    report.align['Table'] = 'l'
+
+    problems = []
+    for table in generation_tables:
+        check = 'ok'
+        if table in required_generation_tables and next_counts[table] == 0:
+            check = 'empty'
+        elif (table not in shrinking_generation_tables and
+              next_counts[table] < current_counts[table] * min_row_ratio):
+            check = f"below {min_row_ratio:.0%} of current"
+        if check != 'ok':
+            problems.append(f"{table} {check}")
+        report.add_row([table, current_counts[table], next_counts[table], check])
+    print(report)
+
+    if problems:
+        raise ValidationError("The new generation is not swapped in: " + ', '.join(problems))
+
+
+def snapshot_control_tables(cur: psycopg2.extensions.cursor):
+    """ Keep the rows of the control tables in <table>_previous """
+
+    for table in generation_control_tables:
+        cur.execute(sql(TABLE_DROP.format(table + PREVIOUS_SUFFIX)))
+        cur.execute(sql(TABLE_SNAPSHOT.format(table + PREVIOUS_SUFFIX, table)))
+
+
+def restore_control_tables(cur: psycopg2.extensions.cursor):
+    """ Replace the rows of the control tables with the ones kept in <table>_previous """
+
+    for table in generation_control_tables:
+        cur.execute(sql(TABLE_DELETE.format(table)))
+        cur.execute(sql(TABLE_RESTORE.format(table, table + PREVIOUS_SUFFIX)))
+        cur.execute(sql(TABLE_DROP.format(table + PREVIOUS_SUFFIX)))
+
+
+def replace_generation(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection,
+                       drops: list, renames: list, control_updates: list) -> int:
+    """ In one transaction, committed by the caller: drop the tables, run the (from, to)
+    renames with users_current recreated on the new user_levels (PostgreSQL and Redshift
+    views follow the table they were created on), call each of control_updates with the
+    cursor and record a new data version.  Nothing changes if any of it fails.
+    Returns the data version """
+
+    try:
+        for table in drops:
+            cur.execute(sql(TABLE_DROP.format(table)))
+        cur.execute(sql(USERS_CURRENT_VIEW_DROP))
+        for old_name, new_name in renames:
+            cur.execute(sql(TABLE_RENAME.format(old_name, new_name)))
+        cur.execute(sql(USERS_CURRENT_VIEW_CREATE))
+        for control_update in control_updates:
+            control_update(cur)
+        data_version = result_cache.record_data_version(cur)
+    except Exception:
+        conn.rollback()
+        raise
+
+    return data_version
+
+
+def swap_in_next_tables(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection,
+                        write_control_rows):
+    """ Make the _next tables current, keeping the current ones as _previous.
+    write_control_rows(cur) records the control rows of the new generation.  Committed
+    by the caller, the run journal commits the swap with its completion """
+
+    drops = [table + PREVIOUS_SUFFIX for table in generation_tables]
+    renames = []
+    for table in generation_tables:
+        renames.append((table, table + PREVIOUS_SUFFIX))
+        renames.append((table + NEXT_SUFFIX, table))
+    data_version = replace_generation(cur, conn, drops, renames,
+                                      [snapshot_control_tables, write_control_rows])
+
+    print("Swapped in the new generation, the replaced one is kept as *" + PREVIOUS_SUFFIX +
+          f", data version {data_version}")
+
+
+def roll_back(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection):
+    """ Make the _previous tables and control rows current again,
+    the current tables become _next.  Raises RollbackError, changing nothing, if there is
+    no previous generation: no swap yet, or it was already rolled back """
+
+    missing_tables = get_missing_tables(
+        cur, [table + PREVIOUS_SUFFIX for table in generation_tables + generation_control_tables])
+    conn.commit()
+    if missing_tables:
+        raise RollbackError("There is no previous generation to roll back to, missing " +
+                            ', '.join(missing_tables))
+
+    drops = [table + NEXT_SUFFIX for table in generation_tables]
+    renames = []
+    for table in generation_tables:
+        renames.append((table, table + NEXT_SUFFIX))
+        renames.append((table + PREVIOUS_SUFFIX, table))
+    data_version = replace_generation(cur, conn, drops, renames, [restore_control_tables])
+    conn.commit()
+
+    print("Rolled back to the previous generation, the replaced one is kept as *" +
+          NEXT_SUFFIX + f", data version {data_version}")
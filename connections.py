@@ -0,0 +1,250 @@
+""" Connections to the Redshift (or PostgreSQL) database
+
+Connections are opened with TCP keepalives, so idle connections are not silently
+dropped during a long run, and opening one is retried with jittered exponential
+backoff, which rides out a Serverless workgroup resuming from a cold start or a
+network blip.  ConnectionPool is a bounded pool of them: it opens (pre-warms) a few
+connections at startup, checks connections that sat idle before handing them out, and
+measures how long each checkout waited, to help size the pool.  Settings are in the
+CONNECTIONS section of dwh.cfg, read when they are first used """
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+import psycopg2.extensions
+import utilities
+
+# defaults of the settings in the CONNECTIONS section of dwh.cfg
+CONNECT_TIMEOUT = 30
+CONNECT_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+KEEPALIVES_IDLE = 60
+HEALTH_CHECK_IDLE = 30.0
+PREWARM_CONNECTIONS = 2
+
+# keepalive probes after KEEPALIVES_IDLE seconds of silence
+KEEPALIVES_INTERVAL = 10
+KEEPALIVES_COUNT = 5
+
+
+def get_setting(option: str, default):
+    """ A setting of the CONNECTIONS section of dwh.cfg, the default if unset """
+
+    return utilities.get_config_value("CONNECTIONS", option, default)
+
+
+def get_retry_delay(attempt: int, base_delay: float = None,
+                    max_delay: float = None) -> float:
+    """ Seconds to wait before retry number attempt (1 for the first retry):
+    exponential backoff with full jitter, so clients that failed together
+    do not all retry at the same moment """
+
+    if base_delay is None:
+        base_delay = get_setting("RETRY_BASE_DELAY", RETRY_BASE_DELAY)
+    if max_delay is None:
+        max_delay = get_setting("RETRY_MAX_DELAY", RETRY_MAX_DELAY)
+
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+def connect(dsn: str, attempts: int = None) -> psycopg2.extensions.connection:
+    """ Open a connection with TCP keepalives, retrying when it cannot be opened """
+
+    if attempts is None:
+        attempts = get_setting("CONNECT_ATTEMPTS", CONNECT_ATTEMPTS)
+
+    attempt = 1
+    while True:
+        try:
+            return psycopg2.connect(dsn,
+                                    connect_timeout=get_setting("CONNECT_TIMEOUT",
+                                                                CONNECT_TIMEOUT),
+                                    keepalives=1,
+                                    keepalives_idle=get_setting("KEEPALIVES_IDLE",
+                                                                KEEPALIVES_IDLE),
+                                    keepalives_interval=KEEPALIVES_INTERVAL,
+                                    keepalives_count=KEEPALIVES_COUNT)
+        except psycopg2.OperationalError as error:
+            if attempt >= attempts:
+                raise
+            delay = get_retry_delay(attempt)
+            print(f"Could not connect ({str(error).strip()}), " +
+                  f"retrying in {delay:.1f} seconds.")
+            time.sleep(delay)
+            attempt += 1
+
+
+class CheckoutStats:
+    """ How long the checkouts of a pool waited: for a free connection (when all were
+    checked out) and in total, opening or checking the connection included """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.waited_checkouts = 0
+        self.total_slot_wait = 0.0
+        self.max_slot_wait = 0.0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, slot_wait: float, wait: float):
+        """ Add a checkout """
+
+        with self.lock:
+            self.checkouts += 1
+            if slot_wait > 0.001:
+                self.waited_checkouts += 1
+            self.total_slot_wait += slot_wait
+            self.max_slot_wait = max(self.max_slot_wait, slot_wait)
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def get_summary(self, max_connections: int = None) -> str:
+        """ Printable summary of the checkouts """
+
+        checkouts = max(self.checkouts, 1)
+        pool_size = ''
+        if max_connections is not None:
+            pool_size = f" of up to {max_connections} connections"
+        return (f"{self.checkouts} checkouts{pool_size}, " +
+                f"{self.waited_checkouts} waited for a free connection " +
+                f"({1000 * self.total_slot_wait / checkouts:.1f} ms on average, " +
+                f"{1000 * self.max_slot_wait:.1f} ms at most), checkout wait " +
+                f"{1000 * self.total_wait / checkouts:.1f} ms on average, " +
+                f"{1000 * self.max_wait:.1f} ms at most")
+
+
+class ConnectionPool:
+    """ Thread safe pool of up to max_connections connections, with the interface
+    of psycopg2's ThreadedConnectionPool (getconn, putconn and closeall).
+
+    getconn blocks until a connection is free instead of failing.  Returned connections
+    are reused last in, first out, one that sat idle for HEALTH_CHECK_IDLE seconds is
+    checked with SELECT 1 first and replaced if it does not answer """
+
+    def __init__(self, dsn: str, max_connections: int, prewarm: int = None):
+        if prewarm is None:
+            prewarm = get_setting("PREWARM_CONNECTIONS", PREWARM_CONNECTIONS)
+        self.dsn = dsn
+        self.max_connections = max_connections
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.opened = 0
+        self.replaced = 0
+        self.stats = CheckoutStats()
+        self.health_check_idle = get_setting("HEALTH_CHECK_IDLE", HEALTH_CHECK_IDLE)
+        self.prewarm(min(prewarm, max_connections))
+
+    def open(self) -> psycopg2.extensions.connection:
+        """ A new connection """
+
+        conn = connect(self.dsn)
+        with self.lock:
+            self.opened += 1
+        return conn
+
+    def prewarm(self, count: int):
+        """ Open count connections at the same time, so a cold start
+        is waited out once at startup rather than by the first steps """
+
+        if count < 1:
+            return
+
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            connections = list(executor.map(lambda _: self.open(), range(count)))
+
+        returned_at = time.time()
+        with self.lock:
+            self.idle.extend((conn, returned_at) for conn in connections)
+        print(f"Opened {count} pooled connections in {time.time() - start_time:.1f} seconds.")
+
+    def is_healthy(self, conn: psycopg2.extensions.connection, idle_seconds: float) -> bool:
+        """ False if the connection is closed, or sat idle and does not answer """
+
+        if conn.closed:
+            return False
+        if idle_seconds < self.health_check_idle:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1;')
+                cur.fetchone()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    @staticmethod
+    def discard(conn: psycopg2.extensions.connection):
+        """ Close a connection that is not reused """
+
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self) -> psycopg2.extensions.connection:
+        """ A healthy connection, waits while max_connections are checked out """
+
+        start_time = time.time()
+        self.slots.acquire()
+        slot_wait = time.time() - start_time
+
+        try:
+            conn = None
+            while conn is None:
+                with self.lock:
+                    idle = self.idle.pop() if self.idle else None
+                if idle is None:
+                    conn = self.open()
+                elif self.is_healthy(idle[0], time.time() - idle[1]):
+                    conn = idle[0]
+                else:
+                    self.discard(idle[0])
+                    with self.lock:
+                        self.replaced += 1
+        except Exception:
+            self.slots.release()
+            raise
+
+        self.stats.record(slot_wait, time.time() - start_time)
+        return conn
+
+    def putconn(self, conn: psycopg2.extensions.connection, close: bool = False):
+        """ Return a connection, with close (e.g. after a connection error) it is not reused.
+        An open transaction is rolled back """
+
+        if not close and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+
+        if close or conn.closed:
+            self.discard(conn)
+        else:
+            with self.lock:
+                self.idle.append((conn, time.time()))
+        self.slots.release()
+
+    def closeall(self):
+        """ Close the idle connections """
+
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            self.discard(conn)
+
+    def print_stats(self):
+        """ Print the checkout waits and how many connections were opened and replaced """
+
+        print(f"Connection pool: {self.stats.get_summary(self.max_connections)}, " +
+              f"{self.opened} connections opened, {self.replaced} replaced after a failed " +
+              "health check.")
@@ -3,23 +3,29 @@
 
 import psycopg2
 import utilities
-from sql_queries import create_table_queries, drop_table_queries
+import dialects
+import metrics
+from sql_queries import get_create_table_queries, drop_table_queries
 
 
 def drop_tables(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection):
     """ loop through list of DDL SQL to drop any existing 
     tables (that we are creating new versions of)"""
 
+    dialect = utilities.get_db_dialect()
     for query in drop_table_queries:
-        cur.execute(query)
+        metrics.execute(cur, metrics.get_statement_name(query),
+                        dialects.translate(query, dialect))
         conn.commit()
 
 
 def create_new_tables(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection):
     """ loop through list of DDL SQL to create new tables """
 
-    for query in create_table_queries:
-        cur.execute(query)
+    dialect = utilities.get_db_dialect()
+    for query in get_create_table_queries():
+        metrics.execute(cur, metrics.get_statement_name(query),
+                        dialects.translate(query, dialect))
         conn.commit()
 
 
@@ -31,6 +37,7 @@ def main():
     cur = conn.cursor()
     drop_tables(cur, conn)
     create_new_tables(cur, conn)
+    metrics.finish(conn, 'create_tables')
     conn.close()
 
 
@@ -0,0 +1,146 @@
+""" Translate the Redshift SQL in sql_queries.py for other databases
+
+The SQL is written for Redshift.  'postgres' and 'duckdb' rewrite the few Redshift only
+pieces, so the same DDL, inserts and sample queries can run against a local PostgreSQL
+or in-process on DuckDB (see duckdb_engine.py) """
+
+import re
+from sql_queries import (STAGING_EVENTS_JSON_FIELDS, STAGING_SONGS_JSON_FIELDS,
+                         STAGING_INTEGER_JSON_FIELDS)
+
+DIALECTS = ['redshift', 'postgres', 'duckdb']
+
+# staging table -> JSON fields in column order
+_STAGING_JSON_FIELDS = {'staging_events': STAGING_EVENTS_JSON_FIELDS,
+                        'staging_songs': STAGING_SONGS_JSON_FIELDS}
+
+
+def _strip_physical_design(query: str) -> str:
+    """ Leave out Redshift's distribution styles, sort keys and column encodings """
+
+    query = re.sub(r'\s+ENCODE\s+\w+', '', query)
+    query = re.sub(r'\s+DISTSTYLE\s+\w+', '', query)
+    query = re.sub(r'\s+DISTKEY\s*\(\w+\)', '', query)
+    query = re.sub(r'\s+(COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*(\([^)]*\)|AUTO)', '', query)
+
+    return query
+
+
+def _replace_function(query: str, name: str, template: str) -> str:
+    """ Replace every call name(argument) with the template, {} standing for the
+    argument.  The argument may itself contain parentheses """
+
+    start = query.find(name + '(')
+    while start != -1:
+        depth = 0
+        for end in range(start + len(name), len(query)):
+            if query[end] == '(':
+                depth += 1
+            elif query[end] == ')':
+                depth -= 1
+                if depth == 0:
+                    break
+
+        argument = query[start + len(name) + 1:end]
+        replacement = template.format(argument)
+        query = query[:start] + replacement + query[end + 1:]
+        start = query.find(name + '(', start + len(replacement))
+
+    return query
+
+
+def _replace_all_matches(query: str) -> str:
+    """ Redshift's REGEXP_REPLACE replaces every match,
+    PostgreSQL's and DuckDB's only the first without the 'g' flag """
+
+    return query.replace("'[[:space:]]+', ' ')", "'[[:space:]]+', ' ', 'g')")
+
+
+def _to_postgres(query: str) -> str:
+    """ Redshift SQL -> PostgreSQL """
+
+    query = _strip_physical_design(query)
+    # Redshift only uses primary keys as planner hints, the loads do not rely on them
+    # being enforced (e.g. staging_songs may hold a song twice), PostgreSQL would
+    # enforce them, so they are left out
+    query = re.sub(r'\s+PRIMARY KEY', '', query)
+    query = re.sub(r'IDENTITY\((\d+),\s*(\d+)\)',
+                   r'GENERATED BY DEFAULT AS IDENTITY (START WITH \1 INCREMENT BY \2 MINVALUE \1)',
+                   query)
+    query = query.replace('GETDATE()', 'CURRENT_TIMESTAMP')
+    query = re.sub(r'EXTRACT\(WEEKDAY\b', 'EXTRACT(DOW', query)
+    query = _replace_all_matches(query)
+    query = _replace_function(query, 'FNV_HASH', 'hashtextextended({}, 0)')
+
+    return query
+
+
+def _duckdb_identity(query: str) -> str:
+    """ IDENTITY(start, step) column -> column defaulting to a sequence,
+    DuckDB has no identity columns """
+
+    match = re.search(r'CREATE TABLE ([\w.]+)\s*\(.*?(\w+)\s+\w+\s+IDENTITY\((\d+),\s*(\d+)\)',
+                      query, re.DOTALL)
+    if match is None:
+        return query
+
+    table, column, start, step = match.groups()
+    sequence = f"{table.replace('.', '_')}_{column}_seq"
+    query = re.sub(r'IDENTITY\(\d+,\s*\d+\)', f"DEFAULT nextval('{sequence}')", query, count=1)
+
+    return (f"CREATE OR REPLACE SEQUENCE {sequence} START {start} INCREMENT BY {step} " +
+            f"MINVALUE {start};" + query)
+
+
+def _duckdb_copy(match: re.Match) -> str:
+    """ COPY <staging table> FROM '<path>' ... -> INSERT ... SELECT from DuckDB's read_json.
+    The path is a local file, or a local directory whose JSON files are all read """
+
+    table, path = match.group(1), match.group(2)
+    fields = _STAGING_JSON_FIELDS[table]
+
+    if not path.endswith('.json'):
+        path = path.rstrip('/') + '/**/*.json'
+
+    columns = ', '.join(f"'{field}': 'VARCHAR'" for field in fields)
+    values = ', '.join(f'TRY_CAST(TRY_CAST("{field}" AS DOUBLE) AS BIGINT)'
+                       if field in STAGING_INTEGER_JSON_FIELDS else f'"{field}"'
+                       for field in fields)
+
+    return (f"INSERT INTO {table} ({', '.join(fields)}) SELECT {values} " +
+            f"FROM read_json('{path}', " +
+            f"format = 'newline_delimited', columns = {{{columns}}});")
+
+
+def _to_duckdb(query: str) -> str:
+    """ Redshift SQL -> DuckDB """
+
+    query = re.sub(r'COPY\s+(\w+)\s+FROM\s+\'([^\']*)\'[^;]*;', _duckdb_copy, query)
+    query = _strip_physical_design(query)
+    query = re.sub(r'\s+PRIMARY KEY', '', query)
+    query = _duckdb_identity(query)
+    query = query.replace('GETDATE()', 'CURRENT_TIMESTAMP')
+    query = _replace_all_matches(query)
+    # DuckDB's hash is an unsigned 64 bit integer, halved to fit the BIGINT match keys
+    query = _replace_function(query, 'FNV_HASH', 'CAST(hash({}) >> 1 AS BIGINT)')
+    query = re.sub(r'SET search_path TO ([^;]*);',
+                   lambda match: "SET search_path = '" + match.group(1).replace(' ', '') + "';",
+                   query)
+    # Redshift divides integers, i.e. the timestamps are truncated to whole seconds
+    query = re.sub(r"TIMESTAMP 'epoch' \+ \((.+?) / 1000\) \* INTERVAL '1 second'",
+                   r'make_timestamp(((\1) // 1000) * 1000000)', query)
+
+    return query
+
+
+def translate(query: str, dialect: str) -> str:
+    """ The query, rewritten for the given dialect """
+
+    if dialect == 'redshift':
+        return query
+    if dialect == 'postgres':
+        return _to_postgres(query)
+    if dialect == 'duckdb':
+        return _to_duckdb(query)
+
+    raise ValueError(f"Unknown SQL dialect {dialect}, expected one of {DIALECTS}")
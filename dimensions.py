@@ -0,0 +1,53 @@
+""" Change report of the dimension upserts
+
+The user_changes, song_changes and artist_changes steps (see DIMENSION UPSERTS in
+sql_queries.py) classify the latest staging version of every dimension row as an
+insert, an update or unchanged before the changes are applied.  The staging_*_changes
+tables are emptied before each load and counted after it """
+
+import psycopg2
+from prettytable import PrettyTable
+import utilities
+import dialects
+from sql_queries import dimension_changes_tables, STAGING_CHANGES_TRUNCATE, STAGING_CHANGES_COUNT
+
+CHANGE_TYPES = ['insert', 'update', 'unchanged']
+
+
+def reset_dimension_changes(cur: psycopg2.extensions.cursor,
+                            conn: psycopg2.extensions.connection):
+    """ Empty the staging_*_changes tables before a load """
+
+    for changes_table in dimension_changes_tables.values():
+        cur.execute(dialects.translate(STAGING_CHANGES_TRUNCATE.format(changes_table),
+                                       utilities.get_db_dialect()))
+    conn.commit()
+
+
+def get_dimension_changes(cur: psycopg2.extensions.cursor) -> dict:
+    """ dimension -> {change type -> rows} of the last load """
+
+    changes = {}
+    for dimension, changes_table in dimension_changes_tables.items():
+        cur.execute(dialects.translate(STAGING_CHANGES_COUNT.format(changes_table),
+                                       utilities.get_db_dialect()))
+        counts = dict(cur.fetchall())
+        changes[dimension] = {change_type: counts.get(change_type, 0)
+                              for change_type in CHANGE_TYPES}
+
+    return changes
+
+
+def report_dimension_changes(cur: psycopg2.extensions.cursor,
+                             conn: psycopg2.extensions.connection):
+    """ Print how many rows of each dimension were inserted, updated and left unchanged """
+
+    changes = get_dimension_changes(cur)
+    conn.commit()
+
+    report = PrettyTable()
+    report.field_names = ['Dimension', 'Inserted', 'Updated', 'Unchanged']
+    report.align['Dimension'] = 'l'
+    for dimension, counts in changes.items():
+        report.add_row([dimension] + [counts[change_type] for change_type in CHANGE_TYPES])
+    print(report)
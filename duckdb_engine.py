@@ -0,0 +1,168 @@
+""" In-process DuckDB database behind a psycopg2 style interface
+
+create_tables.py, etl.py and analysis.py only use a small part of the psycopg2
+connection / cursor / pool interface.  These classes provide it on top of DuckDB,
+so with dialect = duckdb in dwh.cfg the whole pipeline runs in-process on local data,
+with the SQL rewritten by dialects.py """
+
+import re
+import time
+import duckdb
+from connections import CheckoutStats
+
+DEFAULT_PATH = 'sparkify.duckdb'
+
+_NAMED_PARAMETER = re.compile(r'%\((\w+)\)s')
+
+
+def _to_duckdb_parameters(query: str, params):
+    """ psycopg2 style parameters (%s or %(name)s) -> DuckDB style (? or $name) """
+
+    if params is None:
+        return query, None
+
+    if isinstance(params, dict):
+        names = set(_NAMED_PARAMETER.findall(query))
+        query = _NAMED_PARAMETER.sub(r'$\1', query)
+        # DuckDB, unlike psycopg2, rejects parameters the query does not use
+        params = {name: value for name, value in params.items() if name in names}
+    else:
+        query = query.replace('%s', '?')
+
+    return query.replace('%%', '%'), params
+
+
+class DuckDBCursor:
+    """ Cursor that, like psycopg2, starts a transaction with the first statement.
+    It runs on its connection's DuckDB connection, which holds the transaction """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.database
+        self.last_rowcount = -1
+
+    def execute(self, query: str, params=None):
+        """ Execute a query with psycopg2 style parameters """
+
+        self.connection.begin()
+        query, params = _to_duckdb_parameters(query, params)
+        self.cursor.execute(query, params)
+        self.last_rowcount = -1
+
+    def executemany(self, query: str, params_list):
+        """ Execute a query once for each set of psycopg2 style parameters """
+
+        self.connection.begin()
+        for params in params_list:
+            self.cursor.execute(*_to_duckdb_parameters(query, params))
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self) -> int:
+        """ Rows written by the last INSERT, UPDATE, DELETE or COPY, -1 for other
+        statements.  DuckDB returns them as the statement's single Count row """
+
+        description = self.cursor.description
+        if description and len(description) == 1 and description[0][0] == 'Count':
+            row = self.cursor.fetchone()
+            if row is not None:
+                self.last_rowcount = row[0]
+            return self.last_rowcount
+        return -1
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size: int):
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        """ Nothing to release, the DuckDB connection is closed with the connection """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DuckDBConnection:
+    """ Connection with psycopg2 transaction handling (commit / rollback) """
+
+    def __init__(self, database):
+        self.database = database
+        self.in_transaction = False
+        # like psycopg2's connection.closed, nonzero once closed
+        self.closed = 0
+
+    def begin(self):
+        """ Start a transaction unless one is already open """
+
+        if not self.in_transaction:
+            self.database.execute('BEGIN TRANSACTION;')
+            self.in_transaction = True
+
+    def cursor(self, name: str = None) -> DuckDBCursor:
+        """ New cursor, name is accepted for psycopg2's named (server side) cursors,
+        DuckDB results are fetched from the database in chunks anyway """
+
+        return DuckDBCursor(self)
+
+    def commit(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.database.execute('COMMIT;')
+
+    def rollback(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.database.execute('ROLLBACK;')
+
+    def cancel(self):
+        """ Interrupt the running statement, like psycopg2's connection.cancel() """
+
+        self.database.interrupt()
+
+    def close(self):
+        self.rollback()
+        self.database.close()
+        self.closed = 1
+
+
+class DuckDBPool:
+    """ Connections to one DuckDB database, with the interface of
+    psycopg2's ThreadedConnectionPool.  Each connection is a DuckDB cursor,
+    DuckDB's way of using one database from several threads """
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.database = duckdb.connect(path)
+        self.stats = CheckoutStats()
+
+    def getconn(self) -> DuckDBConnection:
+        start_time = time.time()
+        conn = DuckDBConnection(self.database.cursor())
+        self.stats.record(0.0, time.time() - start_time)
+        return conn
+
+    def putconn(self, conn: DuckDBConnection, close: bool = False):
+        conn.close()
+
+    def closeall(self):
+        self.database.close()
+
+    def print_stats(self):
+        """ Print the checkout waits, DuckDB connections are never in short supply """
+
+        print(f"Connection pool: {self.stats.get_summary()}.")
+
+
+def connect(path: str = DEFAULT_PATH) -> DuckDBConnection:
+    """ Open (or create) the DuckDB database file """
+
+    return DuckDBConnection(duckdb.connect(path))
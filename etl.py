@@ -1,63 +1,629 @@
-""" This ETL code reads from S3 and populates staging 
-and fact-dimension tables in a database tables associated 
-with a Serverless Redshift """
+""" This ETL code reads from S3 and populates staging
+and fact-dimension tables in a database tables associated
+with a Serverless Redshift
 
-import configparser
+By default only S3 files that have not been loaded before are copied into staging
+and only their rows are appended to the fact-dimension tables (see the etl_loaded_files
+and etl_watermarks control tables).  Run with --full-refresh to reload everything.
+
+Every run records its steps in the etl_run_journal table (see run_journal.py),
+etl.py --resume continues a run that failed from its first incomplete step."""
+
+import argparse
+import os
 import psycopg2
+import psycopg2.pool
 import utilities
 import analysis
-from sql_queries import copy_table_queries, insert_table_queries
+import parallel
+import pipeline
+import manifests
+import stdin_loader
+import dialects
+import time_dimension
+import result_cache
+import match_keys
+import blue_green
+import dimensions
+import run_journal
+import load_errors
+import metrics
+from s3_listing import S3Lister, LocalLister, split_s3_path
+from sql_queries import (copy_table_queries, insert_table_steps,
+                         incremental_insert_table_steps,
+                         STAGING_EVENTS_COPY, STAGING_SONGS_COPY, STAGING_SONGS_MANIFEST_COPY,
+                         STAGING_EVENTS_TRUNCATE, STAGING_EVENTS_KEYED_TRUNCATE,
+                         STAGING_SONGPLAYS_TRUNCATE, STAGING_USER_LEVELS_TRUNCATE,
+                         STAGING_EVENTS_MAX_TS, WATERMARK_SELECT, WATERMARK_DELETE,
+                         WATERMARK_INSERT, LOADED_FILES_SELECT, LOADED_FILES_INSERT,
+                         LOADED_FILES_ROW_INSERT, LOADED_FILES_DELETE, SONGPLAYS_PENDING_COUNT,
+                         STAGING_SONGPLAYS_COUNT, STAGING_USER_LEVELS_COUNT,
+                         staging_truncate_queries, rename_generation_tables, NEXT_SUFFIX,
+                         get_copy_max_errors, get_time_grain_ms)
 
 LOG_DATA = 's3://udacity-dend/log-data'
 LOG_JSONPATH = 's3://udacity-dend/log_json_path.json'
-SONG_DATA = 's3://udacity-dend/song-data/A/A'
+SONG_DATA = 's3://udacity-dend/song-data'
 S3_REGION = 'us-west-2'
 
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
-ROLE_ARN = config.get("IAM_ROLE", "ARN")
+# source name (as recorded in the control tables) -> S3 prefix
+STAGING_SOURCES = {'log_data': LOG_DATA,
+                   'song_data': SONG_DATA}
+
+# source name -> staging table
+STAGING_TABLES = {'log_data': 'staging_events',
+                  'song_data': 'staging_songs'}
+
+# source name -> COPY template
+STAGING_COPIES = {'log_data': STAGING_EVENTS_COPY,
+                  'song_data': STAGING_SONGS_COPY}
+
+
+def sql(query: str) -> str:
+    """ The query rewritten for the SQL dialect of the database """
+
+    return dialects.translate(query, utilities.get_db_dialect())
+
+
+def get_manifest_path() -> str:
+    """ Where song_data COPY manifests are written (MANIFEST_PATH in the S3 section of
+    dwh.cfg, a bucket in S3_REGION the role can read), empty to copy the song data one
+    track-ID letter prefix at a time """
+
+    return utilities.get_config_value("S3", "MANIFEST_PATH", '')
+
+
+def format_copy_query(query: str, s3_path: str) -> str:
+    """ Fill in a COPY template from copy_table_queries for the given S3 path """
+
+    role_arn = utilities.get_config().get("IAM_ROLE", "ARN")
+    max_errors = get_copy_max_errors()
+    if 'staging_songs' in query:
+        query = query.format(s3_path, role_arn, max_errors, S3_REGION)
+    elif 'staging_events' in query:
+        query = query.format(s3_path, role_arn, LOG_JSONPATH, max_errors, S3_REGION)
+
+    return query
+
+
+def list_song_objects(lister: S3Lister) -> list:
+    """ (key, size) of every song file, listed one track-ID letter partition at a time """
 
+    bucket, _ = split_s3_path(SONG_DATA)
+    song_objects = []
+    for partition in lister.list_partitions(SONG_DATA):
+        song_objects.extend(lister.list_objects(f"s3://{bucket}/{partition}"))
 
-def load_staging_tables(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection):
-    """ Extracts data from S3 into staging database tables """
+    return song_objects
 
+
+def get_song_copy_statements(new_objects: list, all_keys: list, slices: int) -> list:
+    """ (name, query) COPY statements that load the new song files.
+
+    With a manifest path the files are split into evenly sized manifests,
+    otherwise each fully new track-ID letter prefix gets its own COPY """
+
+    bucket, root_prefix = split_s3_path(SONG_DATA)
+    manifest_path = get_manifest_path()
+
+    if manifest_path:
+        batches = manifests.get_batches(new_objects, slices)
+        # boto3 is slow to import, only import it when manifests are uploaded
+        import boto3
+        s3_client = boto3.client('s3', region_name=S3_REGION)
+        manifest_paths = manifests.upload_manifests(s3_client, manifest_path, 'song_data',
+                                                    bucket, batches)
+        print(f"song_data: {len(new_objects)} files in {len(manifest_paths)} manifests " +
+              f"for {slices} slices")
+        return [(f"song_data COPY of {manifest_path}",
+                 format_copy_query(STAGING_SONGS_MANIFEST_COPY, manifest_path))
+                for manifest_path in manifest_paths]
+
+    new_keys = [key for key, _ in new_objects]
+    return [(f"song_data COPY of {prefix}",
+             format_copy_query(STAGING_SONGS_COPY, f"s3://{bucket}/{prefix}"))
+            for prefix in get_copy_prefixes(new_keys, all_keys, root_prefix, split_root=True)]
+
+
+def load_staging_tables(pool: psycopg2.pool.ThreadedConnectionPool, max_workers: int,
+                        song_objects: list, slices: int, journal: run_journal.RunJournal):
+    """ Extracts data from S3 into staging database tables,
+    running the COPYs at the same time on separate connections """
+
+    statements = []
     for query in copy_table_queries:
 
         if 'staging_songs' in query:
-            query = query.format(SONG_DATA, ROLE_ARN, S3_REGION)
+            song_keys = [key for key, _ in song_objects]
+            statements.extend(get_song_copy_statements(song_objects, song_keys, slices))
         elif 'staging_events' in query:
-            query = query.format(LOG_DATA, ROLE_ARN, LOG_JSONPATH, S3_REGION)
+            query = format_copy_query(query, LOG_DATA)
+            statements.append(('staging_events COPY', query))
 
+    for _, query in statements:
         print('\n', query, '\n')
 
-        cur.execute(query)
-        conn.commit()
+    parallel.run_statements_in_parallel(pool, statements, max_workers, journal)
+
+
+def load_local_source(cur: psycopg2.extensions.cursor, table: str, paths: list,
+                      run_id: int) -> int:
+    """ Stream local files into a staging table and quarantine the records it
+    rejected, uncommitted, returns the number of rows loaded """
+
+    rejected = []
+    row_count = stdin_loader.load_staging_files(cur, table, paths, rejected=rejected)
+    load_errors.quarantine_rejected_records(cur, run_id, rejected)
+
+    return row_count
+
+
+def quarantine_copy_errors(cur: psycopg2.extensions.cursor,
+                           conn: psycopg2.extensions.connection,
+                           journal: run_journal.RunJournal):
+    """ Move the records the Redshift COPYs of the run rejected into etl_load_errors
+    (local loads quarantine their own) """
+
+    if utilities.get_db_dialect() == 'redshift':
+        journal.run_step(cur, conn, 'load_errors', load_errors.quarantine_copy_errors,
+                         cur, journal.run_id)
+
+
+def load_local_files(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection,
+                     local_data: str, keys_by_source: dict, all_keys_by_source: dict,
+                     journal: run_journal.RunJournal):
+    """ Loads local data files, laid out like the S3 bucket under local_data, into staging.
+
+    DuckDB reads the JSON files itself (the COPYs are rewritten by dialects.py),
+    other databases get the rows streamed by the client with COPY FROM STDIN.
+    DuckDB has no error budget, it stops at the first malformed record """
+
+    dialect = utilities.get_db_dialect()
+    max_errors = get_copy_max_errors()
+    if dialect == 'duckdb' and max_errors and any(keys_by_source.values()):
+        print(f"copy_max_errors ({max_errors}) does not apply to DuckDB, which reads " +
+              "the files itself: the load stops at the first malformed record")
+
+    for source, keys in keys_by_source.items():
+        if not keys:
+            continue
+
+        if dialect == 'duckdb':
+            _, root_prefix = split_s3_path(STAGING_SOURCES[source])
+            for prefix in get_copy_prefixes(keys, all_keys_by_source[source], root_prefix):
+                query = sql(format_copy_query(STAGING_COPIES[source],
+                                              os.path.join(local_data, prefix)))
+
+                print('\n', query, '\n')
+
+                journal.run_query(cur, conn, f"{source} COPY of {prefix}", query)
+        else:
+            paths = [os.path.join(local_data, key) for key in keys]
+            journal.run_step(cur, conn, f"{source} COPY FROM STDIN", load_local_source,
+                             cur, STAGING_TABLES[source], paths, journal.run_id)
+
+
+def translate_steps(steps: list, suffix: str = '') -> list:
+    """ The steps with their queries rewritten for the SQL dialect of the database,
+    with a suffix (e.g. _next) writing to that generation of the tables """
+
+    dialect = utilities.get_db_dialect()
+    return [dict(step, query=dialects.translate(rename_generation_tables(step['query'], suffix),
+                                                dialect))
+            for step in steps]
+
+
+def insert_tables(pool: psycopg2.pool.ThreadedConnectionPool, max_workers: int,
+                  journal: run_journal.RunJournal, suffix: str = ''):
+    """ Transforms and loads data in staging tables into fact-dimension tables,
+    running the inserts that do not depend on each other at the same time """
+    steps = translate_steps(insert_table_steps, suffix)
+    for step in steps:
+
+        print('\n', step['query'], '\n')
+
+    pipeline.run_pipeline(pool, steps, max_workers, {'time_grain_ms': get_time_grain_ms()},
+                          journal)
+
+
+def get_copy_prefixes(new_keys: list, all_keys: list, root_prefix: str,
+                      split_root: bool = False) -> list:
+    """ Group the new keys into as few COPY prefixes as possible.
+
+    A directory is copied as a whole when every key under it is new, otherwise
+    its new files are copied one by one.  When nothing has been loaded yet this
+    is just the root prefix, i.e. the same single COPY as a full refresh,
+    or with split_root the directories directly under it """
+
+    def ancestors(key):
+        """ directory prefixes of a key below the root, shortest first """
+        parts = key[len(root_prefix):].strip('/').split('/')[:-1]
+        prefix = root_prefix.rstrip('/')
+        if not split_root:
+            yield prefix
+        for part in parts:
+            prefix = f"{prefix}/{part}"
+            yield prefix
+
+    all_counts = {}
+    for key in all_keys:
+        for prefix in ancestors(key):
+            all_counts[prefix] = all_counts.get(prefix, 0) + 1
+
+    new_counts = {}
+    for key in new_keys:
+        for prefix in ancestors(key):
+            new_counts[prefix] = new_counts.get(prefix, 0) + 1
+
+    copy_prefixes = []
+    for key in sorted(new_keys):
+        copy_prefix = key
+        for prefix in ancestors(key):
+            if new_counts[prefix] == all_counts[prefix]:
+                copy_prefix = prefix
+                break
+        if copy_prefix not in copy_prefixes:
+            copy_prefixes.append(copy_prefix)
+
+    return copy_prefixes
+
+
+def get_loaded_keys(cur: psycopg2.extensions.cursor, source: str) -> set:
+    """ S3 keys of a source that have already been loaded into staging """
+
+    cur.execute(sql(LOADED_FILES_SELECT), (source,))
+    return {row[0] for row in cur.fetchall()}
+
+
+def get_watermark(cur: psycopg2.extensions.cursor, source: str) -> int:
+    """ The high water mark of a source (0 if nothing was loaded yet) """
+
+    cur.execute(sql(WATERMARK_SELECT), (source,))
+    row = cur.fetchone()
+    if row is None or row[0] is None:
+        return 0
+    return row[0]
+
+
+def record_loaded_keys(cur: psycopg2.extensions.cursor, source: str, keys: list):
+    """ Remember which S3 keys of a source have been loaded """
+
+    if not keys:
+        return
 
+    rows = [(source, key) for key in keys]
+    utilities.insert_rows(cur, LOADED_FILES_INSERT, sql(LOADED_FILES_ROW_INSERT), rows)
 
-def insert_tables(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection):
-    """ Transforms and loads data in staging tables into fact-dimension tables"""
-    for query in insert_table_queries:
 
+def record_watermark(cur: psycopg2.extensions.cursor, source: str, watermark):
+    """ Replace the high water mark of a source """
+
+    cur.execute(sql(WATERMARK_DELETE), (source,))
+    cur.execute(sql(WATERMARK_INSERT), (source, watermark))
+
+
+def truncate_tables(cur: psycopg2.extensions.cursor, truncate_queries: list):
+    """ Empty staging tables (committed by the caller) """
+
+    for query in truncate_queries:
+        cur.execute(sql(query))
+
+
+def load_new_staging_files(cur: psycopg2.extensions.cursor,
+                           conn: psycopg2.extensions.connection,
+                           pool: psycopg2.pool.ThreadedConnectionPool,
+                           max_workers: int, lister: S3Lister, slices: int,
+                           journal: run_journal.RunJournal, local_data: str = None) -> dict:
+    """ Copies only the S3 files that have not been loaded before into staging,
+    running the COPYs at the same time on separate connections
+    (or, with local_data, streams the new local files with COPY FROM STDIN).
+
+    staging_events and the staging tables derived from it are emptied first, so
+    they only hold the new events, while staging_songs keeps the whole catalog for
+    matching.  Returns, per source, the new keys that were loaded (recorded after the
+    inserts succeed) """
+
+    journal.run_step(cur, conn, 'staging_truncate', truncate_tables, cur,
+                     [STAGING_EVENTS_TRUNCATE, STAGING_EVENTS_KEYED_TRUNCATE,
+                      STAGING_SONGPLAYS_TRUNCATE, STAGING_USER_LEVELS_TRUNCATE])
+
+    statements = []
+    new_keys_by_source = {}
+    all_keys_by_source = {}
+    for source, s3_path in STAGING_SOURCES.items():
+
+        if source == 'song_data':
+            all_objects = list_song_objects(lister)
+        else:
+            all_objects = lister.list_objects(s3_path)
+        all_keys = [key for key, _ in all_objects]
+        loaded_keys = get_loaded_keys(cur, source)
+        new_objects = [s3_object for s3_object in all_objects if s3_object[0] not in loaded_keys]
+        new_keys = [key for key, _ in new_objects]
+        new_keys_by_source[source] = new_keys
+        all_keys_by_source[source] = all_keys
+
+        print(f"{source}: {len(new_keys)} new of {len(all_keys)} files")
+
+        if not new_keys or local_data:
+            continue
+
+        if source == 'song_data':
+            statements.extend(get_song_copy_statements(new_objects, all_keys, slices))
+        else:
+            bucket, root_prefix = split_s3_path(s3_path)
+            for prefix in get_copy_prefixes(new_keys, all_keys, root_prefix):
+                statements.append((f"{source} COPY of {prefix}",
+                                   format_copy_query(STAGING_EVENTS_COPY,
+                                                     f"s3://{bucket}/{prefix}")))
+
+    for _, query in statements:
         print('\n', query, '\n')
 
-        cur.execute(query)
-        conn.commit()
+    if statements:
+        parallel.run_statements_in_parallel(pool, statements, max_workers, journal)
+
+    if local_data:
+        load_local_files(cur, conn, local_data, new_keys_by_source, all_keys_by_source,
+                         journal)
+
+    return new_keys_by_source
+
+
+def insert_new_rows(pool: psycopg2.pool.ThreadedConnectionPool, max_workers: int,
+                    journal: run_journal.RunJournal):
+    """ Appends the rows of the newly loaded files from staging tables into
+    fact-dimension tables, running the inserts that do not depend on each other
+    at the same time """
+
+    steps = translate_steps(incremental_insert_table_steps)
+    for step in steps:
+
+        print('\n', step['query'], '\n')
+
+    pipeline.run_pipeline(pool, steps, max_workers, {'time_grain_ms': get_time_grain_ms()},
+                          journal)
+
+
+def write_control_rows(cur: psycopg2.extensions.cursor, loaded_keys_by_source: dict,
+                       watermark: int, full_load: bool = False) -> int:
+    """ Records the loaded S3 keys (with full_load in place of the keys recorded before)
+    and moves the log_data watermark forward, committed by the caller.  Returns the
+    watermark """
+
+    if full_load:
+        for source in loaded_keys_by_source:
+            cur.execute(sql(LOADED_FILES_DELETE), (source,))
+
+    cur.execute(sql(STAGING_EVENTS_MAX_TS))
+    max_ts = cur.fetchone()[0]
+    if max_ts is not None:
+        watermark = max(watermark, max_ts)
+
+    for source, keys in loaded_keys_by_source.items():
+        record_loaded_keys(cur, source, keys)
+
+    record_watermark(cur, 'log_data', watermark)
+    return watermark
+
+
+def print_pending_count(cur: psycopg2.extensions.cursor):
+    """ Print how many events wait for their song """
+
+    cur.execute(sql(SONGPLAYS_PENDING_COUNT))
+    print(f"{cur.fetchone()[0]} events are pending, waiting for their song to be loaded")
+
 
+def count_changed_rows(cur: psycopg2.extensions.cursor) -> int:
+    """ Songplays the incremental inserts added, the level periods they added or changed
+    (a level change of a user may leave the users row as it was, e.g. from a late event)
+    plus the dimension rows they inserted or updated (songplays_by_hour only changes
+    along with the songplays) """
 
-def main():
+    changed_rows = 0
+    for count_query in [STAGING_SONGPLAYS_COUNT, STAGING_USER_LEVELS_COUNT]:
+        cur.execute(sql(count_query))
+        changed_rows += cur.fetchone()[0]
+    for counts in dimensions.get_dimension_changes(cur).values():
+        changed_rows += counts['insert'] + counts['update']
+
+    return changed_rows
+
+
+def update_control_tables(cur: psycopg2.extensions.cursor, loaded_keys_by_source: dict,
+                          watermark: int, full_load: bool = False):
+    """ Records the loaded S3 keys, moves the log_data watermark forward and, if the load
+    changed any rows (a full load always does), records a new data version (load id, see
+    result_cache.py), so the cached analysis results of a run that changed nothing stay
+    valid.  Committed by the run journal with the step, so a failed run is simply loaded
+    again next time """
+
+    watermark = write_control_rows(cur, loaded_keys_by_source, watermark, full_load)
+    if full_load or count_changed_rows(cur) > 0:
+        data_version = f"data version {result_cache.record_data_version(cur)}"
+    else:
+        data_version = "no rows changed, the data version stays"
+
+    print(f"log_data watermark is now {watermark}, {data_version}")
+    print_pending_count(cur)
+
+
+def update_full_load_control_tables(cur: psycopg2.extensions.cursor, loaded_keys: dict):
+    """ Replace the loaded S3 keys with the keys of a full load """
+
+    update_control_tables(cur, loaded_keys, 0, full_load=True)
+
+
+def full_load(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection,
+              pool: psycopg2.pool.ThreadedConnectionPool, args: argparse.Namespace,
+              lister: S3Lister, slices: int, journal: run_journal.RunJournal):
+    """ Copy all of the data into staging and run every insert """
+
+    song_objects = list_song_objects(lister)
+    loaded_keys = {'log_data': lister.list_keys(LOG_DATA),
+                   'song_data': [key for key, _ in song_objects]}
+    if args.local_data:
+        load_local_files(cur, conn, args.local_data, loaded_keys, loaded_keys, journal)
+    else:
+        load_staging_tables(pool, args.staging_concurrency, song_objects, slices, journal)
+    quarantine_copy_errors(cur, conn, journal)
+    journal.run_step(cur, conn, 'time', time_dimension.load_time_dimension, cur, conn)
+    journal.run_step(cur, conn, 'dimension_changes_reset',
+                     dimensions.reset_dimension_changes, cur, conn)
+    insert_tables(pool, args.transform_concurrency, journal)
+    dimensions.report_dimension_changes(cur, conn)
+    journal.run_step(cur, conn, 'control_tables', update_full_load_control_tables,
+                     cur, loaded_keys)
+
+
+def incremental_load(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection,
+                     pool: psycopg2.pool.ThreadedConnectionPool, args: argparse.Namespace,
+                     lister: S3Lister, slices: int, journal: run_journal.RunJournal):
+    """ Copy the new data files into staging and append or upsert their rows """
+
+    watermark = get_watermark(cur, 'log_data')
+    new_keys = load_new_staging_files(cur, conn, pool, args.staging_concurrency,
+                                      lister, slices, journal, args.local_data)
+    quarantine_copy_errors(cur, conn, journal)
+    journal.run_step(cur, conn, 'time', time_dimension.load_time_dimension, cur, conn)
+    journal.run_step(cur, conn, 'dimension_changes_reset',
+                     dimensions.reset_dimension_changes, cur, conn)
+    insert_new_rows(pool, args.transform_concurrency, journal)
+    dimensions.report_dimension_changes(cur, conn)
+    journal.run_step(cur, conn, 'control_tables', update_control_tables,
+                     cur, new_keys, watermark)
+
+
+def load_shadow_tables(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection,
+                       pool: psycopg2.pool.ThreadedConnectionPool, args: argparse.Namespace,
+                       lister: S3Lister, slices: int, journal: run_journal.RunJournal):
+    """ Full refresh into a new generation of the tables (see blue_green.py), which is
+    swapped in once its row counts check out.  The current tables stay readable until
+    the swap, a failed load or check leaves them untouched """
+
+    journal.run_step(cur, conn, 'staging_truncate', truncate_tables, cur,
+                     staging_truncate_queries)
+    journal.run_step(cur, conn, 'next_tables', blue_green.create_next_tables, cur, conn)
+
+    song_objects = list_song_objects(lister)
+    loaded_keys = {'log_data': lister.list_keys(LOG_DATA),
+                   'song_data': [key for key, _ in song_objects]}
+    if args.local_data:
+        load_local_files(cur, conn, args.local_data, loaded_keys, loaded_keys, journal)
+    else:
+        load_staging_tables(pool, args.staging_concurrency, song_objects, slices, journal)
+    quarantine_copy_errors(cur, conn, journal)
+    journal.run_step(cur, conn, 'time', time_dimension.load_time_dimension, cur, conn,
+                     NEXT_SUFFIX)
+    insert_tables(pool, args.transform_concurrency, journal, NEXT_SUFFIX)
+    dimensions.report_dimension_changes(cur, conn)
+
+    journal.run_step(cur, conn, 'validate', blue_green.validate_next_tables, cur, conn,
+                     args.min_row_ratio)
+    # the control rows of the new generation are recorded in the swap's transaction
+    journal.run_step(cur, conn, 'swap', blue_green.swap_in_next_tables, cur, conn,
+                     lambda cur: write_control_rows(cur, loaded_keys, 0, full_load=True))
+    print_pending_count(cur)
+    conn.commit()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """ Command line options """
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0].strip())
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='copy all S3 data and run every insert (expects freshly '
+                             'created tables, see create_tables.py)')
+    parser.add_argument('--staging-concurrency', type=int, default=2,
+                        help='how many staging COPYs may run at the same time (default 2)')
+    parser.add_argument('--transform-concurrency', type=int, default=4,
+                        help='how many independent inserts may run at the same time (default 4)')
+    parser.add_argument('--analysis-concurrency', type=int,
+                        default=analysis.DEFAULT_CONCURRENCY,
+                        help='how many sample queries may run at the same time after the load '
+                             f'(default {analysis.DEFAULT_CONCURRENCY})')
+    parser.add_argument('--local-data', metavar='DIR',
+                        help='list and load the data files from a local directory laid out '
+                             'like the udacity-dend bucket, with COPY FROM STDIN, instead of '
+                             'from S3 (for a PostgreSQL or DuckDB database, see dialect in '
+                             'dwh.cfg)')
+    parser.add_argument('--no-analysis', action='store_true',
+                        help='do not run the sample queries after the load')
+    parser.add_argument('--match-report', action='store_true',
+                        help='after the inserts, compare the match rate and join time of the '
+                             'exact title / artist join and the match key join')
+    parser.add_argument('--shadow', action='store_true',
+                        help='full refresh into new *_next tables, check their row counts and '
+                             'swap them in, in one transaction, while the current tables stay '
+                             'readable (see blue_green.py)')
+    parser.add_argument('--min-row-ratio', type=float, default=blue_green.MIN_ROW_RATIO,
+                        help='with --shadow, the share of its current rows every new table must '
+                             f'have to be swapped in (default {blue_green.MIN_ROW_RATIO})')
+    parser.add_argument('--rollback', action='store_true',
+                        help='swap the tables replaced by the last --shadow run back in, '
+                             'and exit')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the last run if it failed, skipping the steps it '
+                             'completed (run with the same options as the failed run)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
     """ This method controls the ETL processes """
 
+    args = parse_args(argv)
+
     conn = utilities.get_db_connection()
     cur = conn.cursor()
 
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    if args.rollback:
+        blue_green.roll_back(cur, conn)
+        conn.close()
+        return
+
+    pool = utilities.get_db_connection_pool(
+        max(args.staging_concurrency, args.transform_concurrency, args.analysis_concurrency))
+
+    if args.local_data:
+        lister = LocalLister(args.local_data)
+    else:
+        lister = S3Lister(region_name=S3_REGION)
+    if utilities.get_db_dialect() == 'redshift':
+        slices = manifests.get_slice_count(cur, conn)
+    else:
+        slices = manifests.DEFAULT_SLICES
+
+    if args.shadow:
+        mode, load = 'shadow', load_shadow_tables
+    elif args.full_refresh:
+        mode, load = 'full refresh', full_load
+    else:
+        mode, load = 'incremental', incremental_load
+
+    journal = run_journal.start_run(cur, conn, mode, args.resume)
+    try:
+        load(cur, conn, pool, args, lister, slices, journal)
+    except Exception:
+        journal.fail(conn)
+        metrics.finish(conn, 'etl', journal.run_id)
+        raise
+    journal.finish(cur, conn)
+    load_errors.report_load_errors(cur, conn, journal.run_id)
+
+    if args.match_report:
+        match_keys.report_match_rate(cur, conn)
 
-    print('\n\nETL completed. Starting analysis queries.\n\n')
-    analysis.run_analysis_queries(cur)
+    if args.no_analysis:
+        print('\n\nETL completed.\n\n')
+    else:
+        print('\n\nETL completed. Starting analysis queries.\n\n')
+        analysis.run_analysis_queries_concurrently(pool, args.analysis_concurrency)
 
     conn.commit()
+    metrics.finish(conn, 'etl', journal.run_id)
     conn.close()
+    pool.print_stats()
+    pool.closeall()
 
 
 if __name__ == "__main__":
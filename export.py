@@ -0,0 +1,169 @@
+""" Streaming export of the full sample query results
+
+Each result is read from a server side cursor, chunk_rows rows at a time, and every
+chunk is written out before the next one is fetched, so memory use depends on the
+chunk size, not on the size of the result.  Results are written as CSV, JSON Lines
+or Parquet (Parquet needs pyarrow, which is only imported for it) """
+
+import csv
+import json
+import os
+import re
+import resource
+import sys
+import time
+import psycopg2
+from prettytable import PrettyTable
+import utilities
+import dialects
+import metrics
+
+CHUNK_ROWS = 10000
+
+FORMATS = ['csv', 'jsonl', 'parquet']
+
+
+def get_peak_rss_mb() -> float:
+    """ Peak resident set size of this process so far, in MB """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+def get_file_name(title: str, export_format: str) -> str:
+    """ File name for the result of a sample query, from its title """
+
+    return re.sub(r'[^a-z0-9]+', '_', title.lower()).strip('_') + '.' + export_format
+
+
+def fetch_chunks(cur: psycopg2.extensions.cursor, chunk_rows: int = CHUNK_ROWS):
+    """ Yield the rows of the executed query in lists of up to chunk_rows rows """
+
+    while True:
+        rows = cur.fetchmany(chunk_rows)
+        if not rows:
+            break
+        yield rows
+
+
+def write_csv(path: str, headers_list: list, chunks) -> int:
+    """ Write the chunks as CSV with a header line, returns the number of rows """
+
+    row_count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(headers_list)
+        for rows in chunks:
+            writer.writerows(rows)
+            row_count += len(rows)
+
+    return row_count
+
+
+def write_jsonl(path: str, headers_list: list, chunks) -> int:
+    """ Write the chunks as JSON Lines, one object per row, returns the number of rows """
+
+    row_count = 0
+    with open(path, 'w', encoding='utf-8') as jsonl_file:
+        for rows in chunks:
+            for row in rows:
+                # default=str covers decimals, dates and timestamps
+                jsonl_file.write(json.dumps(dict(zip(headers_list, row)), default=str) + '\n')
+            row_count += len(rows)
+
+    return row_count
+
+
+def write_parquet(path: str, headers_list: list, chunks) -> int:
+    """ Write the chunks as Parquet, one row group per chunk, returns the number of rows.
+    The schema is taken from the first chunk """
+
+    # optional dependency, only needed for Parquet exports
+    import pyarrow
+    import pyarrow.parquet
+
+    row_count = 0
+    writer = None
+    try:
+        for rows in chunks:
+            columns = [list(column) for column in zip(*rows)]
+            table = pyarrow.table(dict(zip(headers_list, columns)))
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+            row_count += len(rows)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        # empty result, the file still gets the columns
+        pyarrow.parquet.write_table(
+            pyarrow.table({header: pyarrow.array([], pyarrow.string())
+                           for header in headers_list}), path)
+
+    return row_count
+
+
+WRITERS = {'csv': write_csv,
+           'jsonl': write_jsonl,
+           'parquet': write_parquet}
+
+
+def export_query(conn: psycopg2.extensions.connection, name: str, query: str, path: str,
+                 export_format: str, chunk_rows: int = CHUNK_ROWS) -> int:
+    """ Stream the full result of a query into a file, returns the number of rows """
+
+    with conn.cursor(name) as cur:
+        cur.execute(dialects.translate(query, utilities.get_db_dialect()))
+        chunks = fetch_chunks(cur, chunk_rows)
+
+        # named cursors only describe the result once the first rows are fetched
+        first_chunk = next(chunks, [])
+        headers_list = [desc[0] for desc in cur.description]
+
+        def all_chunks():
+            if first_chunk:
+                yield first_chunk
+            yield from chunks
+
+        row_count = WRITERS[export_format](path, headers_list, all_chunks())
+    conn.commit()
+
+    return row_count
+
+
+def export_queries(conn: psycopg2.extensions.connection, queries: list, titles: list,
+                   export_dir: str, export_format: str, chunk_rows: int = CHUNK_ROWS):
+    """ Export every query into export_dir, one file per query, each timed in a span
+    (see metrics.py), and print the rows, rows/s and peak resident memory after each
+    export """
+
+    os.makedirs(export_dir, exist_ok=True)
+
+    report = PrettyTable()
+    report.field_names = ['Query', 'File', 'Rows', 'Rows/s', 'Peak RSS (MB)']
+    report.align['Query'] = 'l'
+    report.align['File'] = 'l'
+
+    start_time = time.time()
+    for index, (query, title) in enumerate(zip(queries, titles)):
+        path = os.path.join(export_dir, get_file_name(title, export_format))
+
+        query_start_time = time.time()
+        with metrics.span(f"export: {title}", conn) as span:
+            row_count = export_query(conn, f"export_{index}", query, path, export_format,
+                                     chunk_rows)
+            span.rows = row_count
+        duration = time.time() - query_start_time
+
+        rows_per_second = row_count / duration if duration else float(row_count)
+        report.add_row([title, os.path.basename(path), row_count, f"{rows_per_second:,.0f}",
+                        f"{get_peak_rss_mb():.1f}"])
+
+    print(report)
+    print(f"Exported {len(queries)} results to {export_dir} in " +
+          f"{utilities.get_duration_string(start_time)}, in chunks of {chunk_rows} rows.")
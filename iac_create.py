@@ -22,58 +22,143 @@ WHAT THIS PROGRAM DOES (USING THE BOTO3 LIBRARY)
         which is a group of compute resources.  
         (note a namespace can have multiple workgroups 
         and they can be used selectively as needed,
-        but we only need one for this program) """
+        but we only need one for this program)
+
+    5)  opens port 5439 of the workgroup's security group to this computer's IP address
+
+    Resources that do not depend on each other are set up at the same time: the role
+    and the IP address lookup, then the ingress rule while the namespace and workgroup
+    are being created (as soon as the workgroup is listed with its security group).  The
+    waiters poll with a backoff that starts short and grows, and give up at an overall
+    deadline.  A timeline of every resource is printed.
+    provision() takes the boto3 clients, so it can be run against stubbed (or moto)
+    clients """
 
 import configparser
 import json
+import threading
 import time
-import boto3
-from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from prettytable import PrettyTable
 import ingress_rule
-import utilities
-
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
-DB_NAME = config.get("CLUSTER", "DB_NAME")
-DB_USER = config.get("CLUSTER", "DB_USER")
-DB_PASSWORD = config.get("CLUSTER", "DB_PASSWORD")
-
-config_iac = configparser.ConfigParser()
-config_iac.read('dwh_iac.cfg')
-KEY = config_iac.get('AWS', 'KEY')
-SECRET = config_iac.get('AWS', 'SECRET')
-DWH_REGION = config_iac.get("DWH", "DWH_REGION")
-DWH_IAM_ROLE_NAME = config_iac.get("DWH", "DWH_IAM_ROLE_NAME")
-DWH_NAMESPACE_NAME = config_iac.get("DWH", "DWH_NAMESPACE_NAME")
-DWH_WORKGROUP_NAME = config_iac.get("DWH", "DWH_WORKGROUP_NAME")
-
-
-def setup_namespace(redshift_serverless: boto3.session.Session.resource,
-                    role_arn: str) -> None:
+
+# seconds everything has to be ready in, unless DWH_PROVISIONING_DEADLINE is set
+DWH_PROVISIONING_DEADLINE = 1800
+
+
+def get_config() -> configparser.ConfigParser:
+    """ dwh.cfg, read when it is needed (update_config_file writes it back) """
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    return config
+
+
+def get_iac_setting(option: str) -> str:
+    """ A setting of the DWH section of dwh_iac.cfg """
+
+    return ingress_rule.get_iac_config().get("DWH", option)
+
+
+# polling of the waiters: the first delay is INITIAL_POLL_DELAY seconds, each next one
+# POLL_BACKOFF times longer, up to MAX_POLL_DELAY.  A status change starts over
+INITIAL_POLL_DELAY = 2
+POLL_BACKOFF = 1.5
+MAX_POLL_DELAY = 30
+
+
+class ProvisioningError(Exception):
+    """ A resource failed, or was not ready before the deadline """
+
+
+class Timeline:
+    """ When each resource of the plan started, changed status and was done, in seconds
+    since the plan started.  Events are printed as they happen, a table at the end """
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()
+        # resource -> [started, finished, outcome]
+        self.resources = {}
+
+    def get_elapsed(self) -> float:
+        """ Seconds since the plan started """
+
+        return time.monotonic() - self.start_time
+
+    def log(self, resource: str, message: str):
+        """ Print an event of a resource """
+
+        print(f"[{self.get_elapsed():7.1f}s] {resource}: {message}")
+
+    def run(self, resource: str, function, *args):
+        """ Run function(*args) as the setup of a resource, returns its result """
+
+        with self.lock:
+            self.resources[resource] = [self.get_elapsed(), None, 'running']
+        self.log(resource, 'started')
+
+        try:
+            result = function(*args)
+        except Exception as error:
+            self.end(resource, f"failed: {error}")
+            raise
+
+        self.end(resource, 'done')
+        return result
+
+    def end(self, resource: str, outcome: str):
+        """ Record that a resource is done (or failed) """
+
+        with self.lock:
+            self.resources[resource][1:] = [self.get_elapsed(), outcome]
+        self.log(resource, outcome)
+
+    def print_summary(self):
+        """ Print when each resource started and ended and how long it took """
+
+        report = PrettyTable()
+        report.field_names = ['Resource', 'Started (s)', 'Ended (s)', 'Took (s)', 'Outcome']
+        report.align['Resource'] = 'l'
+        report.align['Outcome'] = 'l'
+        with self.lock:
+            resources = sorted(self.resources.items(), key=lambda item: item[1][0])
+        for resource, (started, finished, outcome) in resources:
+            report.add_row([resource, f"{started:.1f}",
+                            '' if finished is None else f"{finished:.1f}",
+                            '' if finished is None else f"{finished - started:.1f}",
+                            outcome[:60]])
+        print(report)
+        print(f"Provisioning took {self.get_elapsed():.1f} seconds.")
+
+
+def setup_namespace(redshift_serverless, role_arn: str) -> None:
     """ Create Namespace (if it does not exist) for/as-part-of the new Redshift """
+    namespace_name = get_iac_setting("DWH_NAMESPACE_NAME")
     namespace_exists = False
     response = redshift_serverless.list_namespaces()
     for namespace in response['namespaces']:
-        if DWH_NAMESPACE_NAME == namespace['namespaceName']:
+        if namespace_name == namespace['namespaceName']:
             namespace_exists = True
             break
 
     if namespace_exists is True:
-        print(f"A namespace {DWH_NAMESPACE_NAME} already exists")
+        print(f"A namespace {namespace_name} already exists")
     else:
+        config = get_config()
         # https://boto3.amazonaws.com/v1/documentation/api/1.26.2/reference/services/redshift-serverless.html#RedshiftServerless.Client.create_namespace
         response = redshift_serverless.create_namespace(
-            adminUserPassword=DB_PASSWORD,
-            adminUsername=DB_USER,
-            dbName=DB_NAME,
-            namespaceName=DWH_NAMESPACE_NAME,
+            adminUserPassword=config.get("CLUSTER", "DB_PASSWORD"),
+            adminUsername=config.get("CLUSTER", "DB_USER"),
+            dbName=config.get("CLUSTER", "DB_NAME"),
+            namespaceName=namespace_name,
             # Optionally specify other parameters like KMS key, admin username/password, etc.
             # 'arn:aws:iam::123456789012:role/YourRedshiftRole']
             iamRoles=[role_arn]
         )
 
         # print(response)
-        print('Initiated creation of namespace', DWH_NAMESPACE_NAME,
+        print('Initiated creation of namespace', namespace_name,
               'with default database settings from config file.')
 
     # response = redshift_serverless.list_namespaces()
@@ -81,24 +166,26 @@ def setup_namespace(redshift_serverless: boto3.session.Session.resource,
     #    print(f"Namespace: {namespace['namespaceName']}")
 
 
-def setup_workgroup(redshift_serverless: boto3.session.Session.resource) -> None:
+def setup_workgroup(redshift_serverless) -> None:
     """ Create workgroup (if it does not exist) for/as-part-of the new Redshift """
 
+    workgroup_name = ingress_rule.get_workgroup_name()
+    namespace_name = get_iac_setting("DWH_NAMESPACE_NAME")
     workgroup_exists = False
     response = redshift_serverless.list_workgroups()
     for wg in response['workgroups']:
-        if wg['workgroupName'] == DWH_WORKGROUP_NAME:
+        if wg['workgroupName'] == workgroup_name:
             workgroup_exists = True
 
     if workgroup_exists is True:
         print(
-            f"A workgroup {DWH_WORKGROUP_NAME} for namespace {DWH_NAMESPACE_NAME} already exists")
+            f"A workgroup {workgroup_name} for namespace {namespace_name} already exists")
     else:
         # Create a workgroup
         response = redshift_serverless.create_workgroup(
-            workgroupName=DWH_WORKGROUP_NAME,
+            workgroupName=workgroup_name,
             baseCapacity=8,  # Specify base capacity units, cannot be less than 8 RPUs
-            namespaceName=DWH_NAMESPACE_NAME,  # Specify the namespace
+            namespaceName=namespace_name,  # Specify the namespace
             # Specify VPC routing preferences, ie just route over internet
             enhancedVpcRouting=False,
             publiclyAccessible=True,  # Specify access preferences
@@ -106,8 +193,8 @@ def setup_workgroup(redshift_serverless: boto3.session.Session.resource) -> None
         )
 
         # print(response)
-        print('Initiated creation of workgroup', DWH_WORKGROUP_NAME,
-              'for namespace', DWH_NAMESPACE_NAME)
+        print('Initiated creation of workgroup', workgroup_name,
+              'for namespace', namespace_name)
 
 
 def get_role_arn(iam_client, role_name):
@@ -116,22 +203,35 @@ def get_role_arn(iam_client, role_name):
     return role_arn
 
 
-def setup_role_for_redshit_to_access_s3():
+def get_client(service: str):
+    """ boto3 client of a service, with the key, secret and region of dwh_iac.cfg """
+
+    import boto3
+
+    config = ingress_rule.get_iac_config()
+    return boto3.client(service,
+                        region_name=config.get("DWH", "DWH_REGION"),
+                        aws_access_key_id=config.get('AWS', 'KEY'),
+                        aws_secret_access_key=config.get('AWS', 'SECRET')
+                        )
+
+
+def setup_role_for_redshit_to_access_s3(iam_client=None):
     """ get_role_that_redshit_will_use_to_access_s3_data(iam_client, DWH_IAM_ROLE_NAME) """
 
-    iam_client = boto3.client('iam',
-                              region_name=DWH_REGION,
-                              aws_access_key_id=KEY,
-                              aws_secret_access_key=SECRET
-                              )
+    from botocore.exceptions import ClientError
+
+    if iam_client is None:
+        iam_client = get_client('iam')
+    role_name = get_iac_setting("DWH_IAM_ROLE_NAME")
 
     try:
-        print("Creating an IAM Role", DWH_IAM_ROLE_NAME,
+        print("Creating an IAM Role", role_name,
               "that allows Redshift to make AWS calls.")
 
         iam_client.create_role(
             Path='/',
-            RoleName=DWH_IAM_ROLE_NAME,
+            RoleName=role_name,
             Description="Allows Redshift clusters to call AWS services on your behalf.",
             AssumeRolePolicyDocument=json.dumps(
                 {'Statement': [{'Action': 'sts:AssumeRole',
@@ -140,85 +240,112 @@ def setup_role_for_redshit_to_access_s3():
                  'Version': '2012-10-17'})
         )
 
-        print("Adding an S3 Read Policy to the IAM Role", DWH_IAM_ROLE_NAME)
+        print("Adding an S3 Read Policy to the IAM Role", role_name)
 
         status = iam_client.attach_role_policy(
-            RoleName=DWH_IAM_ROLE_NAME,
+            RoleName=role_name,
             PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
         )['ResponseMetadata']['HTTPStatusCode']
 
     except ClientError as error:
         if error.response['Error']['Code'] == 'EntityAlreadyExists':
-            print(f"The role {DWH_IAM_ROLE_NAME} already exists.")
+            print(f"The role {role_name} already exists.")
         else:
             raise
 
-    return get_role_arn(iam_client, DWH_IAM_ROLE_NAME)
+    return get_role_arn(iam_client, role_name)
 
 
-def wait_until_workgroup_ready(redshift_serverless_client):
-    """ Monitors the status of the new workgroup, 
-    in a loop, until it is ready for use"""
+def wait_until_available(resource: str, get_status, timeline: Timeline, deadline: float,
+                         stop: threading.Event = None):
+    """ Poll get_status() until it returns AVAILABLE, waiting longer after each poll
+    (see POLL_BACKOFF).  Status changes are added to the timeline.  Raises
+    ProvisioningError if the status is FAILED, at the deadline (a time.monotonic() time)
+    or when stop is set (e.g. because another resource failed) """
 
-    while True:
-        start_time = time.time()
+    stop = stop or threading.Event()
+    delay = INITIAL_POLL_DELAY
+    last_status = None
 
-        response = redshift_serverless_client.get_workgroup(
-            workgroupName=DWH_WORKGROUP_NAME)
-        status = response['workgroup']['status']
+    while True:
+        status = get_status()
+        if status != last_status:
+            timeline.log(resource, status)
+            # a resource that is moving along is polled closely again
+            delay = INITIAL_POLL_DELAY
+            last_status = status
 
         if status == 'AVAILABLE':
+            return
+        if status == 'FAILED':
+            raise ProvisioningError(f"{resource} creation failed.")
 
-            duration_string = utilities.get_duration_string(start_time)
-            print(
-                f"Workgroup {DWH_WORKGROUP_NAME} created. " +
-                f"It took {duration_string}. It is now ready for use.")
-            break
-        elif status == 'FAILED':
-            print(f"Workgroup {DWH_WORKGROUP_NAME} creation failed.")
-            break
-        else:
-            duration_string = utilities.get_duration_string(start_time)
-            print(
-                f"Workgroup {DWH_WORKGROUP_NAME} creation in-progress. " +
-                f"It has been running for {duration_string}.")
-            time.sleep(10)  # Wait for 10 seconds before checking again
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise ProvisioningError(f"{resource} was still {status} at the deadline.")
+        if stop.wait(min(delay, remaining)):
+            raise ProvisioningError(f"Stopped waiting for {resource}.")
+        delay = min(delay * POLL_BACKOFF, MAX_POLL_DELAY)
 
 
-def wait_until_namespace_ready(redshift_serverless_client):
-    """ Monitors the status of the new namespace, 
-    in a loop, until it is ready for use"""
+def wait_until_workgroup_ready(redshift_serverless_client, timeline: Timeline, deadline: float,
+                               stop: threading.Event = None):
+    """ Monitors the status of the new workgroup until it is ready for use """
 
-    start_time = time.time()
+    workgroup_name = ingress_rule.get_workgroup_name()
+    wait_until_available(
+        f"workgroup {workgroup_name}",
+        lambda: redshift_serverless_client.get_workgroup(
+            workgroupName=workgroup_name)['workgroup']['status'],
+        timeline, deadline, stop)
 
-    while True:
 
-        response = redshift_serverless_client.get_namespace(
-            namespaceName=DWH_NAMESPACE_NAME)
-        status = response['namespace']['status']
+def wait_until_namespace_ready(redshift_serverless_client, timeline: Timeline, deadline: float,
+                               stop: threading.Event = None):
+    """ Monitors the status of the new namespace until it is ready for use """
 
-        if status == 'AVAILABLE':
+    namespace_name = get_iac_setting("DWH_NAMESPACE_NAME")
+    wait_until_available(
+        f"namespace {namespace_name}",
+        lambda: redshift_serverless_client.get_namespace(
+            namespaceName=namespace_name)['namespace']['status'],
+        timeline, deadline, stop)
 
-            duration_string = utilities.get_duration_string(start_time)
-            print(
-                f"Namespace {DWH_NAMESPACE_NAME} created. " +
-                f"It took {duration_string}. It is now ready for use.")
-            break
-        elif status == 'FAILED':
-            print(f"Namespace {DWH_NAMESPACE_NAME} creation failed.")
-            break
-        else:
-            duration_string = utilities.get_duration_string(start_time)
-            print(
-                f"Namespace {DWH_NAMESPACE_NAME} creation in-progress. " +
-                f"It has been running for {duration_string}.")
-            time.sleep(10)  # Wait for 10 seconds before checking again
+
+def wait_for_security_group(redshift_serverless_client, timeline: Timeline, deadline: float,
+                            stop: threading.Event = None) -> str:
+    """ Polls until the new workgroup is listed with its security group, returns its ID """
+
+    security_group_id = None
+
+    def get_status():
+        nonlocal security_group_id
+        try:
+            security_group_id = ingress_rule.get_security_group_id(redshift_serverless_client)
+        except ingress_rule.SecurityGroupError:
+            return 'PENDING'
+        return 'AVAILABLE'
+
+    wait_until_available(f"workgroup {ingress_rule.get_workgroup_name()} security group",
+                         get_status,
+                         timeline, deadline, stop)
+    return security_group_id
+
+
+def add_ingress_rule(redshift_serverless_client, ec2_client, cidr_ip: str, timeline: Timeline,
+                     deadline: float, stop: threading.Event = None):
+    """ Opens the port to cidr_ip once the workgroup has its security group """
+
+    security_group_id = wait_for_security_group(redshift_serverless_client, timeline,
+                                                deadline, stop)
+    ingress_rule.setup_ingress_rule(redshift_serverless_client, ec2_client, cidr_ip,
+                                    security_group_id)
 
 
 def get_host(redshift_serverless_client):
     """ Gets the string of the host / endpoint that is used for ingress requests """
     workgroup = redshift_serverless_client.get_workgroup(
-        workgroupName=DWH_WORKGROUP_NAME)
+        workgroupName=ingress_rule.get_workgroup_name())
     endpoint = workgroup['workgroup']['endpoint']
     return endpoint['address']
 
@@ -235,34 +362,77 @@ def update_config_file(role_arn, host):
     # the sql client code (create_tables.py and etl.py) is used.  So that code may not include
     # boto3 code or use the key & secret required to create a boto3 cleint. """
 
+    config = get_config()
     config['IAM_ROLE']['ARN'] = role_arn
     config['CLUSTER']['HOST'] = host
     with open('dwh.cfg', 'w') as configfile:
         config.write(configfile)
 
 
-def main():
-    """ This method controls the IAC creation processes """
+def provision(iam_client, redshift_serverless_client, ec2_client,
+              deadline_seconds: float = None,
+              get_cidr_ip=ingress_rule.get_cidr_ip) -> tuple:
+    """ Set up the role, namespace, workgroup and ingress rule, independent ones at the
+    same time, and wait until the namespace and workgroup are available, by
+    deadline_seconds (DWH_PROVISIONING_DEADLINE in dwh_iac.cfg by default).
+    Returns the role ARN and the workgroup's host """
+
+    if deadline_seconds is None:
+        deadline_seconds = ingress_rule.get_iac_config().getint(
+            "DWH", "DWH_PROVISIONING_DEADLINE", fallback=DWH_PROVISIONING_DEADLINE)
+    role_name = get_iac_setting("DWH_IAM_ROLE_NAME")
+    namespace_name = get_iac_setting("DWH_NAMESPACE_NAME")
+    workgroup_name = ingress_rule.get_workgroup_name()
+    timeline = Timeline()
+    deadline = time.monotonic() + deadline_seconds
+    stop = threading.Event()
 
-    role_arn = setup_role_for_redshit_to_access_s3()
-
-    redshift_serverless_client = boto3.client('redshift-serverless',
-                                              region_name=DWH_REGION,
-                                              aws_access_key_id=KEY,
-                                              aws_secret_access_key=SECRET
-                                              )
-
-    setup_namespace(redshift_serverless_client, role_arn)
-
-    setup_workgroup(redshift_serverless_client)
-
-    ingress_rule.setup_ingress_rule()
+    try:
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            try:
+                # the IP address lookup does not depend on any AWS resource
+                cidr_ip = executor.submit(timeline.run, 'client IP address', get_cidr_ip)
+
+                # the namespace needs the role, the workgroup needs the namespace
+                role_arn = timeline.run(f"role {role_name}",
+                                        setup_role_for_redshit_to_access_s3, iam_client)
+                timeline.run(f"create namespace {namespace_name}", setup_namespace,
+                             redshift_serverless_client, role_arn)
+                timeline.run(f"create workgroup {workgroup_name}", setup_workgroup,
+                             redshift_serverless_client)
+
+                # the ingress rule is added while the namespace and the workgroup are
+                # being created, as soon as the workgroup is listed with its security group
+                futures = [
+                    executor.submit(timeline.run, 'namespace available',
+                                    wait_until_namespace_ready, redshift_serverless_client,
+                                    timeline, deadline, stop),
+                    executor.submit(timeline.run, 'workgroup available',
+                                    wait_until_workgroup_ready, redshift_serverless_client,
+                                    timeline, deadline, stop)]
+                futures.append(executor.submit(timeline.run, 'ingress rule', add_ingress_rule,
+                                               redshift_serverless_client, ec2_client,
+                                               cidr_ip.result(), timeline, deadline, stop))
+
+                done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    future.result()
+            finally:
+                # on a failure the waiters give up instead of polling until the deadline
+                stop.set()
+
+        host = timeline.run('workgroup endpoint', get_host, redshift_serverless_client)
+    finally:
+        timeline.print_summary()
+
+    return role_arn, host
 
-    wait_until_namespace_ready(redshift_serverless_client)
 
-    wait_until_workgroup_ready(redshift_serverless_client)
+def main():
+    """ This method controls the IAC creation processes """
 
-    host = get_host(redshift_serverless_client)
+    role_arn, host = provision(get_client('iam'), get_client('redshift-serverless'),
+                               get_client('ec2'))
 
     update_config_file(role_arn, host)
 
@@ -1,30 +1,23 @@
 """ Used to delete the AWS Serverless Redshift """
-import configparser
 import time
-import boto3
-from botocore.exceptions import ClientError
 import utilities
-
-config = configparser.ConfigParser()
-config.read_file('dwh_iac.cfg')
-KEY = config.get('AWS', 'KEY')
-SECRET = config.get('AWS', 'SECRET')
-DWH_REGION = config.get("DWH", "DWH_REGION")
-DWH_NAMESPACE_NAME = config.get("DWH", "DWH_NAMESPACE_NAME")
-DWH_WORKGROUP_NAME = config.get("DWH", "DWH_WORKGROUP_NAME")
+import ingress_rule
 
 
 def delete_workgroup(redshift_serverless_client):
     """ Deletes the workgroup of the  AWS Serverless Redshift """
 
+    from botocore.exceptions import ClientError
+
+    workgroup_name = ingress_rule.get_workgroup_name()
     start_time = None
     while True:
 
         try:
             response = redshift_serverless_client.delete_workgroup(
-                workgroupName=DWH_WORKGROUP_NAME)
+                workgroupName=workgroup_name)
             print(
-                f"Workgroup {DWH_WORKGROUP_NAME} deletion initiated successfully.")
+                f"Workgroup {workgroup_name} deletion initiated successfully.")
             start_time = time.time()
 
         except ClientError as error:
@@ -33,16 +26,16 @@ def delete_workgroup(redshift_serverless_client):
             if code == 'ConflictException' and start_time is not None:
                 duration_string = utilities.get_duration_string(start_time)
                 print(
-                    f"Workgroup {DWH_WORKGROUP_NAME} deletion in-progress. " +
+                    f"Workgroup {workgroup_name} deletion in-progress. " +
                     f"It has been running for {duration_string}.")
             elif code == 'ResourceNotFoundException' and start_time is not None:
                 duration_string = utilities.get_duration_string(start_time)
                 print(
-                    f"Workgroup {DWH_WORKGROUP_NAME} deletion completed successfully. " +
+                    f"Workgroup {workgroup_name} deletion completed successfully. " +
                     f"It took {duration_string}. Now the namespace deletion can be initiated.")
                 break
             else:
-                error_msg_prefix = f"Error deleting workgroup {DWH_WORKGROUP_NAME}: {code} :"
+                error_msg_prefix = f"Error deleting workgroup {workgroup_name}: {code} :"
 
                 if code == 'ConflictException':
                     print(error_msg_prefix,
@@ -63,14 +56,17 @@ def delete_workgroup(redshift_serverless_client):
 def delete_namespace(redshift_serverless_client):
     """ Deletes the namespace of the  AWS Serverless Redshift """
 
+    from botocore.exceptions import ClientError
+
+    namespace_name = ingress_rule.get_iac_config().get("DWH", "DWH_NAMESPACE_NAME")
     start_time = None
     while True:
 
         try:
             response = redshift_serverless_client.delete_namespace(
-                namespaceName=DWH_NAMESPACE_NAME)
+                namespaceName=namespace_name)
             print(
-                f"Namespace {DWH_NAMESPACE_NAME} deletion initiated successfully.")
+                f"Namespace {namespace_name} deletion initiated successfully.")
             start_time = time.time()
 
         except ClientError as error:
@@ -79,17 +75,17 @@ def delete_namespace(redshift_serverless_client):
             if code == 'ConflictException' and start_time is not None:
                 duration_string = utilities.get_duration_string(start_time)
                 print(
-                    f"Namespace {DWH_NAMESPACE_NAME} deletion in-progress. " +
+                    f"Namespace {namespace_name} deletion in-progress. " +
                     f"It has been running for {duration_string}.")
             elif code == 'ResourceNotFoundException' and start_time is not None:
                 duration_string = utilities.get_duration_string(start_time)
                 print(
-                    f"Namespace {DWH_NAMESPACE_NAME} deletion completed successfully. " +
+                    f"Namespace {namespace_name} deletion completed successfully. " +
                     f"It took {duration_string}.")
                 break
             else:
 
-                error_msg_prefix = f"Error deleting namespace {DWH_NAMESPACE_NAME}: {code} :"
+                error_msg_prefix = f"Error deleting namespace {namespace_name}: {code} :"
 
                 if code == 'ConflictException':
                     print(error_msg_prefix,
@@ -110,10 +106,13 @@ def delete_namespace(redshift_serverless_client):
 def main():
     """ This method controls the IAC deletion/cleanup processes """
 
+    import boto3
+
+    config = ingress_rule.get_iac_config()
     redshift_serverless_client = boto3.client('redshift-serverless',
-                                              region_name=DWH_REGION,
-                                              aws_access_key_id=KEY,
-                                              aws_secret_access_key=SECRET
+                                              region_name=config.get("DWH", "DWH_REGION"),
+                                              aws_access_key_id=config.get('AWS', 'KEY'),
+                                              aws_secret_access_key=config.get('AWS', 'SECRET')
                                               )
 
     delete_workgroup(redshift_serverless_client)
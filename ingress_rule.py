@@ -2,39 +2,58 @@
 to port 5439 for db access to the Redshift database"""
 
 import configparser
-import requests
-import boto3
+import functools
 
-config = configparser.ConfigParser()
-config.read('dwh_iac.cfg')
 
-KEY = config.get('AWS', 'KEY')
-SECRET = config.get('AWS', 'SECRET')
-DWH_REGION = config.get("DWH", "DWH_REGION")
-DWH_WORKGROUP_NAME = config.get("DWH", "DWH_WORKGROUP_NAME")
+@functools.lru_cache(maxsize=None)
+def get_iac_config() -> configparser.ConfigParser:
+    """ dwh_iac.cfg, read once, when a setting is first needed """
 
+    config = configparser.ConfigParser()
+    config.read('dwh_iac.cfg')
+    return config
 
-def _get_cidr_ip():
+
+def get_workgroup_name() -> str:
+    """ Name of the Redshift Serverless workgroup (DWH section of dwh_iac.cfg) """
+
+    return get_iac_config().get("DWH", "DWH_WORKGROUP_NAME")
+
+
+def get_cidr_ip():
     """ Gets the CIDR IP for the ingress rule, which is just the 
     user's IP followed by a networking subnet mask (e.g. '/32') added """
 
+    import requests
+
     response = requests.get('https://httpbin.org/ip', timeout=10)
     ip_address = response.json()['origin']
     cidr_ip = ip_address + '/32'
     return cidr_ip
 
 
-def _get_security_group_id(redshift_serverless_client):
-    """ """
+class SecurityGroupError(Exception):
+    """ The workgroup is not listed, or has no security group (yet) """
+
+
+def get_security_group_id(redshift_serverless_client):
+    """ ID of the workgroup's (first) security group, which the ingress rule is added to.
+    Raises SecurityGroupError if the workgroup is not listed or has no security group,
+    as happens right after it was created """
+
+    workgroup_name = get_workgroup_name()
     response = redshift_serverless_client.list_workgroups()
     for wg in response['workgroups']:
-        if wg['workgroupName'] == DWH_WORKGROUP_NAME:
-            security_group_id = wg['securityGroupIds'][0]
-            break
-    return security_group_id
+        if wg['workgroupName'] == workgroup_name:
+            if not wg.get('securityGroupIds'):
+                raise SecurityGroupError(
+                    f"The workgroup {workgroup_name} has no security group.")
+            return wg['securityGroupIds'][0]
+
+    raise SecurityGroupError(f"There is no workgroup {workgroup_name}.")
 
 
-def _ingress_rule_exists(ec2_client, security_group_id):
+def _ingress_rule_exists(ec2_client, security_group_id, cidr_ip):
     """ Check if rule already exists """
     response = ec2_client.describe_security_groups(
         GroupIds=[security_group_id])
@@ -42,12 +61,13 @@ def _ingress_rule_exists(ec2_client, security_group_id):
     for security_group in response.get('SecurityGroups', []):
         rules = security_group.get('IpPermissions', [])
         for rule in rules:
-            if ((rule['ToPort'] == rule['FromPort'] == 5439)
+            cidr_ips = [ip_range['CidrIp'] for ip_range in rule.get('IpRanges', [])]
+            if ((rule.get('ToPort') == rule.get('FromPort') == 5439)
                 and rule['IpProtocol'] == 'tcp'
-                    and rule['IpRanges'][0]['CidrIp'] == '23.93.180.103/32'):
+                    and cidr_ip in cidr_ips):
 
                 rule_exists = True
-                print('Rule exists', rule['IpRanges'][0]['CidrIp'], rule)
+                print('Rule exists', cidr_ip, rule)
                 break
 
     return rule_exists
@@ -70,23 +90,27 @@ def _create_ingress_rule(ec2_client, security_group_id, cidr_ip):
     print('Creating ingress rule... Responce to rule creation', response)
 
 
-def setup_ingress_rule():
-    """ This method controls the process of creating the ingress rule """
-
-    rs_client = boto3.client('redshift-serverless',
-                             region_name=DWH_REGION,
-                             aws_access_key_id=KEY,
-                             aws_secret_access_key=SECRET,
-                             )
-
-    ec2_client = boto3.client('ec2',
-                              region_name=DWH_REGION,
-                              aws_access_key_id=KEY,
-                              aws_secret_access_key=SECRET
-                              )
-
-    cidr_ip = _get_cidr_ip()
-    security_group_id = _get_security_group_id(rs_client)
-    rule_exists = _ingress_rule_exists(ec2_client, security_group_id)
+def setup_ingress_rule(rs_client=None, ec2_client=None, cidr_ip=None, security_group_id=None):
+    """ This method controls the process of creating the ingress rule.
+    The clients, the CIDR IP and the security group are created / looked up unless
+    they are passed in """
+
+    if rs_client is None or ec2_client is None:
+        import boto3
+
+        config = get_iac_config()
+        client_settings = {'region_name': config.get("DWH", "DWH_REGION"),
+                           'aws_access_key_id': config.get('AWS', 'KEY'),
+                           'aws_secret_access_key': config.get('AWS', 'SECRET')}
+        if rs_client is None:
+            rs_client = boto3.client('redshift-serverless', **client_settings)
+        if ec2_client is None:
+            ec2_client = boto3.client('ec2', **client_settings)
+
+    if cidr_ip is None:
+        cidr_ip = get_cidr_ip()
+    if security_group_id is None:
+        security_group_id = get_security_group_id(rs_client)
+    rule_exists = _ingress_rule_exists(ec2_client, security_group_id, cidr_ip)
     if rule_exists is False:
         _create_ingress_rule(ec2_client, security_group_id, cidr_ip)
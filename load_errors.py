@@ -0,0 +1,92 @@
+""" Quarantine of the records the staging loads rejected
+
+Each staging COPY may reject up to COPY_MAX_ERRORS records (ETL section of dwh.cfg)
+instead of failing on the first malformed one.  After the loads the rejected records
+are moved into etl_load_errors with their file, line and reason: on Redshift from
+sys_load_error_detail, by the query ids of the run's COPYs (recorded in the run
+journal), for local loads from the COPY FROM STDIN loader.  The run
+ends with a summary of what was rejected.  DuckDB reads local files itself and has no
+error budget, it stops at the first malformed record (etl.py says so when it loads) """
+
+import datetime
+import psycopg2
+from prettytable import PrettyTable
+import utilities
+import dialects
+from sql_queries import (get_copy_max_errors, LOAD_ERROR_DETAIL_SELECT, LOAD_ERRORS_INSERT,
+                         LOAD_ERRORS_ROW_INSERT, LOAD_ERRORS_SUMMARY, RUN_QUERY_IDS_SELECT)
+
+TEXT_LENGTH = 1024
+
+
+def sql(query: str) -> str:
+    """ The query rewritten for the SQL dialect of the database """
+
+    return dialects.translate(query, utilities.get_db_dialect())
+
+
+def insert_load_errors(cur: psycopg2.extensions.cursor, rows: list) -> int:
+    """ Add etl_load_errors rows, returns how many """
+
+    if rows:
+        utilities.insert_rows(cur, LOAD_ERRORS_INSERT, sql(LOAD_ERRORS_ROW_INSERT), rows)
+
+    return len(rows)
+
+
+def quarantine_copy_errors(cur: psycopg2.extensions.cursor, run_id: int) -> int:
+    """ Copy the errors of the Redshift COPYs of the run into etl_load_errors, uncommitted.
+    Only the statements the run journal recorded for the run are looked up, so the COPYs
+    of other runs and sessions are left out.  Returns the number of errors """
+
+    cur.execute(sql(RUN_QUERY_IDS_SELECT), (run_id,))
+    query_ids = tuple(sorted({query_id for query_id, in cur.fetchall()}))
+    if not query_ids:
+        return 0
+
+    cur.execute(sql(LOAD_ERROR_DETAIL_SELECT), (query_ids,))
+    rows = [(run_id, rejected_at, file_name, line_number, column_name,
+             (reason or '')[:TEXT_LENGTH], None)
+            for rejected_at, file_name, line_number, column_name, reason in cur.fetchall()]
+
+    return insert_load_errors(cur, rows)
+
+
+def quarantine_rejected_records(cur: psycopg2.extensions.cursor, run_id: int,
+                                rejected: list) -> int:
+    """ Add the (file, line number, reason, line) records a local load rejected
+    (see stdin_loader.read_records) to etl_load_errors, uncommitted """
+
+    rejected_at = datetime.datetime.utcnow()
+    rows = [(run_id, rejected_at, path, line_number, None, reason[:TEXT_LENGTH],
+             line[:TEXT_LENGTH])
+            for path, line_number, reason, line in rejected]
+
+    return insert_load_errors(cur, rows)
+
+
+def report_load_errors(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection,
+                       run_id: int):
+    """ Print the rejected records of the run by file, with the first reason of each """
+
+    cur.execute(sql(LOAD_ERRORS_SUMMARY), (run_id,))
+    files = cur.fetchall()
+    conn.commit()
+
+    if not files:
+        print(f"The staging loads rejected no records (error budget {get_copy_max_errors()} " +
+              "per COPY).")
+        return
+
+    report = PrettyTable()
+    report.field_names = ['File', 'Rejected', 'Reason']
+    report.align['File'] = 'l'
+    report.align['Reason'] = 'l'
+    for file_name, rejected, reason in files:
+        report.add_row([file_name, rejected, reason[:80]])
+    print(report)
+
+    total = sum(rejected for _, rejected, _ in files)
+    print(f"The staging loads rejected {total} records in {len(files)} files (error budget " +
+          f"{get_copy_max_errors()} per COPY), they are quarantined in etl_load_errors " +
+          f"(run_id {run_id}).")
@@ -0,0 +1,73 @@
+""" Redshift COPY manifests for loading many small files
+
+The song dataset is one tiny JSON file per track.  Instead of one COPY per prefix,
+the files are split into batches, each listed in a manifest, sized so that every
+slice of the warehouse gets the same number of files from each COPY """
+
+import json
+import math
+import time
+import psycopg2
+from s3_listing import split_s3_path
+
+DEFAULT_SLICES = 16
+FILES_PER_SLICE = 256
+
+
+def get_slice_count(cur: psycopg2.extensions.cursor,
+                    conn: psycopg2.extensions.connection) -> int:
+    """ Number of slices of the warehouse, DEFAULT_SLICES if it can not be queried
+    (e.g. stv_slices is not visible to the user on Redshift Serverless) """
+
+    try:
+        cur.execute("SELECT COUNT(*) FROM stv_slices;")
+        slices = cur.fetchone()[0]
+    except psycopg2.Error:
+        conn.rollback()
+        slices = 0
+
+    return slices or DEFAULT_SLICES
+
+
+def get_batches(objects: list, slices: int, files_per_slice: int = FILES_PER_SLICE) -> list:
+    """ Split (key, size) objects into batches of keys.
+
+    Each batch holds at most slices * files_per_slice files and the batches differ by at
+    most one file, so every COPY gives each slice about files_per_slice files.  The largest
+    files are dealt out first, round robin, so the batches also carry about the same bytes """
+
+    if not objects:
+        return []
+
+    batch_count = math.ceil(len(objects) / (slices * files_per_slice))
+    batches = [[] for _ in range(batch_count)]
+
+    by_size = sorted(objects, key=lambda s3_object: s3_object[1], reverse=True)
+    for index, (key, _) in enumerate(by_size):
+        batches[index % batch_count].append(key)
+
+    return batches
+
+
+def get_manifest(bucket: str, keys: list) -> dict:
+    """ Manifest listing every key, all of which must be loaded """
+
+    return {'entries': [{'url': f"s3://{bucket}/{key}", 'mandatory': True}
+                        for key in sorted(keys)]}
+
+
+def upload_manifests(s3_client, manifest_path: str, name: str,
+                     bucket: str, batches: list) -> list:
+    """ Write one manifest per batch under manifest_path, returns their S3 paths """
+
+    manifest_bucket, manifest_prefix = split_s3_path(manifest_path)
+    run_stamp = time.strftime('%Y%m%d%H%M%S')
+
+    manifest_paths = []
+    for index, keys in enumerate(batches):
+        manifest_key = f"{manifest_prefix.rstrip('/')}/{name}-{run_stamp}-{index:04d}.manifest"
+        s3_client.put_object(Bucket=manifest_bucket, Key=manifest_key,
+                             Body=json.dumps(get_manifest(bucket, keys)).encode('utf-8'))
+        manifest_paths.append(f"s3://{manifest_bucket}/{manifest_key}")
+
+    return manifest_paths
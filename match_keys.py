@@ -0,0 +1,51 @@
+""" Match report for the song / artist match keys
+
+songplays joins staging_events_keyed to staging_songs_keyed on a hashed, normalized
+title + artist key (see MATCH KEYS in sql_queries.py) instead of comparing the
+title and artist VARCHARs.  The report compares both ways of matching on the data
+in staging: how many song events each matches and how long each join takes """
+
+import time
+import psycopg2
+import dialects
+import utilities
+from sql_queries import (MATCH_EVENTS_COUNT, EXACT_MATCHED_EVENTS_COUNT,
+                         KEYED_MATCHED_EVENTS_COUNT, EXACT_MATCH_JOIN, KEYED_MATCH_JOIN)
+
+
+def time_count_query(cur: psycopg2.extensions.cursor, query: str) -> tuple:
+    """ Run a COUNT(*) query, returns the count and the seconds it took """
+
+    start_time = time.time()
+    cur.execute(dialects.translate(query, utilities.get_db_dialect()))
+    count = cur.fetchone()[0]
+
+    return count, time.time() - start_time
+
+
+def get_match_rate(matched: int, events: int) -> str:
+    """ Printable share of the song events that were matched """
+
+    if not events:
+        return 'n/a'
+    return f"{100 * matched / events:.1f}%"
+
+
+def report_match_rate(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection):
+    """ Print the match rate and join time of the exact join (before)
+    and of the match key join (after) """
+
+    events, _ = time_count_query(cur, MATCH_EVENTS_COUNT)
+    exact_matched, _ = time_count_query(cur, EXACT_MATCHED_EVENTS_COUNT)
+    keyed_matched, _ = time_count_query(cur, KEYED_MATCHED_EVENTS_COUNT)
+    exact_rows, exact_seconds = time_count_query(cur, EXACT_MATCH_JOIN)
+    keyed_rows, keyed_seconds = time_count_query(cur, KEYED_MATCH_JOIN)
+    conn.commit()
+
+    print(f"\nMatch report for {events} song events in staging")
+    print("  before (title = title and artist = artist_name): " +
+          f"{exact_matched} matched ({get_match_rate(exact_matched, events)}), " +
+          f"join of {exact_rows} rows took {exact_seconds:.3f} seconds")
+    print("  after (match_key = match_key): " +
+          f"{keyed_matched} matched ({get_match_rate(keyed_matched, events)}), " +
+          f"join of {keyed_rows} rows took {keyed_seconds:.3f} seconds")
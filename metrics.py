@@ -0,0 +1,237 @@
+""" Timing spans of the SQL statements, emitted as structured metrics
+
+Every statement run by create_tables.py, the staging COPYs and inserts of etl.py and the
+sample queries and exports of analysis.py is timed in a span, with its wall time and the rows it
+affected.  On Redshift a span also gets the statement's query id (pg_last_query_id())
+and the bytes its scan steps read, from sys_query_detail.  The system views are filled a
+little after a statement ends, so the bytes are read once, at the end of the run, for all
+the spans.  The spans are then appended to a JSON Lines file (spans_path in the METRICS
+section of dwh.cfg, empty to not write them) and the slowest are printed in a table.
+
+Functions added with add_hooks are called when a span starts and when it ends, on the
+thread running the statement, e.g. to start and stop a profiler """
+
+import contextlib
+import datetime
+import json
+import threading
+import time
+import psycopg2
+from prettytable import PrettyTable
+import utilities
+from sql_queries import LAST_QUERY_ID_SELECT, QUERY_BYTES_SCANNED_SELECT
+
+# default of spans_path in the METRICS section of dwh.cfg
+SPANS_PATH = 'metrics.jsonl'
+
+# spans listed in the summary, the slowest first
+SUMMARY_SPANS = 20
+
+NAME_LENGTH = 60
+ERROR_LENGTH = 1024
+
+
+class Span:
+    """ One timed statement """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.thread = threading.current_thread().name
+        self.started_at = datetime.datetime.utcnow()
+        self.seconds = None
+        self.rows = None
+        self.query_id = None
+        self.bytes_scanned = None
+        self.error = None
+
+    def to_dict(self) -> dict:
+        """ The span as a JSON object """
+
+        return {'name': self.name,
+                'thread': self.thread,
+                'started_at': self.started_at.isoformat() + 'Z',
+                'seconds': round(self.seconds, 6),
+                'rows': self.rows,
+                'query_id': self.query_id,
+                'bytes_scanned': self.bytes_scanned,
+                'error': self.error}
+
+
+class SpanRecorder:
+    """ The spans of a run, recorded by any thread, and the hooks called around them """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+        self.before_hooks = []
+        self.after_hooks = []
+
+    def add_hooks(self, before=None, after=None):
+        """ Call before(span) when a span starts and after(span) when it ended """
+
+        if before is not None:
+            self.before_hooks.append(before)
+        if after is not None:
+            self.after_hooks.append(after)
+
+    @contextlib.contextmanager
+    def span(self, name: str, conn: psycopg2.extensions.connection = None):
+        """ Time the body as a span, which it may give its rows.  With the connection of
+        the statement, the statement's query id is looked up when the body succeeded """
+
+        span = Span(name)
+        for hook in self.before_hooks:
+            hook(span)
+
+        start_time = time.perf_counter()
+        succeeded = False
+        try:
+            yield span
+            succeeded = True
+        except Exception as error:
+            span.error = str(error).strip()[:ERROR_LENGTH]
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start_time
+            if succeeded and conn is not None:
+                span.query_id = get_last_query_id(conn)
+            with self.lock:
+                self.spans.append(span)
+            for hook in self.after_hooks:
+                hook(span)
+
+    def execute(self, cur: psycopg2.extensions.cursor, name: str, query: str,
+                params=None) -> Span:
+        """ Execute a statement in a span, with the rows it affected.  Returns the span """
+
+        with self.span(name, cur.connection) as span:
+            cur.execute(query, params)
+            if cur.rowcount >= 0:
+                span.rows = cur.rowcount
+        return span
+
+    def take_spans(self) -> list:
+        """ The spans recorded so far, which are forgotten """
+
+        with self.lock:
+            spans, self.spans = self.spans, []
+        return spans
+
+
+RECORDER = SpanRecorder()
+
+
+def get_statement_name(query: str) -> str:
+    """ Span name of a statement without one, its first line """
+
+    lines = [line.strip() for line in query.splitlines() if line.strip()]
+    return lines[0][:NAME_LENGTH] if lines else ''
+
+
+def get_last_query_id(conn: psycopg2.extensions.connection) -> int:
+    """ Redshift's id of the last statement of the connection's session, None elsewhere """
+
+    if utilities.get_db_dialect() != 'redshift':
+        return None
+
+    with conn.cursor() as cur:
+        cur.execute(LAST_QUERY_ID_SELECT)
+        query_id = cur.fetchone()[0]
+
+    return query_id if query_id >= 0 else None
+
+
+def add_bytes_scanned(conn: psycopg2.extensions.connection, spans: list):
+    """ Look up the bytes scanned by the spans' statements in the system views """
+
+    query_ids = tuple(sorted({span.query_id for span in spans if span.query_id is not None}))
+    if not query_ids:
+        return
+
+    with conn.cursor() as cur:
+        cur.execute(QUERY_BYTES_SCANNED_SELECT, (query_ids,))
+        bytes_scanned = dict(cur.fetchall())
+    conn.commit()
+
+    for span in spans:
+        if span.query_id in bytes_scanned:
+            span.bytes_scanned = int(bytes_scanned[span.query_id])
+
+
+def get_spans_path() -> str:
+    """ spans_path of dwh.cfg, empty to not write the spans """
+
+    return utilities.get_config_value("METRICS", "SPANS_PATH", SPANS_PATH)
+
+
+def write_spans(spans: list, program: str, run_id: int, path: str):
+    """ Append the spans to the JSON Lines file, one object per span """
+
+    with open(path, 'a', encoding='utf-8') as spans_file:
+        for span in spans:
+            record = {'program': program, 'run_id': run_id}
+            record.update(span.to_dict())
+            spans_file.write(json.dumps(record) + '\n')
+
+
+def print_summary(spans: list):
+    """ Print the slowest spans and the totals """
+
+    report = PrettyTable()
+    report.field_names = ['Span', 'Seconds', 'Rows', 'Bytes scanned', 'Error']
+    report.align['Span'] = 'l'
+    report.align['Seconds'] = 'r'
+    report.align['Rows'] = 'r'
+    report.align['Bytes scanned'] = 'r'
+    slowest = sorted(spans, key=lambda span: span.seconds, reverse=True)
+    for span in slowest[:SUMMARY_SPANS]:
+        report.add_row([span.name, f"{span.seconds:.3f}",
+                        '' if span.rows is None else span.rows,
+                        '' if span.bytes_scanned is None else span.bytes_scanned,
+                        'yes' if span.error else ''])
+    print(report)
+
+    total = sum(span.seconds for span in spans)
+    failed = sum(1 for span in spans if span.error)
+    print(f"{len(spans)} statements ran for {total:.3f} seconds in total, {failed} failed" +
+          (f", the {SUMMARY_SPANS} slowest are listed." if len(spans) > SUMMARY_SPANS else "."))
+
+
+def add_hooks(before=None, after=None):
+    """ Call before(span) when any span starts and after(span) when it ended """
+
+    RECORDER.add_hooks(before, after)
+
+
+def span(name: str, conn: psycopg2.extensions.connection = None):
+    """ Context manager timing its body as a span, see SpanRecorder.span """
+
+    return RECORDER.span(name, conn)
+
+
+def execute(cur: psycopg2.extensions.cursor, name: str, query: str, params=None) -> Span:
+    """ Execute a statement in a span, with the rows it affected.  Returns the span """
+
+    return RECORDER.execute(cur, name, query, params)
+
+
+def finish(conn: psycopg2.extensions.connection, program: str, run_id: int = None):
+    """ End of a run: add the bytes scanned to the spans recorded so far, append them to
+    spans_path and print the summary.  Spans recorded afterwards start a new batch """
+
+    spans = RECORDER.take_spans()
+    if not spans:
+        return
+
+    try:
+        add_bytes_scanned(conn, spans)
+    except psycopg2.Error as error:
+        conn.rollback()
+        print(f"Could not read the bytes scanned ({str(error).strip()}).")
+
+    spans_path = get_spans_path()
+    if spans_path:
+        write_spans(spans, program, run_id, spans_path)
+    print_summary(spans)
+    if spans_path:
+        print(f"Wrote {len(spans)} spans to {spans_path}.")
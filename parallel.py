@@ -0,0 +1,134 @@
+""" Run independent SQL statements at the same time,
+each on its own connection from a connection pool """
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+import psycopg2
+import psycopg2.pool
+import utilities
+import connections
+import metrics
+
+# attempts at a statement that fails on transient connection errors,
+# with jittered exponential backoff between them (see connections.py)
+MAX_ATTEMPTS = 3
+
+
+class StatementRunner:
+    """ Runs statements on pooled connections and keeps track of the connections
+    that are busy, so the running statements can be cancelled if a sibling fails.
+
+    With a run journal (see run_journal.py) statements that completed before are
+    skipped and each statement records its progress.  A statement that fails on a
+    transient connection error is retried on a new connection """
+
+    def __init__(self, pool: psycopg2.pool.ThreadedConnectionPool, journal=None):
+        self.pool = pool
+        self.journal = journal
+        self.busy_connections = set()
+        self.lock = threading.Lock()
+
+    def run(self, name: str, query: str, params=None) -> float:
+        """ Execute and commit one statement, returns how many seconds it ran """
+
+        if self.journal is not None and self.journal.skip(name):
+            return 0.0
+
+        attempt = 1
+        while True:
+            try:
+                duration = self.run_attempt(name, query, params, attempt)
+                break
+            except Exception as error:
+                if attempt >= MAX_ATTEMPTS or not utilities.is_transient_error(error):
+                    raise
+                delay = connections.get_retry_delay(attempt)
+                print(f"{name} failed on a connection error ({str(error).strip()}), " +
+                      f"retrying in {delay:.1f} seconds.")
+                time.sleep(delay)
+                attempt += 1
+
+        print(f"{name} finished. It took {utilities.format_duration(duration)}.")
+        return duration
+
+    def run_attempt(self, name: str, query: str, params, attempt: int) -> float:
+        """ One attempt at a statement, the connection of a transient
+        error is closed rather than returned to the pool """
+
+        conn = self.pool.getconn()
+        with self.lock:
+            self.busy_connections.add(conn)
+
+        start_time = time.time()
+        broken = False
+        try:
+            with conn.cursor() as cur:
+                if self.journal is not None:
+                    self.journal.record(cur, name, 'running', attempt)
+                    conn.commit()
+                span = metrics.execute(cur, name, query, params)
+                if self.journal is not None:
+                    self.journal.record(cur, name, 'completed', attempt, cur.rowcount,
+                                        query_id=span.query_id)
+            conn.commit()
+        except Exception as error:
+            broken = utilities.is_transient_error(error)
+            if not broken:
+                conn.rollback()
+                if self.journal is not None:
+                    self.journal.record_failure(conn, name, attempt, str(error).strip())
+            raise
+        finally:
+            with self.lock:
+                self.busy_connections.discard(conn)
+            self.pool.putconn(conn, close=broken)
+
+        return time.time() - start_time
+
+    def cancel_running(self):
+        """ Ask the database to cancel every statement that is still running """
+
+        with self.lock:
+            for conn in self.busy_connections:
+                conn.cancel()
+
+
+def run_statements_in_parallel(pool: psycopg2.pool.ThreadedConnectionPool,
+                               statements: list, max_workers: int, journal=None) -> dict:
+    """ Run (name, query) statements, up to max_workers at a time.
+
+    If one statement fails the statements that have not started are dropped,
+    the running ones are cancelled and the first error is raised.
+    With a run journal the statements are recorded in it by name.
+    Returns the seconds each statement ran, by name, and prints how much
+    wall clock time running them in parallel saved over running them one by one """
+
+    runner = StatementRunner(pool, journal)
+    start_time = time.time()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(runner.run, name, query): name
+                   for name, query in statements}
+
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        failed = [future for future in done if future.exception() is not None]
+        if failed:
+            for future in not_done:
+                future.cancel()
+            runner.cancel_running()
+            wait(not_done)
+            print(f"{futures[failed[0]]} failed, cancelled the other statements.")
+            raise failed[0].exception()
+
+    wall_clock = time.time() - start_time
+    durations = {futures[future]: future.result() for future in futures}
+    serial = sum(durations.values())
+
+    for name, duration in durations.items():
+        print(f"    {name}: {utilities.format_duration(duration)}")
+    print(f"Total wall clock time {utilities.format_duration(wall_clock)}, " +
+          f"one by one it would have been {utilities.format_duration(serial)}, " +
+          f"saved {utilities.format_duration(max(serial - wall_clock, 0))}.")
+
+    return durations
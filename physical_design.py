@@ -0,0 +1,141 @@
+""" Benchmark the physical design profiles of sql_queries.py
+
+Each profile gets its own schema with copies of the fact and dimension tables
+(run etl.py first), created with that profile's DDL.  Then every sample query is
+run against each schema a few times, and a report compares the per query latency
+across the profiles.  Set PHYSICAL_PROFILE in the CLUSTER section of dwh.cfg to
+switch the profile create_tables.py uses """
+
+import argparse
+import statistics
+import time
+import psycopg2
+from prettytable import PrettyTable
+import utilities
+import dialects
+from sql_queries import (table_columns, physical_profiles, get_create_table_query,
+                         sample_queries, sample_query_titles,
+                         PROFILE_SCHEMA_DROP, PROFILE_SCHEMA_CREATE, PROFILE_TABLE_COPY,
+                         SEARCH_PATH_SET, RESULT_CACHE_DISABLE, USERS_CURRENT_VIEW)
+
+
+def get_schema(profile: str) -> str:
+    """ Schema holding the tables of a profile """
+
+    return f"profile_{profile}"
+
+
+def build_profile_tables(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection,
+                         profile: str, dialect: str):
+    """ (Re)create the profile's schema with copies of the fact and dimension tables
+    (and the users_current view) """
+
+    schema = get_schema(profile)
+    start_time = time.time()
+
+    cur.execute(dialects.translate(PROFILE_SCHEMA_DROP.format(schema), dialect))
+    cur.execute(dialects.translate(PROFILE_SCHEMA_CREATE.format(schema), dialect))
+
+    for table, columns in table_columns.items():
+        cur.execute(dialects.translate(
+            get_create_table_query(table, profile, table_name=f"{schema}.{table}"), dialect))
+
+        # identity columns are generated again
+        column_list = ', '.join(column for column, column_type in columns
+                                if 'IDENTITY' not in column_type)
+        cur.execute(dialects.translate(
+            PROFILE_TABLE_COPY.format(schema, table, column_list, column_list, table), dialect))
+
+    cur.execute(dialects.translate(USERS_CURRENT_VIEW.format(f"{schema}.", f"{schema}."), dialect))
+    conn.commit()
+
+    print(f"Built the {profile} tables in {utilities.get_duration_string(start_time)}.")
+
+
+def time_sample_queries(cur: psycopg2.extensions.cursor, profile: str, dialect: str,
+                        repeat: int) -> list:
+    """ Median seconds of each sample query against the profile's tables """
+
+    cur.execute(dialects.translate(SEARCH_PATH_SET.format(get_schema(profile)), dialect))
+
+    latencies = []
+    for query in sample_queries:
+        query = dialects.translate(query, dialect)
+
+        durations = []
+        for _ in range(repeat):
+            start_time = time.time()
+            cur.execute(query)
+            cur.fetchall()
+            durations.append(time.time() - start_time)
+
+        latencies.append(statistics.median(durations))
+
+    return latencies
+
+
+def print_report(profiles: list, latencies: dict):
+    """ Per query latency (median seconds) of each profile, fastest marked with * """
+
+    report = PrettyTable()
+    report.field_names = ['Query'] + profiles
+    report.align['Query'] = 'l'
+
+    rows = list(zip(*[latencies[profile] for profile in profiles]))
+    for title, row in zip(sample_query_titles, rows):
+        fastest = min(row)
+        report.add_row([title] + [f"{value:.3f}{' *' if value == fastest else ''}"
+                                  for value in row])
+
+    report.add_row(['Total'] + [f"{sum(latencies[profile]):.3f}" for profile in profiles])
+    print(report)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """ Command line options """
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0].strip())
+    parser.add_argument('--profiles', nargs='+', default=list(physical_profiles),
+                        choices=list(physical_profiles),
+                        help='profiles to compare (default all)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each query per profile, the median is reported (default 3)')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the profile schemas instead of dropping them at the end')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """ Benchmark the physical design profiles """
+
+    args = parse_args(argv)
+    dialect = utilities.get_db_dialect()
+
+    conn = utilities.get_db_connection()
+    cur = conn.cursor()
+
+    if dialect == 'redshift':
+        # otherwise repeated queries are answered from the result cache
+        cur.execute(RESULT_CACHE_DISABLE)
+
+    for profile in args.profiles:
+        build_profile_tables(cur, conn, profile, dialect)
+
+    latencies = {}
+    for profile in args.profiles:
+        latencies[profile] = time_sample_queries(cur, profile, dialect, args.repeat)
+    conn.commit()
+
+    print_report(args.profiles, latencies)
+
+    if not args.keep:
+        for profile in args.profiles:
+            cur.execute(dialects.translate(PROFILE_SCHEMA_DROP.format(get_schema(profile)),
+                                           dialect))
+        conn.commit()
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
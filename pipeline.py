@@ -0,0 +1,106 @@
+""" Dependency aware scheduler for SQL steps
+
+A step is a dict with a name, a query and the tables it reads (inputs) and writes (outputs),
+see insert_table_steps in sql_queries.py.  A step waits for every earlier step that writes
+a table it reads or writes, or that reads a table it writes.  Steps whose dependencies are
+done run at the same time, each on its own pooled connection, up to a bounded worker count """
+
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import psycopg2
+import psycopg2.pool
+import utilities
+from parallel import StatementRunner
+
+
+def get_dependencies(steps: list) -> dict:
+    """ Names of the earlier steps each step has to wait for, by step name """
+
+    dependencies = {}
+    for index, step in enumerate(steps):
+        reads = set(step['inputs'])
+        writes = set(step['outputs'])
+        dependencies[step['name']] = [
+            earlier['name'] for earlier in steps[:index]
+            if set(earlier['outputs']) & (reads | writes) or set(earlier['inputs']) & writes]
+
+    return dependencies
+
+
+def get_critical_path(steps: list, dependencies: dict, run_times: dict) -> list:
+    """ The chain of dependent steps with the longest total run time """
+
+    longest = {}
+    for step in steps:
+        name = step['name']
+        previous = max(dependencies[name], key=lambda dep: longest[dep][0], default=None)
+        if previous is None:
+            longest[name] = (run_times[name], [name])
+        else:
+            longest[name] = (longest[previous][0] + run_times[name],
+                             longest[previous][1] + [name])
+
+    return max(longest.values(), key=lambda path: path[0])[1]
+
+
+def run_pipeline(pool: psycopg2.pool.ThreadedConnectionPool, steps: list,
+                 max_workers: int, params=None, journal=None) -> dict:
+    """ Run the steps as soon as their dependencies are done, up to max_workers at a time.
+
+    The first failing step cancels the running steps and its error is raised.
+    Prints how long each step waited for a worker after it was ready versus how
+    long it ran, and the critical path.  With a run journal (see run_journal.py) the
+    steps are recorded in it, the ones that completed before are skipped.
+    Returns the run seconds by step name """
+
+    dependencies = get_dependencies(steps)
+    queries = {step['name']: step['query'] for step in steps}
+    runner = StatementRunner(pool, journal)
+
+    pipeline_start = time.time()
+    ready_times, start_times, run_times = {}, {}, {}
+    pending = [step['name'] for step in steps]
+    running = {}
+
+    def run_step(name):
+        start_times[name] = time.time()
+        return runner.run(name, queries[name], params)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+
+            for name in list(pending):
+                if all(dep in run_times for dep in dependencies[name]):
+                    ready_times[name] = time.time()
+                    running[executor.submit(run_step, name)] = name
+                    pending.remove(name)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    for other in running:
+                        other.cancel()
+                    runner.cancel_running()
+                    wait(running)
+                    print(f"Step {name} failed, cancelled the running steps.")
+                    raise future.exception()
+                run_times[name] = future.result()
+
+    wall_clock = time.time() - pipeline_start
+
+    print('')
+    for step in steps:
+        name = step['name']
+        waited = start_times[name] - ready_times[name]
+        print(f"    {name}: waited {utilities.format_duration(waited)}, " +
+              f"ran {utilities.format_duration(run_times[name])}")
+
+    critical_path = get_critical_path(steps, dependencies, run_times)
+    critical_time = sum(run_times[name] for name in critical_path)
+    print(f"Critical path: {' -> '.join(critical_path)} " +
+          f"({utilities.format_duration(critical_time)})")
+    print(f"Total wall clock time {utilities.format_duration(wall_clock)}, " +
+          f"one by one it would have been {utilities.format_duration(sum(run_times.values()))}.")
+
+    return run_times
@@ -0,0 +1,158 @@
+""" On-disk cache of the analysis query results
+
+A result is stored under a hash of the normalized SQL, its parameters and the data
+version, the load id etl.py records in etl_watermarks (source 'data_version') after
+every load that changed rows.  So repeated analysis runs are answered locally until the
+data changes.  Entries also expire after a TTL, and the least recently used ones are evicted when
+the cache grows past its size limit.  Settings are in the ANALYSIS section of dwh.cfg """
+
+import hashlib
+import os
+import pickle
+import re
+import threading
+import time
+import psycopg2
+import dialects
+import utilities
+from sql_queries import WATERMARK_SELECT, WATERMARK_DELETE, WATERMARK_INSERT
+
+# defaults of the settings in the ANALYSIS section of dwh.cfg
+CACHE_DIR = '.analysis_cache'
+CACHE_MAX_MB = 64.0
+CACHE_TTL_HOURS = 24.0
+
+# etl_watermarks source of the load id
+DATA_VERSION_SOURCE = 'data_version'
+
+
+def get_data_version(conn: psycopg2.extensions.connection):
+    """ Load id of the last ETL run that changed rows, None if nothing was loaded yet """
+
+    with conn.cursor() as cur:
+        cur.execute(dialects.translate(WATERMARK_SELECT, utilities.get_db_dialect()),
+                    (DATA_VERSION_SOURCE,))
+        row = cur.fetchone()
+    conn.commit()
+
+    return None if row is None else row[0]
+
+
+def record_data_version(cur: psycopg2.extensions.cursor) -> int:
+    """ Record a new load id (committed by the caller), so the cached results of
+    earlier loads are not used anymore.  Returns it """
+
+    data_version = int(time.time() * 1000)
+    dialect = utilities.get_db_dialect()
+    cur.execute(dialects.translate(WATERMARK_DELETE, dialect), (DATA_VERSION_SOURCE,))
+    cur.execute(dialects.translate(WATERMARK_INSERT, dialect),
+                (DATA_VERSION_SOURCE, data_version))
+
+    return data_version
+
+
+def normalize_sql(query: str) -> str:
+    """ The query with its whitespace collapsed, so layout changes still hit """
+
+    return re.sub(r'\s+', ' ', query).strip()
+
+
+class ResultCache:
+    """ Size bounded LRU cache of query results with a TTL, one pickle file per result.
+    The modification time of a file is its last use.  Results are looked up and stored
+    for one data version (see get_data_version), nothing is cached when it is None """
+
+    def __init__(self, data_version, directory: str = None, max_mb: float = None,
+                 ttl_hours: float = None):
+        if directory is None:
+            directory = utilities.get_config_value("ANALYSIS", "CACHE_DIR", CACHE_DIR)
+        if max_mb is None:
+            max_mb = utilities.get_config_value("ANALYSIS", "CACHE_MAX_MB", CACHE_MAX_MB)
+        if ttl_hours is None:
+            ttl_hours = utilities.get_config_value("ANALYSIS", "CACHE_TTL_HOURS",
+                                                   CACHE_TTL_HOURS)
+        self.data_version = data_version
+        self.directory = directory
+        self.max_bytes = max_mb * 1024 * 1024
+        self.ttl_seconds = ttl_hours * 3600
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, query: str, params) -> str:
+        """ File of a result """
+
+        key = '\n'.join([str(self.data_version), utilities.get_db_dialect(),
+                         normalize_sql(query), repr(params)])
+        return os.path.join(self.directory,
+                            hashlib.sha256(key.encode('utf-8')).hexdigest() + '.pickle')
+
+    def get(self, query: str, params):
+        """ The cached result, None on a miss (nothing loaded yet, not cached or expired) """
+
+        result = None
+        if self.data_version is not None:
+            path = self.get_path(query, params)
+            try:
+                with open(path, 'rb') as cache_file:
+                    created, cached_result = pickle.load(cache_file)
+                if time.time() - created <= self.ttl_seconds:
+                    os.utime(path)
+                    result = cached_result
+                else:
+                    os.remove(path)
+            except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+                # not cached, or evicted / written by another thread meanwhile
+                pass
+
+        with self.lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return result
+
+    def put(self, query: str, params, result):
+        """ Cache a result, then evict the least recently used results over the size limit """
+
+        if self.data_version is None:
+            return
+
+        path = self.get_path(query, params)
+        temporary_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary_path, 'wb') as cache_file:
+            pickle.dump((time.time(), result), cache_file)
+        os.replace(temporary_path, path)
+
+        with self.lock:
+            self.evict()
+
+    def evict(self):
+        """ Delete the least recently used results until the cache fits its size limit """
+
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pickle'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def print_stats(self):
+        """ Hits and misses so far """
+
+        print(f"Result cache: {self.hits} hits, {self.misses} misses " +
+              f"(data version {self.data_version}, {self.directory})")
@@ -0,0 +1,203 @@
+""" Journal of the steps of an ETL run, for resuming a failed run
+
+Every step of etl.py (the staging COPYs, the time dimension, the inserts, the control
+table update) is recorded in etl_run_journal when it starts and when it completes or
+fails, with its attempts, times, row count and (on Redshift) query id.  SQL steps record
+their completion in the same transaction as their work, so a completed step is never run
+twice.  etl.py --resume continues the last run if it did not complete: the steps it
+completed are skipped and the run goes on from the first incomplete one """
+
+import time
+import psycopg2
+import utilities
+import dialects
+import connections
+import metrics
+import parallel
+from sql_queries import (LAST_RUN_SELECT, COMPLETED_STEPS_SELECT, JOURNAL_STEP_DELETE,
+                         JOURNAL_STEP_INSERT)
+
+# journal step of the run itself
+RUN_STEP = 'run'
+
+DETAIL_LENGTH = 1024
+
+
+def get_time_ms() -> int:
+    """ Now, in milliseconds since the epoch """
+
+    return int(time.time() * 1000)
+
+
+def sql(query: str) -> str:
+    """ The query rewritten for the SQL dialect of the database """
+
+    return dialects.translate(query, utilities.get_db_dialect())
+
+
+class RunJournal:
+    """ The journal of one run, with the steps it completed so far """
+
+    def __init__(self, run_id: int, mode: str, attempt: int = 1, completed_steps=()):
+        self.run_id = run_id
+        self.mode = mode
+        self.attempt = attempt
+        self.completed_steps = set(completed_steps)
+        self.start_times = {}
+
+    def is_completed(self, step: str) -> bool:
+        """ True if the step completed in this run (before it was resumed) """
+
+        return step in self.completed_steps
+
+    def record(self, cur: psycopg2.extensions.cursor, step: str, status: str,
+               attempts: int = 1, row_count: int = None, detail: str = None,
+               query_id: int = None):
+        """ Replace the journal row of a step, in the transaction of the cursor """
+
+        now = get_time_ms()
+        if status == 'running':
+            self.start_times[step] = now
+        finished_at = None if status == 'running' else now
+        if row_count is not None and row_count < 0:
+            row_count = None
+        if detail is not None:
+            detail = detail[:DETAIL_LENGTH]
+
+        cur.execute(sql(JOURNAL_STEP_DELETE), (self.run_id, step))
+        cur.execute(sql(JOURNAL_STEP_INSERT),
+                    (self.run_id, step, status, attempts, self.start_times.get(step, now),
+                     finished_at, row_count, detail, query_id))
+        if status == 'completed':
+            self.completed_steps.add(step)
+
+    def record_failure(self, conn: psycopg2.extensions.connection, step: str, attempts: int,
+                       detail: str):
+        """ Record that a step failed, if the connection still works
+        (a step left running is just as incomplete) """
+
+        try:
+            with conn.cursor() as cur:
+                self.record(cur, step, 'failed', attempts, detail=detail)
+            conn.commit()
+        except Exception:
+            # e.g. the connection was lost
+            print(f"Could not record the failure of {step} in the run journal.")
+
+    def skip(self, step: str) -> bool:
+        """ True (and says so) if the step completed before, so it is not run again """
+
+        if self.is_completed(step):
+            print(f"{step} completed in run {self.run_id} before, skipped.")
+            return True
+        return False
+
+    def run_attempts(self, cur: psycopg2.extensions.cursor,
+                     conn: psycopg2.extensions.connection, step: str, attempt_function):
+        """ Call attempt_function(attempt), which does the work of a step and records its
+        completion, then commit both.  Like parallel.StatementRunner, a transient error
+        (e.g. a serialization conflict) is retried after a jittered backoff, up to
+        parallel.MAX_ATTEMPTS attempts, as long as the connection is still open.
+        Returns the result of the attempt that succeeded """
+
+        attempt = 1
+        while True:
+            self.record(cur, step, 'running', attempt)
+            conn.commit()
+            try:
+                result = attempt_function(attempt)
+                conn.commit()
+                return result
+            except Exception as error:
+                if not conn.closed:
+                    conn.rollback()
+                if (attempt >= parallel.MAX_ATTEMPTS or conn.closed
+                        or not utilities.is_transient_error(error)):
+                    self.record_failure(conn, step, attempt, str(error).strip())
+                    raise
+                delay = connections.get_retry_delay(attempt)
+                print(f"{step} failed on a transient error ({str(error).strip()}), " +
+                      f"retrying in {delay:.1f} seconds.")
+                time.sleep(delay)
+                attempt += 1
+
+    def run_step(self, cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection,
+                 step: str, function, *args):
+        """ Run a step done in Python (e.g. the time dimension) unless it completed before.
+        What the step leaves uncommitted is committed with its completion.
+        An int result is recorded as its row count.  Returns the result """
+
+        if self.skip(step):
+            return None
+
+        def attempt_step(attempt: int):
+            result = function(*args)
+            self.record(cur, step, 'completed', attempt,
+                        row_count=result if isinstance(result, int) else None)
+            return result
+
+        return self.run_attempts(cur, conn, step, attempt_step)
+
+    def run_query(self, cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection,
+                  step: str, query: str, params=None):
+        """ Execute a query as a step unless it completed before, the query and
+        its completion are committed together """
+
+        if self.skip(step):
+            return
+
+        def attempt_query(attempt: int):
+            span = metrics.execute(cur, step, query, params)
+            self.record(cur, step, 'completed', attempt, row_count=cur.rowcount,
+                        query_id=span.query_id)
+
+        self.run_attempts(cur, conn, step, attempt_query)
+
+    def finish(self, cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection):
+        """ Record that the run completed, it cannot be resumed anymore """
+
+        self.record(cur, RUN_STEP, 'completed', self.attempt, detail=self.mode)
+        conn.commit()
+
+    def fail(self, conn: psycopg2.extensions.connection):
+        """ Record that the run failed, so etl.py --resume can continue it
+        (the error is recorded with the step that failed) """
+
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        self.record_failure(conn, RUN_STEP, self.attempt, self.mode)
+        print(f"Run {self.run_id} failed, run etl.py --resume with the same options " +
+              "to continue it.")
+
+
+def start_run(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection,
+              mode: str, resume: bool = False) -> RunJournal:
+    """ Journal of a new run, or with resume of the last run if it did not complete.
+    mode describes the kind of load (e.g. incremental), a run is only resumed in its mode """
+
+    journal = None
+    if resume:
+        cur.execute(sql(LAST_RUN_SELECT))
+        last_run = cur.fetchone()
+
+        if last_run is None or last_run[1] == 'completed':
+            print("The last run completed, there is nothing to resume. Starting a new run.")
+        elif last_run[3] != mode:
+            raise ValueError(f"Run {last_run[0]} was started as '{last_run[3]}', it cannot " +
+                             f"be resumed as '{mode}', use the options it was started with.")
+        else:
+            cur.execute(sql(COMPLETED_STEPS_SELECT), (last_run[0],))
+            completed_steps = [row[0] for row in cur.fetchall()]
+            journal = RunJournal(last_run[0], mode, last_run[2] + 1, completed_steps)
+            print(f"Resuming run {journal.run_id} (attempt {journal.attempt}), " +
+                  f"{len(completed_steps)} steps completed before.")
+
+    if journal is None:
+        journal = RunJournal(get_time_ms(), mode)
+
+    journal.record(cur, RUN_STEP, 'running', journal.attempt, detail=mode)
+    conn.commit()
+
+    return journal
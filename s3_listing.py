@@ -0,0 +1,95 @@
+""" Listing of the JSON data files under an S3 prefix
+
+The listers share one interface, so the ETL can be pointed at S3 (or a moto stand-in,
+by passing in its client) or at a local directory laid out like the bucket """
+
+import os
+
+
+def split_s3_path(s3_path: str) -> tuple:
+    """ Split 's3://bucket/some/prefix' into ('bucket', 'some/prefix') """
+
+    bucket, _, prefix = s3_path[len('s3://'):].partition('/')
+    return bucket, prefix
+
+
+class S3Lister:
+    """ Lists S3 objects.  By default the requests are not signed
+    (no key/secret needed), which works for public buckets like udacity-dend """
+
+    def __init__(self, s3_client=None, region_name=None):
+        if s3_client is None:
+            # boto3 is slow to import, only import it when S3 is listed
+            import boto3
+            from botocore import UNSIGNED
+            from botocore.config import Config
+            s3_client = boto3.client('s3', region_name=region_name,
+                                     config=Config(signature_version=UNSIGNED))
+        self.s3_client = s3_client
+
+    def list_objects(self, s3_path: str) -> list:
+        """ (key, size in bytes) of all JSON files under the prefix """
+
+        bucket, prefix = split_s3_path(s3_path)
+
+        objects = []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for s3_object in page.get('Contents', []):
+                if s3_object['Key'].endswith('.json'):
+                    objects.append((s3_object['Key'], s3_object['Size']))
+
+        return objects
+
+    def list_partitions(self, s3_path: str) -> list:
+        """ The 'directories' directly under the prefix, e.g. song-data/A, song-data/B ... """
+
+        bucket, prefix = split_s3_path(s3_path)
+        prefix = prefix.rstrip('/') + '/'
+
+        partitions = []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+            for common_prefix in page.get('CommonPrefixes', []):
+                partitions.append(common_prefix['Prefix'].rstrip('/'))
+
+        return partitions
+
+    def list_keys(self, s3_path: str) -> list:
+        """ Keys of all JSON files under the prefix """
+
+        return [key for key, _ in self.list_objects(s3_path)]
+
+
+class LocalLister(S3Lister):
+    """ Lists a local directory as if it were the bucket,
+    i.e. s3://any-bucket/song-data is read from <root_dir>/song-data """
+
+    def __init__(self, root_dir: str):
+        self.s3_client = None
+        self.root_dir = root_dir
+
+    def list_objects(self, s3_path: str) -> list:
+        """ (key, size in bytes) of all JSON files under the prefix """
+
+        _, prefix = split_s3_path(s3_path)
+
+        objects = []
+        for dir_path, _, file_names in os.walk(os.path.join(self.root_dir, prefix)):
+            for file_name in file_names:
+                if file_name.endswith('.json'):
+                    path = os.path.join(dir_path, file_name)
+                    key = os.path.relpath(path, self.root_dir).replace(os.sep, '/')
+                    objects.append((key, os.path.getsize(path)))
+
+        return sorted(objects)
+
+    def list_partitions(self, s3_path: str) -> list:
+        """ The directories directly under the prefix """
+
+        _, prefix = split_s3_path(s3_path)
+        prefix = prefix.rstrip('/')
+        path = os.path.join(self.root_dir, prefix)
+
+        return [f"{prefix}/{name}" for name in sorted(os.listdir(path))
+                if os.path.isdir(os.path.join(path, name))]
@@ -0,0 +1,125 @@
+""" Single entry point of the project's programs
+
+    python3 sparkify.py iac up | iac down | schema | etl | analyze | generate | bench
+
+Only argparse is imported at startup.  The program of a subcommand, and with it boto3,
+psycopg2 and the config files it reads when it is imported, is only imported when the
+subcommand runs, so --help answers at once and the IaC commands do not load the database
+modules or the other way around.  The options after a subcommand are passed on to its
+program, e.g. python3 sparkify.py etl --full-refresh (etl --help lists them).
+
+python3 sparkify.py --check-startup imports this entry point in a fresh interpreter and
+fails if that takes longer than STARTUP_BUDGET_MS or imports a heavy module """
+
+import argparse
+import importlib
+import os
+import subprocess
+import sys
+
+# subcommand -> (module, whether its main takes command line options, help)
+COMMANDS = {'schema': ('create_tables', False, 'replace the tables with new empty ones'),
+            'etl': ('etl', True, 'load the data, then run the sample queries'),
+            'analyze': ('analysis', True, 'run the sample queries'),
+            'generate': ('synthetic_data', True, 'write a synthetic dataset'),
+            'bench': ('benchmark', True, 'benchmark the pipeline on synthetic data')}
+
+IAC_COMMANDS = {'up': ('iac_create', False, 'create the Serverless Redshift'),
+                'down': ('iac_delete', False, 'delete the Serverless Redshift')}
+
+# import time budget of this module, in milliseconds
+STARTUP_BUDGET_MS = 50
+
+# modules that must only be imported by the subcommands
+DEFERRED_MODULES = ['boto3', 'botocore', 'requests', 'psycopg2', 'duckdb', 'prettytable',
+                    'utilities', 'sql_queries']
+
+
+def get_import_times(module: str) -> tuple:
+    """ Import the module in a fresh interpreter, returns its cumulative import time in
+    milliseconds and the names of all the modules that were imported """
+
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         f"import sys, {module}; print(' '.join(sys.modules))"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+        check=True)
+
+    cumulative_us = None
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            cumulative_us = int(fields[1])
+
+    return cumulative_us / 1000, set(result.stdout.split())
+
+
+def check_startup(budget_ms: float = STARTUP_BUDGET_MS) -> bool:
+    """ Print the import time of this module, True if it is within the budget
+    and no deferred module was imported """
+
+    milliseconds, modules = get_import_times('sparkify')
+    imported = [module for module in DEFERRED_MODULES if module in modules]
+
+    print(f"Importing sparkify took {milliseconds:.1f} ms (budget {budget_ms} ms).")
+    if imported:
+        print("It imported " + ', '.join(imported) + ", which only the subcommands should.")
+
+    return milliseconds <= budget_ms and not imported
+
+
+def run_command(command: tuple, options: list, parser: argparse.ArgumentParser):
+    """ Import the program of a subcommand and run its main with the options """
+
+    module_name, takes_options, _ = command
+    if options and not takes_options:
+        parser.error(f"{module_name}.py takes no options: {' '.join(options)}")
+
+    module = importlib.import_module(module_name)
+    if takes_options:
+        module.main(options)
+    else:
+        module.main()
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """ The parser of the subcommands, their own options are left to their programs """
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0].strip())
+    parser.add_argument('--check-startup', action='store_true',
+                        help='check that importing this entry point takes at most ' +
+                             f"{STARTUP_BUDGET_MS} ms and defers the heavy imports")
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+
+    iac_parser = subparsers.add_parser('iac', help='create or delete the infrastructure')
+    iac_subparsers = iac_parser.add_subparsers(dest='action', metavar='action', required=True)
+    for action, (module_name, _, help_text) in IAC_COMMANDS.items():
+        iac_subparsers.add_parser(action, help=f"{help_text} ({module_name}.py)")
+
+    for command, (module_name, _, help_text) in COMMANDS.items():
+        # add_help=False passes --help on to the program
+        subparsers.add_parser(command, help=f"{help_text} ({module_name}.py)", add_help=False)
+
+    return parser
+
+
+def main(argv=None):
+    """ Run a subcommand """
+
+    parser = get_parser()
+    args, options = parser.parse_known_args(argv)
+
+    if args.check_startup:
+        sys.exit(0 if check_startup() else 1)
+
+    if args.command is None:
+        parser.print_help()
+    elif args.command == 'iac':
+        run_command(IAC_COMMANDS[args.action], options, parser)
+    else:
+        run_command(COMMANDS[args.command], options, parser)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,6 @@
 """" This file contains all the SQL used in this project """
-import configparser
-
-
-# CONFIG
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
+import re
+import utilities
 
 # DROP TABLES
 
@@ -13,9 +9,26 @@ STAGING_SONGS_TABLE_DROP = "DROP TABLE IF EXISTS staging_songs;"
 
 SONGPLAYS_TABLE_DROP = "DROP TABLE IF EXISTS songplays;"
 USERS_TABLE_DROP = "DROP TABLE IF EXISTS users;"
+USERS_CURRENT_VIEW_DROP = "DROP VIEW IF EXISTS users_current;"
+USER_LEVELS_TABLE_DROP = "DROP TABLE IF EXISTS user_levels;"
 SONGS_TABLE_DROP = "DROP TABLE IF EXISTS songs;"
 ARTISTS_TABLE_DROP = "DROP TABLE IF EXISTS artists;"
 TIME_TABLE_DROP = "DROP TABLE IF EXISTS time;"
+SONGPLAYS_BY_HOUR_TABLE_DROP = "DROP TABLE IF EXISTS songplays_by_hour;"
+
+STAGING_EVENTS_KEYED_TABLE_DROP = "DROP TABLE IF EXISTS staging_events_keyed;"
+STAGING_SONGS_KEYED_TABLE_DROP = "DROP TABLE IF EXISTS staging_songs_keyed;"
+SONGPLAYS_PENDING_TABLE_DROP = "DROP TABLE IF EXISTS songplays_pending;"
+STAGING_SONGPLAYS_TABLE_DROP = "DROP TABLE IF EXISTS staging_songplays;"
+STAGING_USER_LEVELS_TABLE_DROP = "DROP TABLE IF EXISTS staging_user_levels;"
+STAGING_USER_CHANGES_TABLE_DROP = "DROP TABLE IF EXISTS staging_user_changes;"
+STAGING_SONG_CHANGES_TABLE_DROP = "DROP TABLE IF EXISTS staging_song_changes;"
+STAGING_ARTIST_CHANGES_TABLE_DROP = "DROP TABLE IF EXISTS staging_artist_changes;"
+
+ETL_WATERMARKS_TABLE_DROP = "DROP TABLE IF EXISTS etl_watermarks;"
+ETL_LOADED_FILES_TABLE_DROP = "DROP TABLE IF EXISTS etl_loaded_files;"
+ETL_RUN_JOURNAL_TABLE_DROP = "DROP TABLE IF EXISTS etl_run_journal;"
+ETL_LOAD_ERRORS_TABLE_DROP = "DROP TABLE IF EXISTS etl_load_errors;"
 
 # CREATE TABLES
 
@@ -52,61 +65,343 @@ STAGING_SONGS_TABLE_CREATE = """
         duration REAL,
         artist_id VARCHAR(64),
         artist_longitude REAL,
-        artist_location VARCHAR(512) 
+        artist_location VARCHAR(512),
+        dimensions_loaded BOOLEAN
     );"""
 
-# Note that we are ignoring event fields ... auth, iteminSession, length, method, page, registration
+# events and songs with their hashed song / artist match key, both distributed and
+# sorted on it so the songplays join is a co-located join on one integer column
+STAGING_EVENTS_KEYED_TABLE_CREATE = """
+    CREATE TABLE staging_events_keyed (
+        match_key BIGINT,
+        ts BIGINT,
+        userId INT,
+        level VARCHAR(64),
+        sessionId INT,
+        location VARCHAR(512),
+        userAgent VARCHAR(512)
+    )
+    DISTSTYLE KEY
+    DISTKEY(match_key)
+    SORTKEY(match_key);"""
+
+STAGING_SONGS_KEYED_TABLE_CREATE = """
+    CREATE TABLE staging_songs_keyed (
+        match_key BIGINT,
+        song_id VARCHAR(64),
+        artist_id VARCHAR(64)
+    )
+    DISTSTYLE KEY
+    DISTKEY(match_key)
+    SORTKEY(match_key);"""
+
+# keyed events that did not match a song yet, matched again as new songs arrive
+SONGPLAYS_PENDING_TABLE_CREATE = """
+    CREATE TABLE songplays_pending (
+        match_key BIGINT,
+        ts BIGINT,
+        userId INT,
+        level VARCHAR(64),
+        sessionId INT,
+        location VARCHAR(512),
+        userAgent VARCHAR(512)
+    )
+    DISTSTYLE KEY
+    DISTKEY(match_key)
+    SORTKEY(match_key);"""
 
-SONGPLAYS_TABLE_CREATE = """
-    CREATE TABLE songplays (
-        songplay_id INT PRIMARY KEY IDENTITY(0,1),  
-        start_time BIGINT, 
+# the songplays matched by this run, appended to songplays and rolled up into
+# songplays_by_hour, distributed like songplays (star profile)
+STAGING_SONGPLAYS_TABLE_CREATE = """
+    CREATE TABLE staging_songplays (
+        start_time BIGINT,
+        time_key INT,
         user_id INT,
-        level VARCHAR(64),    
+        level VARCHAR(64),
         song_id VARCHAR(64),
         artist_id VARCHAR(64),
         session_id INT,
         location VARCHAR(512),
         user_agent VARCHAR(512)
+    )
+    DISTSTYLE KEY
+    DISTKEY(song_id);"""
+
+# level periods of the users with new events, the open periods of user_levels included
+STAGING_USER_LEVELS_TABLE_CREATE = """
+    CREATE TABLE staging_user_levels (
+        user_id INT,
+        first_name VARCHAR(256),
+        last_name VARCHAR(256),
+        gender VARCHAR(64),
+        level VARCHAR(64),
+        valid_from BIGINT,
+        valid_to BIGINT
     );"""
 
-USERS_TABLE_CREATE = """
-    CREATE TABLE users (
-        user_id INT PRIMARY KEY,
+# latest version of each dimension row in staging, with the change it makes to the
+# dimension table: change_type is 'insert', 'update' or 'unchanged'
+STAGING_USER_CHANGES_TABLE_CREATE = """
+    CREATE TABLE staging_user_changes (
+        user_id INT,
         first_name VARCHAR(256),
         last_name VARCHAR(256),
         gender VARCHAR(64),
-        level VARCHAR(64)
+        level VARCHAR(64),
+        change_type VARCHAR(16)
     );"""
 
-SONGS_TABLE_CREATE = """
-    CREATE TABLE songs (
-        song_id VARCHAR(30) PRIMARY KEY,
-        artist_id VARCHAR, 
+STAGING_SONG_CHANGES_TABLE_CREATE = """
+    CREATE TABLE staging_song_changes (
+        song_id VARCHAR(30),
+        artist_id VARCHAR,
         title VARCHAR(512),
         year INT,
-        duration REAL
+        duration REAL,
+        change_type VARCHAR(16)
     );"""
 
-ARTISTS_TABLE_CREATE = """
-    CREATE TABLE artists ( 
-        artist_id VARCHAR PRIMARY KEY,
+STAGING_ARTIST_CHANGES_TABLE_CREATE = """
+    CREATE TABLE staging_artist_changes (
+        artist_id VARCHAR,
         artist_name VARCHAR(512),
         artist_location VARCHAR(512),
-        artist_latitude REAL, 
-        artist_longitude REAL
+        artist_latitude REAL,
+        artist_longitude REAL,
+        change_type VARCHAR(16)
     );"""
 
-# values generated from events.ts
-TIME_TABLE_CREATE = """
-    CREATE TABLE time (  
-        start_time BIGINT PRIMARY KEY, 
-        hour INT, 
-        day INT, 
-        week INT, 
-        month INT, 
-        year INT, 
-        weekday INT
+# Note that we are ignoring event fields ... auth, iteminSession, length, method, page, registration
+
+# The fact and dimension tables are declared as column specs, their DDL is generated
+# for a physical design profile (Redshift distribution style, sort keys, column encodings)
+
+table_columns = {
+    'songplays': [('songplay_id', 'INT IDENTITY(0,1) PRIMARY KEY'),
+                  ('start_time', 'BIGINT'),
+                  ('time_key', 'INT'),
+                  ('user_id', 'INT'),
+                  ('level', 'VARCHAR(64)'),
+                  ('song_id', 'VARCHAR(64)'),
+                  ('artist_id', 'VARCHAR(64)'),
+                  ('session_id', 'INT'),
+                  ('location', 'VARCHAR(512)'),
+                  ('user_agent', 'VARCHAR(512)')],
+    'users': [('user_id', 'INT PRIMARY KEY'),
+              ('first_name', 'VARCHAR(256)'),
+              ('last_name', 'VARCHAR(256)'),
+              ('gender', 'VARCHAR(64)'),
+              ('level', 'VARCHAR(64)')],
+    # level history (slowly changing dimension, type 2): a row per period a user kept
+    # a level, from the ts of the event that started it to the ts of the next period
+    # (valid_to, exclusive, NULL for the current level)
+    'user_levels': [('user_id', 'INT'),
+                    ('first_name', 'VARCHAR(256)'),
+                    ('last_name', 'VARCHAR(256)'),
+                    ('gender', 'VARCHAR(64)'),
+                    ('level', 'VARCHAR(64)'),
+                    ('valid_from', 'BIGINT'),
+                    ('valid_to', 'BIGINT')],
+    'songs': [('song_id', 'VARCHAR(30) PRIMARY KEY'),
+              ('artist_id', 'VARCHAR'),
+              ('title', 'VARCHAR(512)'),
+              ('year', 'INT'),
+              ('duration', 'REAL')],
+    'artists': [('artist_id', 'VARCHAR PRIMARY KEY'),
+                ('artist_name', 'VARCHAR(512)'),
+                ('artist_location', 'VARCHAR(512)'),
+                ('artist_latitude', 'REAL'),
+                ('artist_longitude', 'REAL')],
+    # calendar generated for the range of events.ts, one row per TIME_GRAIN period
+    # (see time_dimension.py), time_key numbers the periods since the epoch
+    'time': [('time_key', 'INT PRIMARY KEY'),
+             ('start_time', 'TIMESTAMP'),
+             ('hour', 'INT'),
+             ('day', 'INT'),
+             ('week', 'INT'),
+             ('month', 'INT'),
+             ('year', 'INT'),
+             ('weekday', 'INT')],
+    # play counts per hour, kept up to date by etl.py for the play volume queries
+    'songplays_by_hour': [('year', 'INT'),
+                          ('month', 'INT'),
+                          ('week', 'INT'),
+                          ('day', 'INT'),
+                          ('hour', 'INT'),
+                          ('weekday', 'INT'),
+                          ('songplay_count', 'BIGINT')]}
+
+# Per table: diststyle (EVEN, KEY, ALL or AUTO), distkey, sortkey columns (or 'AUTO')
+# and encode, a {column: encoding} dict or 'by_type' (see _get_column_encoding).
+# 'none' is the original DDL.  'star' co-locates songplays with songs, the largest dimension,
+# copies the small dimensions to every node and sorts on the join / filter columns.
+physical_profiles = {
+    'none': {},
+    'star': {
+        'songplays': {'diststyle': 'KEY', 'distkey': 'song_id', 'sortkey': ['start_time'],
+                      'encode': 'by_type'},
+        'songs': {'diststyle': 'KEY', 'distkey': 'song_id', 'sortkey': ['song_id'],
+                  'encode': 'by_type'},
+        'users': {'diststyle': 'ALL', 'sortkey': ['user_id'], 'encode': 'by_type'},
+        'user_levels': {'diststyle': 'ALL', 'sortkey': ['user_id', 'valid_from'],
+                        'encode': 'by_type'},
+        'artists': {'diststyle': 'ALL', 'sortkey': ['artist_id'], 'encode': 'by_type'},
+        'time': {'diststyle': 'ALL', 'sortkey': ['time_key'], 'encode': 'by_type'},
+        'songplays_by_hour': {'diststyle': 'ALL', 'sortkey': ['year', 'month', 'day', 'hour'],
+                              'encode': 'by_type'}},
+    'auto': {table: {'diststyle': 'AUTO', 'sortkey': 'AUTO'} for table in table_columns}}
+
+# profile create_tables.py uses, unless PHYSICAL_PROFILE in the CLUSTER section of dwh.cfg
+# names another one
+DEFAULT_PHYSICAL_PROFILE = 'star'
+
+# grain of the time dimension, songplays.time_key is the number of the period since the epoch.
+# The time rows carry the hour of their period (the hourly sample query and songplays_by_hour
+# group by it), so no grain is coarser than an hour
+TIME_GRAINS = {'second': 1, 'minute': 60, 'hour': 3600}
+DEFAULT_TIME_GRAIN = 'hour'
+
+
+def get_physical_profile() -> str:
+    """ The physical design profile of the fact and dimension tables (dwh.cfg) """
+
+    return utilities.get_config_value("CLUSTER", "PHYSICAL_PROFILE", DEFAULT_PHYSICAL_PROFILE)
+
+
+def get_time_grain() -> str:
+    """ The grain of the time dimension (TIME_GRAIN in the ETL section of dwh.cfg),
+    raises ValueError if it is not one of TIME_GRAINS """
+
+    time_grain = utilities.get_config_value("ETL", "TIME_GRAIN", DEFAULT_TIME_GRAIN)
+    if time_grain not in TIME_GRAINS:
+        raise ValueError(f"time_grain {time_grain} in dwh.cfg is not supported, expected " +
+                         "one of " + ', '.join(TIME_GRAINS))
+    return time_grain
+
+
+def get_time_grain_ms() -> int:
+    """ Milliseconds of a time dimension period """
+
+    return TIME_GRAINS[get_time_grain()] * 1000
+
+
+def get_copy_max_errors() -> int:
+    """ Error budget of each staging COPY: how many records it may reject (they are
+    quarantined in etl_load_errors) before the COPY fails (ETL section of dwh.cfg) """
+
+    return utilities.get_config_value("ETL", "COPY_MAX_ERRORS", 0)
+
+
+def _get_column_encoding(column_type: str) -> str:
+    """ Redshift encoding for a column type: AZ64 for integers and timestamps, ZSTD for the rest """
+
+    if column_type.split()[0] in ('INT', 'BIGINT', 'SMALLINT', 'TIMESTAMP'):
+        return 'AZ64'
+    return 'ZSTD'
+
+
+def get_create_table_query(table: str, profile: str = None, table_name: str = None) -> str:
+    """ CREATE TABLE for a table in table_columns, with the physical design of the profile
+    (the one of dwh.cfg by default).  table_name, if given, is used instead of the table's
+    own name """
+
+    if profile is None:
+        profile = get_physical_profile()
+    design = physical_profiles[profile].get(table, {})
+    encode = design.get('encode', {})
+    sortkey = design.get('sortkey', [])
+
+    columns = []
+    for column, column_type in table_columns[table]:
+        if encode == 'by_type':
+            # sort key columns are left raw, so zone maps stay effective
+            encoding = 'RAW' if column in sortkey else _get_column_encoding(column_type)
+        else:
+            encoding = encode.get(column)
+        if encoding:
+            # ENCODE goes after the data type (and IDENTITY), before the constraints
+            column_type = re.sub(r'^(\S+(\s+IDENTITY\([^)]*\))?)', f"\\1 ENCODE {encoding}",
+                                 column_type)
+        columns.append(f"        {column} {column_type}")
+
+    query = f"""
+    CREATE TABLE {table_name or table} (
+""" + ',\n'.join(columns) + """
+    )"""
+
+    if 'diststyle' in design:
+        query += f"\n    DISTSTYLE {design['diststyle']}"
+    if 'distkey' in design:
+        query += f"\n    DISTKEY({design['distkey']})"
+    if sortkey == 'AUTO':
+        query += "\n    SORTKEY AUTO"
+    elif sortkey:
+        query += f"\n    SORTKEY({', '.join(sortkey)})"
+
+    return query + ';'
+
+
+# used by physical_design.py to benchmark the profiles side by side, each in its own schema
+PROFILE_SCHEMA_DROP = "DROP SCHEMA IF EXISTS {} CASCADE;"
+PROFILE_SCHEMA_CREATE = "CREATE SCHEMA {};"
+PROFILE_TABLE_COPY = "INSERT INTO {}.{} ({}) SELECT {} FROM {};"
+SEARCH_PATH_SET = "SET search_path TO {};"
+RESULT_CACHE_DISABLE = "SET enable_result_cache_for_session TO off;"
+
+# one row per user, with the current level, formatted with the schema prefix of the view
+# and of user_levels ('' or e.g. 'profile_star.')
+USERS_CURRENT_VIEW = """
+    CREATE VIEW {}users_current AS
+    SELECT
+        user_id, first_name, last_name, gender, level, valid_from AS level_since
+    FROM {}user_levels
+    WHERE valid_to is NULL;"""
+
+USERS_CURRENT_VIEW_CREATE = USERS_CURRENT_VIEW.format('', '')
+
+# ETL control tables, used by incremental loads to know what has already been loaded
+# (high_water_mark is the max staging_events.ts loaded, NULL for sources without one)
+ETL_WATERMARKS_TABLE_CREATE = """
+    CREATE TABLE etl_watermarks (
+        source VARCHAR(64) PRIMARY KEY,
+        high_water_mark BIGINT,
+        updated_at TIMESTAMP DEFAULT GETDATE()
+    );"""
+
+ETL_LOADED_FILES_TABLE_CREATE = """
+    CREATE TABLE etl_loaded_files (
+        source VARCHAR(64),
+        s3_key VARCHAR(1024),
+        loaded_at TIMESTAMP DEFAULT GETDATE()
+    );"""
+
+# one row per step of an etl.py run (see run_journal.py), status is running, completed
+# or failed, times are milliseconds since the epoch, detail is the error of a failed step.
+# The step named run is the run itself, its detail the load mode
+ETL_RUN_JOURNAL_TABLE_CREATE = """
+    CREATE TABLE etl_run_journal (
+        run_id BIGINT,
+        step VARCHAR(1024),
+        status VARCHAR(16),
+        attempts INT,
+        started_at BIGINT,
+        finished_at BIGINT,
+        row_count BIGINT,
+        detail VARCHAR(1024),
+        query_id BIGINT
+    );"""
+
+# quarantine of the records the staging loads of a run rejected (see load_errors.py),
+# raw_line is only known for local loads
+ETL_LOAD_ERRORS_TABLE_CREATE = """
+    CREATE TABLE etl_load_errors (
+        run_id BIGINT,
+        rejected_at TIMESTAMP,
+        file_name VARCHAR(1024),
+        line_number BIGINT,
+        column_name VARCHAR(256),
+        reason VARCHAR(1024),
+        raw_line VARCHAR(1024)
     );"""
 
 # STAGING TABLES
@@ -116,6 +411,7 @@ STAGING_EVENTS_COPY = """
         FROM '{}'
         CREDENTIALS 'aws_iam_role={}'
         FORMAT AS JSON '{}'
+        MAXERROR {}
         compupdate off region '{}';
 """
 
@@ -124,243 +420,975 @@ STAGING_SONGS_COPY = """
         FROM '{}'
         CREDENTIALS 'aws_iam_role={}'
         FORMAT AS JSON 'auto'
+        MAXERROR {}
+        compupdate off region '{}';
+"""
+
+# the files to load are listed in a manifest (see manifests.py)
+STAGING_SONGS_MANIFEST_COPY = """
+    COPY staging_songs 
+        FROM '{}'
+        CREDENTIALS 'aws_iam_role={}'
+        FORMAT AS JSON 'auto'
+        MANIFEST
+        MAXERROR {}
         compupdate off region '{}';
 """
 
+# JSON fields in the column order of the staging tables (as in log_json_path.json),
+# for loads that do not go through Redshift's COPY from S3
+STAGING_EVENTS_JSON_FIELDS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession',
+                              'lastName', 'length', 'level', 'location', 'method', 'page',
+                              'registration', 'sessionId', 'song', 'status', 'ts',
+                              'userAgent', 'userId']
+STAGING_SONGS_JSON_FIELDS = ['song_id', 'num_songs', 'title', 'artist_name', 'artist_latitude',
+                             'year', 'duration', 'artist_id', 'artist_longitude',
+                             'artist_location']
+
+# fields loaded into INT / BIGINT columns, e.g. logged out events have userId ""
+# and registration is written as a float
+STAGING_INTEGER_JSON_FIELDS = ['itemInSession', 'registration', 'sessionId', 'status', 'ts',
+                               'userId', 'num_songs', 'year']
+
+# client side loads (see stdin_loader.py), rows are sent in PostgreSQL text format
+# in the column order of the staging tables
+
+STAGING_EVENTS_COPY_STDIN = """
+    COPY staging_events (
+        artist, auth, firstName, gender, iteminSession, lastName, length, level, location,
+        method, page, registration, sessionId, song, status, ts, userAgent, userId)
+    FROM STDIN;
+"""
+
+STAGING_SONGS_COPY_STDIN = """
+    COPY staging_songs (
+        song_id, num_songs, title, artist_name, artist_latitude, year, duration,
+        artist_id, artist_longitude, artist_location)
+    FROM STDIN;
+"""
+
+# MATCH KEYS
+# Events are matched to songs on a 64 bit hash of the title and artist name, ignoring
+# case and surrounding or repeated whitespace, instead of comparing both VARCHARs
+
+
+def _normalize(column: str) -> str:
+    """ SQL for a title / artist name in lower case with its whitespace collapsed """
+
+    return f"LOWER(TRIM(REGEXP_REPLACE({column}, '[[:space:]]+', ' ')))"
+
+
+def get_match_key(title_column: str, artist_column: str) -> str:
+    """ SQL for the match key of a title and artist name """
+
+    return f"FNV_HASH({_normalize(title_column)} || '|' || {_normalize(artist_column)})"
+
+
+STAGING_EVENTS_KEYED_TRUNCATE = "TRUNCATE staging_events_keyed;"
+STAGING_SONGPLAYS_TRUNCATE = "TRUNCATE staging_songplays;"
+
+STAGING_EVENTS_KEYED_INSERT = f"""
+    INSERT INTO staging_events_keyed (
+        match_key, ts, userId, level, sessionId, location, userAgent)
+    SELECT
+        {get_match_key('se.song', 'se.artist')},
+        se.ts, se.userId, se.level, se.sessionId, se.location, se.userAgent
+    FROM staging_events se
+    WHERE se.userId is not NULL and se.song is not NULL and se.artist is not NULL;
+"""
+
+# staging_songs_keyed accumulates like staging_songs, only songs new to it are keyed
+STAGING_SONGS_KEYED_INSERT = f"""
+    INSERT INTO staging_songs_keyed (
+        match_key, song_id, artist_id)
+    SELECT
+        {get_match_key('ss.title', 'ss.artist_name')},
+        ss.song_id, ss.artist_id
+    FROM staging_songs ss
+    WHERE ss.title is not NULL and ss.artist_name is not NULL
+    AND NOT EXISTS (
+        SELECT 1 FROM staging_songs_keyed sk WHERE sk.song_id = ss.song_id);
+"""
+
+# match report (etl.py --match-report), the exact VARCHAR join versus the match key join
+MATCH_EVENTS_COUNT = "SELECT COUNT(*) FROM staging_events_keyed;"
+
+EXACT_MATCHED_EVENTS_COUNT = """
+    SELECT COUNT(*)
+    FROM staging_events se
+    WHERE se.userId is not NULL and se.song is not NULL and se.artist is not NULL
+    AND EXISTS (
+        SELECT 1 FROM staging_songs ss
+        WHERE se.song = ss.title and se.artist = ss.artist_name);
+"""
+
+KEYED_MATCHED_EVENTS_COUNT = """
+    SELECT COUNT(*)
+    FROM staging_events_keyed se
+    WHERE EXISTS (
+        SELECT 1 FROM staging_songs_keyed ss WHERE ss.match_key = se.match_key);
+"""
+
+EXACT_MATCH_JOIN = """
+    SELECT COUNT(*)
+    FROM staging_events se, staging_songs ss
+    WHERE se.song = ss.title and se.artist = ss.artist_name and se.userId is not NULL;
+"""
+
+KEYED_MATCH_JOIN = """
+    SELECT COUNT(*)
+    FROM staging_events_keyed se
+    JOIN staging_songs_keyed ss ON se.match_key = ss.match_key;
+"""
+
 # FINAL TABLES
 
+STAGING_SONGPLAYS_INSERT = """
+    INSERT INTO staging_songplays ( 
+        start_time, time_key, user_id, level, song_id,   
+        artist_id, session_id, location, user_agent)
+    SELECT
+        se.ts, CAST(FLOOR(se.ts / %(time_grain_ms)s) AS INT), se.userId, se.level, ss.song_id,
+        ss.artist_id, se.sessionId, se.location, se.userAgent
+    FROM (
+        SELECT match_key, ts, userId, level, sessionId, location, userAgent
+        FROM staging_events_keyed
+        UNION ALL
+        SELECT match_key, ts, userId, level, sessionId, location, userAgent
+        FROM songplays_pending) se
+    JOIN staging_songs_keyed ss ON se.match_key = ss.match_key;
+"""
+
 SONGPLAYS_TABLE_INSERT = """
     INSERT INTO songplays ( 
-        start_time, user_id, level, song_id,   
+        start_time, time_key, user_id, level, song_id,   
         artist_id, session_id, location, user_agent)
     SELECT
-        se.ts, se.userId, se.level, ss.song_id,
-        ss.artist_id, se.sessionId, se.location, se.userAgent
-    FROM staging_events se, staging_songs ss
-    WHERE se.song = ss.title and se.artist = ss.artist_name and se.userId is not NULL;
+        start_time, time_key, user_id, level, song_id,
+        artist_id, session_id, location, user_agent
+    FROM staging_songplays;
 """
 
-USERS_TABLE_INSERT = """
-    INSERT INTO users (
-        user_id, first_name, last_name, gender, level)
-    SELECT DISTINCT
-        userId, firstName, lastName, gender, level
-    FROM staging_events
-    WHERE userId is not NULL;
+# UNMATCHED EVENTS
+# New events without a song are kept in songplays_pending.  songplays matches the new
+# events and the pending ones, so the pending events that matched are retired afterwards
+
+SONGPLAYS_PENDING_DELETE = """
+    DELETE FROM songplays_pending
+    WHERE EXISTS (
+        SELECT 1 FROM staging_songs_keyed ss
+        WHERE ss.match_key = songplays_pending.match_key);
 """
 
-SONGS_TABLE_INSERT = """
-    INSERT INTO songs (
-        song_id, artist_id, title, year, duration)
-    SELECT 
-        song_id, artist_id, title, year, duration 
-    FROM staging_songs;
+SONGPLAYS_PENDING_INSERT = """
+    INSERT INTO songplays_pending (
+        match_key, ts, userId, level, sessionId, location, userAgent)
+    SELECT
+        se.match_key, se.ts, se.userId, se.level, se.sessionId, se.location, se.userAgent
+    FROM staging_events_keyed se
+    WHERE NOT EXISTS (
+        SELECT 1 FROM staging_songs_keyed ss WHERE ss.match_key = se.match_key);
 """
 
-ARTISTS_TABLE_INSERT = """
-    INSERT INTO artists (
-        artist_id, artist_name, artist_location, artist_latitude, artist_longitude)
-    SELECT DISTINCT
-        artist_id, artist_name, artist_location, artist_latitude, artist_longitude
-    FROM staging_songs; 
-    """
+SONGPLAYS_PENDING_COUNT = "SELECT COUNT(*) FROM songplays_pending;"
+STAGING_SONGPLAYS_COUNT = "SELECT COUNT(*) FROM staging_songplays;"
+
+# PLAY VOLUME ROLLUP
+# The songplays of the run, counted per hour, are added to the hours songplays_by_hour
+# already has, and the other hours are inserted
+
+_NEW_SONGPLAYS_BY_HOUR = """
+        SELECT
+            t.year, t.month, t.week, t.day, t.hour, t.weekday, COUNT(*) AS songplay_count
+        FROM staging_songplays sp
+        JOIN time t ON sp.time_key = t.time_key
+        GROUP BY t.year, t.month, t.week, t.day, t.hour, t.weekday"""
+
+SONGPLAYS_BY_HOUR_UPDATE = f"""
+    UPDATE songplays_by_hour
+    SET songplay_count = songplays_by_hour.songplay_count + hourly.songplay_count
+    FROM ({_NEW_SONGPLAYS_BY_HOUR}) hourly
+    WHERE songplays_by_hour.year = hourly.year and songplays_by_hour.month = hourly.month
+    and songplays_by_hour.day = hourly.day and songplays_by_hour.hour = hourly.hour;
+"""
+
+SONGPLAYS_BY_HOUR_INSERT = f"""
+    INSERT INTO songplays_by_hour (
+        year, month, week, day, hour, weekday, songplay_count)
+    SELECT
+        hourly.year, hourly.month, hourly.week, hourly.day, hourly.hour, hourly.weekday,
+        hourly.songplay_count
+    FROM ({_NEW_SONGPLAYS_BY_HOUR}) hourly
+    WHERE NOT EXISTS (
+        SELECT 1 FROM songplays_by_hour h
+        WHERE h.year = hourly.year and h.month = hourly.month
+        and h.day = hourly.day and h.hour = hourly.hour);
+"""
 
-TIME_TABLE_INSERT = """
+# USER LEVEL HISTORY
+# A new level period starts at each event whose level differs from the user's previous
+# event.  The new events are read together with the periods their users already have
+# (each one the event that started it), so an event from a late or backfilled file lands
+# in its place in the history.  staging_user_levels holds the periods that changed: the
+# new ones and the ones whose end moved.  The periods a changed period now covers are
+# removed (user_levels_retire, when a late event started their level earlier), the ends
+# are moved (user_levels_close) and the new periods are added (user_levels_add)
+
+STAGING_USER_LEVELS_INSERT = """
+    INSERT INTO staging_user_levels (
+        user_id, first_name, last_name, gender, level, valid_from, valid_to)
+    SELECT
+        periods.user_id, periods.first_name, periods.last_name, periods.gender,
+        periods.level, periods.valid_from, periods.valid_to
+    FROM (
+        SELECT
+            user_id, first_name, last_name, gender, level, ts AS valid_from,
+            LEAD(ts) OVER (PARTITION BY user_id ORDER BY ts) AS valid_to
+        FROM (
+            SELECT
+                user_id, first_name, last_name, gender, level, ts,
+                LAG(level) OVER (PARTITION BY user_id ORDER BY ts) AS previous_level
+            FROM (
+                SELECT
+                    se.userId AS user_id, se.firstName AS first_name,
+                    se.lastName AS last_name, se.gender, se.level, se.ts
+                FROM staging_events se
+                WHERE se.userId is not NULL
+                UNION ALL
+                SELECT
+                    ul.user_id, ul.first_name, ul.last_name, ul.gender, ul.level,
+                    ul.valid_from
+                FROM user_levels ul
+                WHERE ul.user_id IN (SELECT userId FROM staging_events)) events
+            ) changes
+        WHERE previous_level is NULL or previous_level <> level) periods
+    WHERE NOT EXISTS (
+        SELECT 1 FROM user_levels ul
+        WHERE ul.user_id = periods.user_id and ul.valid_from = periods.valid_from
+        and (ul.valid_to = periods.valid_to
+             or (ul.valid_to is NULL and periods.valid_to is NULL)));
+"""
+
+STAGING_USER_LEVELS_TRUNCATE = "TRUNCATE staging_user_levels;"
+STAGING_USER_LEVELS_COUNT = "SELECT COUNT(*) FROM staging_user_levels;"
+
+USER_LEVELS_RETIRE = """
+    DELETE FROM user_levels
+    WHERE EXISTS (
+        SELECT 1 FROM staging_user_levels periods
+        WHERE periods.user_id = user_levels.user_id
+        and periods.valid_from < user_levels.valid_from
+        and (periods.valid_to is NULL or user_levels.valid_from < periods.valid_to));
+"""
+
+USER_LEVELS_CLOSE = """
+    UPDATE user_levels
+    SET valid_to = periods.valid_to
+    FROM staging_user_levels periods
+    WHERE user_levels.user_id = periods.user_id
+    and user_levels.valid_from = periods.valid_from;
+"""
+
+USER_LEVELS_INSERT = """
+    INSERT INTO user_levels (
+        user_id, first_name, last_name, gender, level, valid_from, valid_to)
+    SELECT
+        periods.user_id, periods.first_name, periods.last_name, periods.gender,
+        periods.level, periods.valid_from, periods.valid_to
+    FROM staging_user_levels periods
+    WHERE NOT EXISTS (
+        SELECT 1 FROM user_levels ul
+        WHERE ul.user_id = periods.user_id and ul.valid_from = periods.valid_from);
+"""
+
+# DIMENSION UPSERTS
+# A staging row may be loaded more than once (a file copied again, an artist in many song
+# files, a user in many events), so the latest version of each key is picked with
+# ROW_NUMBER() and compared to the dimension row, then written to a staging_*_changes table
+# as an insert, an update or unchanged.  The update and insert steps apply the changes
+# (what a MERGE would do), unchanged rows are not touched, and dimensions.py reports the
+# counts.  Re-running a load therefore does not duplicate the dimensions
+
+
+def _get_changed_condition(columns: list, new: str, old: str) -> str:
+    """ True when any of the columns differs between the two rows, NULLs compare equal """
+
+    conditions = [f"{new}.{column} <> {old}.{column}"
+                  f" OR ({new}.{column} is NULL AND {old}.{column} is not NULL)"
+                  f" OR ({new}.{column} is not NULL AND {old}.{column} is NULL)"
+                  for column in columns]
+    return '\n            OR '.join(conditions)
+
+
+def _get_dimension_changes_insert(table: str, key: str, columns: list, versions: str,
+                                  latest_first: str) -> str:
+    """ Insert into staging_<table>_changes of the latest version of each key
+    (the first by latest_first) of the versions subquery """
+
+    changes_table = f"staging_{table[:-1]}_changes"
+    column_list = ', '.join([key] + columns)
+    new_columns = ', '.join(f"latest.{column}" for column in [key] + columns)
+
+    return f"""
+    INSERT INTO {changes_table} (
+        {column_list}, change_type)
+    SELECT
+        {new_columns},
+        CASE WHEN dim.{key} is NULL THEN 'insert'
+            WHEN {_get_changed_condition(columns, 'latest', 'dim')}
+            THEN 'update'
+            ELSE 'unchanged' END
+    FROM (
+        SELECT
+            {column_list},
+            ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY {latest_first}) AS version
+        FROM ({versions}) versions) latest
+    LEFT JOIN {table} dim ON dim.{key} = latest.{key}
+    WHERE latest.version = 1;
+"""
+
+
+def _get_dimension_update(table: str, key: str, columns: list) -> str:
+    """ Update of the dimension rows whose latest version changed """
+
+    assignments = ',\n        '.join(f"{column} = changes.{column}" for column in columns)
+
+    return f"""
+    UPDATE {table}
+    SET {assignments}
+    FROM staging_{table[:-1]}_changes changes
+    WHERE {table}.{key} = changes.{key}
+    and changes.change_type = 'update';
+"""
+
+
+def _get_dimension_insert(table: str, key: str, columns: list) -> str:
+    """ Insert of the dimension rows with a new key """
+
+    column_list = ', '.join([key] + columns)
+
+    return f"""
+    INSERT INTO {table} (
+        {column_list})
+    SELECT
+        {column_list}
+    FROM staging_{table[:-1]}_changes changes
+    WHERE changes.change_type = 'insert';
+"""
+
+
+USER_COLUMNS = ['first_name', 'last_name', 'gender', 'level']
+SONG_COLUMNS = ['artist_id', 'title', 'year', 'duration']
+ARTIST_COLUMNS = ['artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']
+
+
+def _get_user_changes_insert(new_events_filter: str) -> str:
+    """ Insert of the changes of the users with staging_events matching the filter,
+    a user's latest version is the one of their latest event """
+
+    return _get_dimension_changes_insert('users', 'user_id', USER_COLUMNS, f"""
+            SELECT
+                userId AS user_id, firstName AS first_name, lastName AS last_name,
+                gender, level, ts
+            FROM staging_events
+            WHERE userId is not NULL{new_events_filter}""", 'ts DESC')
+
+
+USER_CHANGES_INSERT = _get_user_changes_insert('')
+
+
+def _get_song_changes_insert(new_songs_filter: str) -> str:
+    """ Insert of the changes of the songs in staging_songs matching the filter.
+    The song files carry no version, copies of the same song are the same file,
+    so any version is the latest, the order only keeps the pick deterministic """
+
+    return _get_dimension_changes_insert('songs', 'song_id', SONG_COLUMNS, f"""
+            SELECT song_id, artist_id, title, year, duration
+            FROM staging_songs{new_songs_filter}""", 'year DESC, duration DESC, title, artist_id')
+
+
+def _get_artist_changes_insert(new_songs_filter: str) -> str:
+    """ Insert of the changes of the artists of the songs in staging_songs matching the
+    filter.  An artist is in the file of each of their songs, the most complete version
+    wins """
+
+    return _get_dimension_changes_insert('artists', 'artist_id', ARTIST_COLUMNS, f"""
+            SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+            FROM staging_songs{new_songs_filter}""",
+        "CASE WHEN artist_latitude is NULL THEN 1 ELSE 0 END, "
+        "CASE WHEN artist_location is NULL OR artist_location = '' THEN 1 ELSE 0 END, "
+        "artist_name, artist_location")
+
+
+SONG_CHANGES_INSERT = _get_song_changes_insert('')
+ARTIST_CHANGES_INSERT = _get_artist_changes_insert('')
+
+# staging_songs.dimensions_loaded is NULL until songs and artists were upserted from the
+# row, so an incremental run only reads the songs it loaded
+STAGING_SONGS_DIMENSIONS_LOADED_UPDATE = """
+    UPDATE staging_songs SET dimensions_loaded = TRUE
+    WHERE dimensions_loaded is NULL;
+"""
+
+USERS_TABLE_UPDATE = _get_dimension_update('users', 'user_id', USER_COLUMNS)
+USERS_TABLE_INSERT = _get_dimension_insert('users', 'user_id', USER_COLUMNS)
+SONGS_TABLE_UPDATE = _get_dimension_update('songs', 'song_id', SONG_COLUMNS)
+SONGS_TABLE_INSERT = _get_dimension_insert('songs', 'song_id', SONG_COLUMNS)
+ARTISTS_TABLE_UPDATE = _get_dimension_update('artists', 'artist_id', ARTIST_COLUMNS)
+ARTISTS_TABLE_INSERT = _get_dimension_insert('artists', 'artist_id', ARTIST_COLUMNS)
+
+dimension_changes_tables = {'users': 'staging_user_changes',
+                            'songs': 'staging_song_changes',
+                            'artists': 'staging_artist_changes'}
+
+STAGING_CHANGES_TRUNCATE = "TRUNCATE {};"
+STAGING_CHANGES_COUNT = "SELECT change_type, COUNT(*) FROM {} GROUP BY change_type;"
+
+# the time dimension is generated by time_dimension.py for the periods of the events
+STAGING_EVENTS_TS_RANGE = "SELECT MIN(ts), MAX(ts) FROM staging_events;"
+
+_DIGITS = " UNION ALL ".join(f"SELECT {digit} AS digit" for digit in range(10))
+
+
+def get_time_table_fill_insert(digit_count: int) -> str:
+    """ Insert of the periods first_key to last_key (parameters) that the time table does
+    not have yet, with their calendar units.  The periods are numbered by a cross join of
+    digit_count tables of the digits 0-9, so the range may hold up to 10 ** digit_count
+    periods.  week is the ISO week and weekday counts from 0 = Sunday """
+
+    digit_tables = ',\n            '.join(f"({_DIGITS}) d{index}"
+                                          for index in range(digit_count))
+    offset = ' + '.join(f"d{index}.digit * {10 ** index}" for index in range(digit_count))
+
+    return f"""
     INSERT INTO time (
-        start_time, hour, day, week, month, year, weekday) 
-    SELECT DISTINCT
-        e.ts,
-        EXTRACT(HOUR    from TIMESTAMP 'epoch' + (e.ts / 1000) * INTERVAL '1 second') ,
-        EXTRACT(DAY     from TIMESTAMP 'epoch' + (e.ts / 1000) * INTERVAL '1 second') ,
-        EXTRACT(WEEK    from TIMESTAMP 'epoch' + (e.ts / 1000) * INTERVAL '1 second') ,
-        EXTRACT(MONTH   from TIMESTAMP 'epoch' + (e.ts / 1000) * INTERVAL '1 second') ,
-        EXTRACT(YEAR    from TIMESTAMP 'epoch' + (e.ts / 1000) * INTERVAL '1 second') ,
-        EXTRACT(WEEKDAY from TIMESTAMP 'epoch' + (e.ts / 1000) * INTERVAL '1 second')  
-    FROM staging_events e; """
+        time_key, start_time, hour, day, week, month, year, weekday)
+    SELECT
+        time_key,
+        start_time,
+        EXTRACT(HOUR FROM start_time),
+        EXTRACT(DAY FROM start_time),
+        EXTRACT(WEEK FROM start_time),
+        EXTRACT(MONTH FROM start_time),
+        EXTRACT(YEAR FROM start_time),
+        EXTRACT(WEEKDAY FROM start_time)
+    FROM (
+        SELECT
+            periods.time_key,
+            TIMESTAMP 'epoch' + periods.time_key * %(grain_seconds)s * INTERVAL '1 second'
+                AS start_time
+        FROM (
+            SELECT CAST(%(first_key)s AS BIGINT) + {offset} AS time_key
+            FROM {digit_tables}) periods
+        WHERE periods.time_key <= %(last_key)s
+        AND NOT EXISTS (
+            SELECT 1 FROM time t WHERE t.time_key = periods.time_key)) new_periods;"""
+
+
+# INCREMENTAL LOADS
+# Used when only new S3 files have been copied into staging.  staging_events then only
+# holds the events of the new files, whatever their time (a late or backfilled file
+# included), so the inserts read all of it, while staging_songs keeps accumulating so
+# every event can still be matched against the full song catalog.  The log_data
+# watermark in etl_watermarks only records the latest event time loaded.
+
+STAGING_EVENTS_TRUNCATE = "TRUNCATE staging_events;"
+STAGING_SONGS_TRUNCATE = "TRUNCATE staging_songs;"
+STAGING_SONGS_KEYED_TRUNCATE = "TRUNCATE staging_songs_keyed;"
+
+# an event older than the start of the user's latest level period (from a late file)
+# does not replace the newer version of the user
+USER_CHANGES_INCREMENTAL_INSERT = _get_user_changes_insert("""
+            AND NOT EXISTS (
+                SELECT 1 FROM user_levels ul
+                WHERE ul.user_id = staging_events.userId
+                and ul.valid_from > staging_events.ts)""")
+
+SONG_CHANGES_INCREMENTAL_INSERT = _get_song_changes_insert(
+    '\n            WHERE dimensions_loaded is NULL')
+
+ARTIST_CHANGES_INCREMENTAL_INSERT = _get_artist_changes_insert(
+    '\n            WHERE dimensions_loaded is NULL')
+
+# ETL CONTROL
+
+STAGING_EVENTS_MAX_TS = "SELECT MAX(ts) FROM staging_events;"
+
+WATERMARK_SELECT = "SELECT high_water_mark FROM etl_watermarks WHERE source = %s;"
+WATERMARK_DELETE = "DELETE FROM etl_watermarks WHERE source = %s;"
+WATERMARK_INSERT = "INSERT INTO etl_watermarks (source, high_water_mark) VALUES (%s, %s);"
+
+LOADED_FILES_SELECT = "SELECT s3_key FROM etl_loaded_files WHERE source = %s;"
+LOADED_FILES_INSERT = "INSERT INTO etl_loaded_files (source, s3_key) VALUES %s;"
+LOADED_FILES_ROW_INSERT = "INSERT INTO etl_loaded_files (source, s3_key) VALUES (%s, %s);"
+LOADED_FILES_DELETE = "DELETE FROM etl_loaded_files WHERE source = %s;"
+
+# the load errors of the COPYs with the given query ids (Redshift's sys_load_error_detail),
+# the ids the run journal recorded for the run's COPYs, quarantined in etl_load_errors
+LOAD_ERROR_DETAIL_SELECT = """
+    SELECT
+        start_time, TRIM(file_name), line_number, TRIM(column_name), TRIM(error_message)
+    FROM sys_load_error_detail
+    WHERE query_id IN %s
+    ORDER BY start_time, file_name, line_number;"""
+LOAD_ERRORS_INSERT = """
+    INSERT INTO etl_load_errors (
+        run_id, rejected_at, file_name, line_number, column_name, reason, raw_line)
+    VALUES %s;"""
+LOAD_ERRORS_ROW_INSERT = """
+    INSERT INTO etl_load_errors (
+        run_id, rejected_at, file_name, line_number, column_name, reason, raw_line)
+    VALUES (%s, %s, %s, %s, %s, %s, %s);"""
+LOAD_ERRORS_SUMMARY = """
+    SELECT file_name, COUNT(*), MIN(reason)
+    FROM etl_load_errors
+    WHERE run_id = %s
+    GROUP BY file_name
+    ORDER BY COUNT(*) DESC, file_name;"""
+
+LAST_RUN_SELECT = """
+    SELECT run_id, status, attempts, detail FROM etl_run_journal
+    WHERE step = 'run'
+    ORDER BY run_id DESC
+    LIMIT 1;"""
+COMPLETED_STEPS_SELECT = """
+    SELECT step FROM etl_run_journal
+    WHERE run_id = %s and status = 'completed';"""
+JOURNAL_STEP_DELETE = "DELETE FROM etl_run_journal WHERE run_id = %s and step = %s;"
+JOURNAL_STEP_INSERT = """
+    INSERT INTO etl_run_journal (
+        run_id, step, status, attempts, started_at, finished_at, row_count, detail, query_id)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);"""
+RUN_QUERY_IDS_SELECT = """
+    SELECT query_id FROM etl_run_journal
+    WHERE run_id = %s and query_id IS NOT NULL;"""
+
+# the Redshift query id of the last statement of the session and the bytes read by the
+# scan steps of statements, for the spans of metrics.py (run unrewritten, Redshift only)
+LAST_QUERY_ID_SELECT = "SELECT pg_last_query_id();"
+QUERY_BYTES_SCANNED_SELECT = """
+    SELECT query_id, SUM(input_bytes)
+    FROM sys_query_detail
+    WHERE query_id IN %s AND step_name = 'scan'
+    GROUP BY query_id;"""
 
 
 # QUERY LISTS
 
-create_table_queries = [STAGING_EVENTS_TABLE_CREATE,
-                        STAGING_SONGS_TABLE_CREATE,
-                        SONGPLAYS_TABLE_CREATE,
-                        USERS_TABLE_CREATE,
-                        SONGS_TABLE_CREATE,
-                        ARTISTS_TABLE_CREATE,
-                        TIME_TABLE_CREATE]
+
+
+def get_create_table_queries() -> list:
+    """ The CREATE TABLE queries of all the tables, the fact and dimension tables with the
+    physical design profile of dwh.cfg """
+
+    return [STAGING_EVENTS_TABLE_CREATE,
+            STAGING_SONGS_TABLE_CREATE,
+            STAGING_EVENTS_KEYED_TABLE_CREATE,
+            STAGING_SONGS_KEYED_TABLE_CREATE,
+            SONGPLAYS_PENDING_TABLE_CREATE,
+            STAGING_SONGPLAYS_TABLE_CREATE,
+            STAGING_USER_LEVELS_TABLE_CREATE,
+            STAGING_USER_CHANGES_TABLE_CREATE,
+            STAGING_SONG_CHANGES_TABLE_CREATE,
+            STAGING_ARTIST_CHANGES_TABLE_CREATE,
+            get_create_table_query('songplays'),
+            get_create_table_query('users'),
+            get_create_table_query('user_levels'),
+            USERS_CURRENT_VIEW_CREATE,
+            get_create_table_query('songs'),
+            get_create_table_query('artists'),
+            get_create_table_query('time'),
+            get_create_table_query('songplays_by_hour'),
+            ETL_WATERMARKS_TABLE_CREATE,
+            ETL_LOADED_FILES_TABLE_CREATE,
+            ETL_RUN_JOURNAL_TABLE_CREATE,
+            ETL_LOAD_ERRORS_TABLE_CREATE]
+
 
 drop_table_queries = [STAGING_EVENTS_TABLE_DROP,
                       STAGING_SONGS_TABLE_DROP,
+                      STAGING_EVENTS_KEYED_TABLE_DROP,
+                      STAGING_SONGS_KEYED_TABLE_DROP,
+                      SONGPLAYS_PENDING_TABLE_DROP,
+                      STAGING_SONGPLAYS_TABLE_DROP,
+                      STAGING_USER_LEVELS_TABLE_DROP,
+                      STAGING_USER_CHANGES_TABLE_DROP,
+                      STAGING_SONG_CHANGES_TABLE_DROP,
+                      STAGING_ARTIST_CHANGES_TABLE_DROP,
                       SONGPLAYS_TABLE_DROP,
                       USERS_TABLE_DROP,
+                      USERS_CURRENT_VIEW_DROP,
+                      USER_LEVELS_TABLE_DROP,
                       SONGS_TABLE_DROP,
                       ARTISTS_TABLE_DROP,
-                      TIME_TABLE_DROP]
+                      TIME_TABLE_DROP,
+                      SONGPLAYS_BY_HOUR_TABLE_DROP,
+                      ETL_WATERMARKS_TABLE_DROP,
+                      ETL_LOADED_FILES_TABLE_DROP,
+                      ETL_RUN_JOURNAL_TABLE_DROP,
+                      ETL_LOAD_ERRORS_TABLE_DROP]
 
 copy_table_queries = [STAGING_EVENTS_COPY,
                       STAGING_SONGS_COPY]
 
-insert_table_queries = [SONGPLAYS_TABLE_INSERT,
-                        USERS_TABLE_INSERT,
-                        SONGS_TABLE_INSERT,
-                        ARTISTS_TABLE_INSERT,
-                        TIME_TABLE_INSERT]
+# BLUE / GREEN BUILDS
+# etl.py --shadow loads every table of a generation into <table>_next tables, built from
+# the same DDL, while readers keep using the current tables.  After validation the
+# tables are swapped by renames in one transaction, the replaced generation is kept as
+# <table>_previous (see blue_green.py)
 
+NEXT_SUFFIX = '_next'
+PREVIOUS_SUFFIX = '_previous'
 
-# Sample Queries
-SAMPLE_QUERY_USERS_WHO_USED_FREE_AND_PAID = """
-SELECT  
-    u.user_id 
-    AS users_who_used_both_free_and_paid
-    FROM users u
-    WHERE u.user_id in (SELECT s.user_id from users s where s.level = 'free')
-    AND u.level = 'paid';"""
+generation_tables = ['songplays', 'songplays_pending', 'songplays_by_hour', 'users',
+                     'user_levels', 'songs', 'artists', 'time']
 
+# control tables whose rows belong to a generation, a swap keeps the rows of the
+# replaced generation in <table>_previous for a rollback to restore
+generation_control_tables = ['etl_watermarks', 'etl_loaded_files']
 
-SAMPLE_QUERY_TYPES_OF_USERS = """
-SELECT
-    COUNT(*) AS user_record_count,
+# tables a valid generation can not have empty
+required_generation_tables = ['songplays', 'users', 'user_levels', 'songs', 'artists', 'time']
 
-    (SELECT COUNT(*) 
-    FROM (
-        SELECT DISTINCT 
-        user_id, first_name, last_name, gender, level  
-        FROM users)) 
-    AS unique_users_levels_count, 
+# tables a valid generation can have fewer rows in than the current one: songplays
+# still waiting for their song shrink as the songs arrive
+shrinking_generation_tables = ['songplays_pending']
 
-    (SELECT COUNT(*) 
-    FROM (
-        SELECT DISTINCT 
-        user_id, first_name, last_name, gender
-        FROM users)) 
-    AS users_count, 
- 
-    (SELECT COUNT(*) 
-    FROM (
-        SELECT DISTINCT user_id 
-        FROM users
-        WHERE level = 'free')) 
-    AS free_users_count,
 
-    (SELECT COUNT(*) 
-    FROM (
-        SELECT DISTINCT user_id 
-        FROM users
-        WHERE level = 'paid')) 
-    AS paid_users_count,
 
-    (SELECT COUNT(*) 
-    FROM (
-        SELECT DISTINCT u.user_id 
-        FROM users u
-        WHERE u.level = 'paid'
-        AND   u.user_id in  
-            (SELECT s.user_id from users s where s.level = 'free'))) 
-    AS users_both_free_and_paid_count, 
-
-    (SELECT COUNT(*) 
-    FROM (
-        SELECT DISTINCT user_id 
-        FROM users
-        WHERE level != 'free'
-        AND   level != 'paid')) 
-    AS userds_not_free_and_not_paid_count
+def get_generation_create_queries() -> list:
+    """ The CREATE TABLE queries of the tables of a generation """
+
+    return [get_create_table_query('songplays'),
+            SONGPLAYS_PENDING_TABLE_CREATE,
+            get_create_table_query('songplays_by_hour'),
+            get_create_table_query('users'),
+            get_create_table_query('user_levels'),
+            get_create_table_query('songs'),
+            get_create_table_query('artists'),
+            get_create_table_query('time')]
+
+
+# the shadow build starts from empty staging tables
+staging_truncate_queries = [STAGING_EVENTS_TRUNCATE,
+                            STAGING_SONGS_TRUNCATE,
+                            STAGING_EVENTS_KEYED_TRUNCATE,
+                            STAGING_SONGS_KEYED_TRUNCATE,
+                            STAGING_SONGPLAYS_TRUNCATE,
+                            STAGING_USER_LEVELS_TRUNCATE] + [
+                                STAGING_CHANGES_TRUNCATE.format(changes_table)
+                                for changes_table in dimension_changes_tables.values()]
+
+_GENERATION_TABLE = re.compile(r'\b(' + '|'.join(generation_tables) + r')\b')
+
 
-FROM users;"""
+def rename_generation_tables(query: str, suffix: str) -> str:
+    """ The query with the suffix added to every generation table it uses """
+
+    if not suffix:
+        return query
+    return _GENERATION_TABLE.sub(lambda match: match.group(1) + suffix, query)
+
+
+TABLE_DROP = "DROP TABLE IF EXISTS {};"
+TABLE_RENAME = "ALTER TABLE {} RENAME TO {};"
+TABLE_COUNT = "SELECT COUNT(*) FROM {};"
+TABLE_EXISTS = "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = %s;"
+TABLE_SNAPSHOT = "CREATE TABLE {} AS SELECT * FROM {};"
+TABLE_DELETE = "DELETE FROM {};"
+TABLE_RESTORE = "INSERT INTO {} SELECT * FROM {};"
+
+
+# TRANSFORM STEPS
+# Each insert declares the tables it reads (inputs) and writes (outputs),
+# so pipeline.py can run the steps that do not depend on each other at the same time.
+# Steps are listed in a valid serial order.  They run with a
+# {"time_grain_ms": <milliseconds of a time dimension period>} parameter dict.
+
+insert_table_steps = [
+    {'name': 'event_keys', 'query': STAGING_EVENTS_KEYED_INSERT,
+     'inputs': ['staging_events'], 'outputs': ['staging_events_keyed']},
+    {'name': 'song_keys', 'query': STAGING_SONGS_KEYED_INSERT,
+     'inputs': ['staging_songs', 'staging_songs_keyed'], 'outputs': ['staging_songs_keyed']},
+    {'name': 'new_songplays', 'query': STAGING_SONGPLAYS_INSERT,
+     'inputs': ['staging_events_keyed', 'songplays_pending', 'staging_songs_keyed'],
+     'outputs': ['staging_songplays']},
+    {'name': 'songplays', 'query': SONGPLAYS_TABLE_INSERT,
+     'inputs': ['staging_songplays'], 'outputs': ['songplays']},
+    {'name': 'pending_retire', 'query': SONGPLAYS_PENDING_DELETE,
+     'inputs': ['songplays_pending', 'staging_songs_keyed'], 'outputs': ['songplays_pending']},
+    {'name': 'pending_add', 'query': SONGPLAYS_PENDING_INSERT,
+     'inputs': ['staging_events_keyed', 'staging_songs_keyed'],
+     'outputs': ['songplays_pending']},
+    {'name': 'volume_update', 'query': SONGPLAYS_BY_HOUR_UPDATE,
+     'inputs': ['staging_songplays', 'time', 'songplays_by_hour'],
+     'outputs': ['songplays_by_hour']},
+    {'name': 'volume_insert', 'query': SONGPLAYS_BY_HOUR_INSERT,
+     'inputs': ['staging_songplays', 'time', 'songplays_by_hour'],
+     'outputs': ['songplays_by_hour']},
+    {'name': 'user_changes', 'query': USER_CHANGES_INSERT,
+     'inputs': ['staging_events', 'users'], 'outputs': ['staging_user_changes']},
+    {'name': 'users_update', 'query': USERS_TABLE_UPDATE,
+     'inputs': ['staging_user_changes', 'users'], 'outputs': ['users']},
+    {'name': 'users_insert', 'query': USERS_TABLE_INSERT,
+     'inputs': ['staging_user_changes', 'users'], 'outputs': ['users']},
+    {'name': 'user_periods', 'query': STAGING_USER_LEVELS_INSERT,
+     'inputs': ['staging_events', 'user_levels'], 'outputs': ['staging_user_levels']},
+    {'name': 'user_levels_retire', 'query': USER_LEVELS_RETIRE,
+     'inputs': ['staging_user_levels', 'user_levels'], 'outputs': ['user_levels']},
+    {'name': 'user_levels_close', 'query': USER_LEVELS_CLOSE,
+     'inputs': ['staging_user_levels', 'user_levels'], 'outputs': ['user_levels']},
+    {'name': 'user_levels_add', 'query': USER_LEVELS_INSERT,
+     'inputs': ['staging_user_levels', 'user_levels'], 'outputs': ['user_levels']},
+    {'name': 'song_changes', 'query': SONG_CHANGES_INSERT,
+     'inputs': ['staging_songs', 'songs'], 'outputs': ['staging_song_changes']},
+    {'name': 'songs_update', 'query': SONGS_TABLE_UPDATE,
+     'inputs': ['staging_song_changes', 'songs'], 'outputs': ['songs']},
+    {'name': 'songs_insert', 'query': SONGS_TABLE_INSERT,
+     'inputs': ['staging_song_changes', 'songs'], 'outputs': ['songs']},
+    {'name': 'artist_changes', 'query': ARTIST_CHANGES_INSERT,
+     'inputs': ['staging_songs', 'artists'], 'outputs': ['staging_artist_changes']},
+    {'name': 'artists_update', 'query': ARTISTS_TABLE_UPDATE,
+     'inputs': ['staging_artist_changes', 'artists'], 'outputs': ['artists']},
+    {'name': 'artists_insert', 'query': ARTISTS_TABLE_INSERT,
+     'inputs': ['staging_artist_changes', 'artists'], 'outputs': ['artists']},
+    {'name': 'songs_loaded', 'query': STAGING_SONGS_DIMENSIONS_LOADED_UPDATE,
+     'inputs': ['staging_songs'], 'outputs': ['staging_songs']}]
+
+incremental_insert_table_steps = [
+    {'name': 'event_keys', 'query': STAGING_EVENTS_KEYED_INSERT,
+     'inputs': ['staging_events'], 'outputs': ['staging_events_keyed']},
+    {'name': 'song_keys', 'query': STAGING_SONGS_KEYED_INSERT,
+     'inputs': ['staging_songs', 'staging_songs_keyed'], 'outputs': ['staging_songs_keyed']},
+    {'name': 'new_songplays', 'query': STAGING_SONGPLAYS_INSERT,
+     'inputs': ['staging_events_keyed', 'songplays_pending', 'staging_songs_keyed'],
+     'outputs': ['staging_songplays']},
+    {'name': 'songplays', 'query': SONGPLAYS_TABLE_INSERT,
+     'inputs': ['staging_songplays'], 'outputs': ['songplays']},
+    {'name': 'pending_retire', 'query': SONGPLAYS_PENDING_DELETE,
+     'inputs': ['songplays_pending', 'staging_songs_keyed'], 'outputs': ['songplays_pending']},
+    {'name': 'pending_add', 'query': SONGPLAYS_PENDING_INSERT,
+     'inputs': ['staging_events_keyed', 'staging_songs_keyed'],
+     'outputs': ['songplays_pending']},
+    {'name': 'volume_update', 'query': SONGPLAYS_BY_HOUR_UPDATE,
+     'inputs': ['staging_songplays', 'time', 'songplays_by_hour'],
+     'outputs': ['songplays_by_hour']},
+    {'name': 'volume_insert', 'query': SONGPLAYS_BY_HOUR_INSERT,
+     'inputs': ['staging_songplays', 'time', 'songplays_by_hour'],
+     'outputs': ['songplays_by_hour']},
+    {'name': 'user_changes', 'query': USER_CHANGES_INCREMENTAL_INSERT,
+     'inputs': ['staging_events', 'users', 'user_levels'],
+     'outputs': ['staging_user_changes']},
+    {'name': 'users_update', 'query': USERS_TABLE_UPDATE,
+     'inputs': ['staging_user_changes', 'users'], 'outputs': ['users']},
+    {'name': 'users_insert', 'query': USERS_TABLE_INSERT,
+     'inputs': ['staging_user_changes', 'users'], 'outputs': ['users']},
+    {'name': 'user_periods', 'query': STAGING_USER_LEVELS_INSERT,
+     'inputs': ['staging_events', 'user_levels'], 'outputs': ['staging_user_levels']},
+    {'name': 'user_levels_retire', 'query': USER_LEVELS_RETIRE,
+     'inputs': ['staging_user_levels', 'user_levels'], 'outputs': ['user_levels']},
+    {'name': 'user_levels_close', 'query': USER_LEVELS_CLOSE,
+     'inputs': ['staging_user_levels', 'user_levels'], 'outputs': ['user_levels']},
+    {'name': 'user_levels_add', 'query': USER_LEVELS_INSERT,
+     'inputs': ['staging_user_levels', 'user_levels'], 'outputs': ['user_levels']},
+    {'name': 'song_changes', 'query': SONG_CHANGES_INCREMENTAL_INSERT,
+     'inputs': ['staging_songs', 'songs'], 'outputs': ['staging_song_changes']},
+    {'name': 'songs_update', 'query': SONGS_TABLE_UPDATE,
+     'inputs': ['staging_song_changes', 'songs'], 'outputs': ['songs']},
+    {'name': 'songs_insert', 'query': SONGS_TABLE_INSERT,
+     'inputs': ['staging_song_changes', 'songs'], 'outputs': ['songs']},
+    {'name': 'artist_changes', 'query': ARTIST_CHANGES_INCREMENTAL_INSERT,
+     'inputs': ['staging_songs', 'artists'], 'outputs': ['staging_artist_changes']},
+    {'name': 'artists_update', 'query': ARTISTS_TABLE_UPDATE,
+     'inputs': ['staging_artist_changes', 'artists'], 'outputs': ['artists']},
+    {'name': 'artists_insert', 'query': ARTISTS_TABLE_INSERT,
+     'inputs': ['staging_artist_changes', 'artists'], 'outputs': ['artists']},
+    {'name': 'songs_loaded', 'query': STAGING_SONGS_DIMENSIONS_LOADED_UPDATE,
+     'inputs': ['staging_songs'], 'outputs': ['staging_songs']}]
+
+insert_table_queries = [step['query'] for step in insert_table_steps]
+
+incremental_insert_table_queries = [step['query'] for step in incremental_insert_table_steps]
+
+
+# Sample Queries
+SAMPLE_QUERY_USERS_WHO_USED_FREE_AND_PAID = """
+    SELECT user_id AS users_who_used_both_free_and_paid
+    FROM user_levels
+    GROUP BY user_id
+    HAVING MAX(CASE WHEN level = 'free' THEN 1 ELSE 0 END) = 1
+    AND MAX(CASE WHEN level = 'paid' THEN 1 ELSE 0 END) = 1;"""
+
+
+# one pass over user_levels, a row per user, then summed up
+SAMPLE_QUERY_TYPES_OF_USERS = """
+SELECT
+    SUM(periods) AS level_period_count,
+    SUM(levels) AS unique_users_levels_count,
+    COUNT(*) AS users_count,
+    SUM(used_free) AS free_users_count,
+    SUM(used_paid) AS paid_users_count,
+    SUM(used_free * used_paid) AS users_both_free_and_paid_count,
+    SUM(used_other) AS users_not_free_and_not_paid_count
+FROM (
+    SELECT
+        user_id,
+        COUNT(*) AS periods,
+        COUNT(DISTINCT level) AS levels,
+        MAX(CASE WHEN level = 'free' THEN 1 ELSE 0 END) AS used_free,
+        MAX(CASE WHEN level = 'paid' THEN 1 ELSE 0 END) AS used_paid,
+        MAX(CASE WHEN level <> 'free' and level <> 'paid' THEN 1 ELSE 0 END) AS used_other
+    FROM user_levels
+    GROUP BY user_id) user_summary;"""
 
 
 SAMPLE_QUERY_COUNT_SONGS = "SELECT COUNT(*) FROM songs;"
 SAMPLE_QUERY_COUNT_ARTISTS = "SELECT COUNT(*) FROM artists;"
 
 SAMPLE_QUERY_COUNT_SONGPLAYS_BY_USER = """
-    SELECT s.user_id, COUNT(*) 
-    FROM songplays s, users u 
+    SELECT s.user_id, COUNT(*) AS songplay_count
+    FROM songplays s, users_current u 
     WHERE s.user_id = u.user_id 
     GROUP BY s.user_id 
-    ORDER BY COUNT(*) DESC;"""
+    ORDER BY COUNT(*) DESC, s.user_id ASC;"""
 
 SAMPLE_QUERY_COUNT_SONGPLAYS_BY_YEAR = """
-    SELECT t.year, COUNT(*) 
-    FROM songplays s, time t 
-    WHERE s.start_time = t.start_time 
-    GROUP BY t.year 
-    ORDER BY t.year ASC;"""
+    SELECT year, SUM(songplay_count) AS songplay_count
+    FROM songplays_by_hour
+    GROUP BY year 
+    ORDER BY year ASC;"""
 
 SAMPLE_QUERY_COUNT_SONGPLAYS_BY_DAY = """
-    SELECT t.day, COUNT(*) 
-    FROM songplays s, time t 
-    WHERE s.start_time = t.start_time 
-    GROUP BY t.day 
-    ORDER BY t.day ASC;"""
+    SELECT day, SUM(songplay_count) AS songplay_count
+    FROM songplays_by_hour
+    GROUP BY day 
+    ORDER BY day ASC;"""
 
 SAMPLE_QUERY_COUNT_SONGPLAYS_BY_WEEK = """
-    SELECT t.week, COUNT(*) 
-    FROM songplays s, time t 
-    WHERE s.start_time = t.start_time 
-    GROUP BY t.week 
-    ORDER BY t.week ASC;"""
+    SELECT week, SUM(songplay_count) AS songplay_count
+    FROM songplays_by_hour
+    GROUP BY week 
+    ORDER BY week ASC;"""
 
 SAMPLE_QUERY_COUNT_SONGPLAYS_BY_MONTH = """
-    SELECT t.month, COUNT(*) 
-    FROM songplays s, time t 
-    WHERE s.start_time = t.start_time 
-    GROUP BY t.month 
-    ORDER BY t.month ASC;"""
+    SELECT month, SUM(songplay_count) AS songplay_count
+    FROM songplays_by_hour
+    GROUP BY month 
+    ORDER BY month ASC;"""
 
 SAMPLE_QUERY_COUNT_SONGPLAYS_BY_HOUR = """
-    SELECT t.hour, COUNT(*) 
-    FROM songplays s, time t 
-    WHERE s.start_time = t.start_time 
-    GROUP BY t.hour 
-    ORDER BY t.hour ASC;"""
+    SELECT hour, SUM(songplay_count) AS songplay_count
+    FROM songplays_by_hour
+    GROUP BY hour 
+    ORDER BY hour ASC;"""
 
 SAMPLE_QUERY_COUNT_SONGPLAYS_BY_WEEKDAY = """
-    SELECT t.weekday, COUNT(*) 
-    FROM songplays s, time t 
-    WHERE s.start_time = t.start_time 
-    GROUP BY t.weekday 
-    ORDER BY t.weekday ASC;"""
+    SELECT weekday, SUM(songplay_count) AS songplay_count
+    FROM songplays_by_hour
+    GROUP BY weekday 
+    ORDER BY weekday ASC;"""
 
 
 SAMPLE_QUERY_POPULAR_ARTISTS = """
-    SELECT count(*), a.artist_name  
+    SELECT count(*) AS songplay_count, a.artist_name  
     FROM songplays s, artists a 
     WHERE s.artist_id = a.artist_id 
     GROUP BY a.artist_name 
-    ORDER BY COUNT(*) DESC;"""
+    ORDER BY COUNT(*) DESC, a.artist_name ASC;"""
 
 SAMPLE_QUERY_POPULAR_SONGS = """
-    SELECT count(*), g.title
+    SELECT count(*) AS songplay_count, g.title
     FROM songplays s, songs g 
     WHERE s.song_id = g.song_id 
     GROUP BY g.title
-    ORDER BY COUNT(*) DESC;"""
-
-
-sample_queries = [SAMPLE_QUERY_USERS_WHO_USED_FREE_AND_PAID,
-                  SAMPLE_QUERY_TYPES_OF_USERS,
-                  SAMPLE_QUERY_COUNT_SONGS,
-                  SAMPLE_QUERY_COUNT_ARTISTS,
-                  SAMPLE_QUERY_COUNT_SONGPLAYS_BY_USER,
-                  SAMPLE_QUERY_COUNT_SONGPLAYS_BY_YEAR,
-                  SAMPLE_QUERY_COUNT_SONGPLAYS_BY_DAY,
-                  SAMPLE_QUERY_COUNT_SONGPLAYS_BY_WEEK,
-                  SAMPLE_QUERY_COUNT_SONGPLAYS_BY_MONTH,
-                  SAMPLE_QUERY_COUNT_SONGPLAYS_BY_HOUR,
-                  SAMPLE_QUERY_COUNT_SONGPLAYS_BY_WEEKDAY,
-                  SAMPLE_QUERY_POPULAR_ARTISTS,
-                  SAMPLE_QUERY_POPULAR_SONGS]
-
-sample_query_titles = ['Id of Users who played songs for free and as paid',
-                       'Number of Users, of different types',
-                       'Number of Songs',
-                       'Number of Artists',
-                       'Users who played the most songs',
-                       'Song play volume by year',
-                       'Song play volume by day of the month',
-                       'Song play volume by week of the year',
-                       'Song play volume by month',
-                       'Song play volume by hour',
-                       'Song play volume by weekday',
-                       'Most played Artists',
-                       'Most played Songs']
+    ORDER BY COUNT(*) DESC, g.title ASC;"""
+
+
+# QUERY REGISTRY
+# Each sample query with its title, the number of rows displayed (limit) and, for queries
+# returning many rows, the result columns (aliases) that order it, unique together.
+# Displayed pages are run as a top-K of the limit (see get_page_query), and the next
+# page starts after the last row of the previous one (keyset pagination)
+
+DISPLAY_LIMIT = 35
+
+sample_query_registry = [
+    {'title': 'Id of Users who played songs for free and as paid',
+     'query': SAMPLE_QUERY_USERS_WHO_USED_FREE_AND_PAID, 'limit': DISPLAY_LIMIT,
+     'order_by': [('users_who_used_both_free_and_paid', 'ASC')]},
+    {'title': 'Number of Users, of different types',
+     'query': SAMPLE_QUERY_TYPES_OF_USERS, 'limit': DISPLAY_LIMIT},
+    {'title': 'Number of Songs',
+     'query': SAMPLE_QUERY_COUNT_SONGS, 'limit': DISPLAY_LIMIT},
+    {'title': 'Number of Artists',
+     'query': SAMPLE_QUERY_COUNT_ARTISTS, 'limit': DISPLAY_LIMIT},
+    {'title': 'Users who played the most songs',
+     'query': SAMPLE_QUERY_COUNT_SONGPLAYS_BY_USER, 'limit': DISPLAY_LIMIT,
+     'order_by': [('songplay_count', 'DESC'), ('user_id', 'ASC')]},
+    {'title': 'Song play volume by year',
+     'query': SAMPLE_QUERY_COUNT_SONGPLAYS_BY_YEAR, 'limit': DISPLAY_LIMIT,
+     'order_by': [('year', 'ASC')]},
+    {'title': 'Song play volume by day of the month',
+     'query': SAMPLE_QUERY_COUNT_SONGPLAYS_BY_DAY, 'limit': DISPLAY_LIMIT,
+     'order_by': [('day', 'ASC')]},
+    {'title': 'Song play volume by week of the year',
+     'query': SAMPLE_QUERY_COUNT_SONGPLAYS_BY_WEEK, 'limit': DISPLAY_LIMIT,
+     'order_by': [('week', 'ASC')]},
+    {'title': 'Song play volume by month',
+     'query': SAMPLE_QUERY_COUNT_SONGPLAYS_BY_MONTH, 'limit': DISPLAY_LIMIT,
+     'order_by': [('month', 'ASC')]},
+    {'title': 'Song play volume by hour',
+     'query': SAMPLE_QUERY_COUNT_SONGPLAYS_BY_HOUR, 'limit': DISPLAY_LIMIT,
+     'order_by': [('hour', 'ASC')]},
+    {'title': 'Song play volume by weekday',
+     'query': SAMPLE_QUERY_COUNT_SONGPLAYS_BY_WEEKDAY, 'limit': DISPLAY_LIMIT,
+     'order_by': [('weekday', 'ASC')]},
+    {'title': 'Most played Artists',
+     'query': SAMPLE_QUERY_POPULAR_ARTISTS, 'limit': DISPLAY_LIMIT,
+     'order_by': [('songplay_count', 'DESC'), ('artist_name', 'ASC')]},
+    {'title': 'Most played Songs',
+     'query': SAMPLE_QUERY_POPULAR_SONGS, 'limit': DISPLAY_LIMIT,
+     'order_by': [('songplay_count', 'DESC'), ('title', 'ASC')]}]
+
+
+def get_page_query(entry: dict, after: dict = None) -> tuple:
+    """ (query, params) for one page of a registry entry: the entry's query without its
+    ORDER BY, ordered and limited outside, so the warehouse keeps a top-K of the limit
+    instead of sorting and sending the whole result.  after holds the order_by values of
+    the last row of the previous page.  NULLs sort last in either direction, so a page
+    after a NULL value goes on with the NULLs of the next column.  Entries without
+    order_by return one page """
+
+    if 'order_by' not in entry:
+        return entry['query'], None
+
+    query = re.sub(r'\s+ORDER BY[^;]*;\s*$', '', entry['query']).rstrip(';')
+
+    params = {}
+    where = ''
+    if after is not None:
+        # (a, b) after (x, y): a past x, or a = x and b past y.  With NULLs last a value
+        # is past x if it is further in the direction or NULL, nothing is past NULL
+        equal = []
+        conditions = []
+        for index, (column, direction) in enumerate(entry['order_by']):
+            if after[column] is None:
+                equal.append(f"page.{column} IS NULL")
+                continue
+            params[f"after_{index}"] = after[column]
+            operator = '<' if direction == 'DESC' else '>'
+            conditions.append('(' + ' AND '.join(
+                equal + [f"(page.{column} {operator} %(after_{index})s " +
+                         f"OR page.{column} IS NULL)"]) + ')')
+            equal.append(f"page.{column} = %(after_{index})s")
+        where = '\n    WHERE ' + (' OR '.join(conditions) or 'FALSE')
+
+    order_by = ', '.join(f"page.{column} {direction} NULLS LAST"
+                         for column, direction in entry['order_by'])
+    return (f"\n    SELECT * FROM ({query}) page{where}\n    ORDER BY {order_by}\n" +
+            f"    LIMIT {entry['limit']};", params or None)
+
+
+sample_queries = [entry['query'] for entry in sample_query_registry]
+
+sample_query_titles = [entry['title'] for entry in sample_query_registry]
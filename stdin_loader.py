@@ -0,0 +1,139 @@
+""" Client side streaming load of local song_data / log_data JSON files
+into the staging tables, with COPY ... FROM STDIN
+
+This is the local counterpart of the Redshift COPY from S3 (e.g. for a local PostgreSQL).
+The files are read with a pipeline of generators and the rows are sent in batches,
+so memory use depends on the batch size, not on the size of the dataset """
+
+import io
+import json
+import time
+import psycopg2
+import utilities
+from sql_queries import (STAGING_EVENTS_COPY_STDIN, STAGING_SONGS_COPY_STDIN,
+                         STAGING_EVENTS_JSON_FIELDS, STAGING_SONGS_JSON_FIELDS,
+                         STAGING_INTEGER_JSON_FIELDS, get_copy_max_errors)
+
+BATCH_ROWS = 50000
+
+INTEGER_FIELDS = set(STAGING_INTEGER_JSON_FIELDS)
+
+# table -> (COPY FROM STDIN query, JSON fields)
+STAGING_TABLES = {'staging_events': (STAGING_EVENTS_COPY_STDIN, STAGING_EVENTS_JSON_FIELDS),
+                  'staging_songs': (STAGING_SONGS_COPY_STDIN, STAGING_SONGS_JSON_FIELDS)}
+
+
+def read_records(paths, rejected: list = None, max_errors: int = 0):
+    """ Yield the JSON records of the files, one record per line
+    (log files hold one event per line, song files a single song).
+
+    Like Redshift's COPY MAXERROR, up to max_errors malformed lines are skipped and
+    added to rejected as (file, line number, reason, line), one more raises ValueError """
+
+    errors = 0
+    for path in paths:
+        with open(path, encoding='utf-8') as json_file:
+            for line_number, line in enumerate(json_file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    if not isinstance(record, dict):
+                        raise ValueError(f"Expected a JSON object, got {type(record).__name__}")
+                except ValueError as error:
+                    if rejected is None or errors >= max_errors:
+                        raise ValueError(f"{path} line {line_number}: {error} " +
+                                         f"(more than {max_errors} rejected records)") from error
+                    errors += 1
+                    rejected.append((path, line_number, str(error), line.rstrip('\n')))
+                    continue
+                yield record
+
+
+def flatten_records(records, fields: list):
+    """ Yield each record as a tuple of its fields, in column order """
+
+    for record in records:
+        row = []
+        for field in fields:
+            value = record.get(field)
+            if field in INTEGER_FIELDS:
+                if value == '':
+                    value = None
+                elif isinstance(value, float):
+                    value = int(value)
+            row.append(value)
+        yield tuple(row)
+
+
+def _escape(value) -> str:
+    """ One value in PostgreSQL COPY text format """
+
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def to_copy_lines(rows):
+    """ Yield each row as a line of PostgreSQL COPY text format """
+
+    for row in rows:
+        yield '\t'.join(_escape(value) for value in row) + '\n'
+
+
+def copy_lines(cur: psycopg2.extensions.cursor, copy_query: str, lines,
+               batch_rows: int = BATCH_ROWS) -> int:
+    """ Send the lines with COPY FROM STDIN, batch_rows lines per COPY.
+    Returns the number of rows sent """
+
+    row_count = 0
+    batch = io.StringIO()
+    batch_count = 0
+
+    for line in lines:
+        batch.write(line)
+        batch_count += 1
+
+        if batch_count == batch_rows:
+            batch.seek(0)
+            cur.copy_expert(copy_query, batch)
+            row_count += batch_count
+            batch = io.StringIO()
+            batch_count = 0
+
+    if batch_count:
+        batch.seek(0)
+        cur.copy_expert(copy_query, batch)
+        row_count += batch_count
+
+    return row_count
+
+
+def load_staging_files(cur: psycopg2.extensions.cursor, table: str, paths: list,
+                       batch_rows: int = BATCH_ROWS, rejected: list = None,
+                       max_errors: int = None) -> int:
+    """ Stream the local JSON files into a staging table, uncommitted (the run journal
+    commits them with the step's completion), returns the number of rows.
+    Up to max_errors (copy_max_errors of dwh.cfg by default) malformed records are skipped
+    and added to rejected (see read_records) """
+
+    copy_query, fields = STAGING_TABLES[table]
+    if rejected is None:
+        rejected = []
+    if max_errors is None:
+        max_errors = get_copy_max_errors()
+    rejected_before = len(rejected)
+
+    start_time = time.time()
+    records = read_records(paths, rejected, max_errors)
+    lines = to_copy_lines(flatten_records(records, fields))
+    row_count = copy_lines(cur, copy_query, lines, batch_rows)
+
+    duration = time.time() - start_time
+    rows_per_second = row_count / duration if duration else float(row_count)
+    print(f"{table}: loaded {row_count} rows from {len(paths)} files in " +
+          f"{utilities.format_duration(duration)} ({rows_per_second:,.0f} rows/s), " +
+          f"rejected {len(rejected) - rejected_before}")
+
+    return row_count
@@ -0,0 +1,231 @@
+""" Synthetic song_data and log_data files, laid out like the udacity-dend bucket
+
+Writes one JSON file per song (song-data/A/B/C/TRABC....json) and one file of events
+per day, one event per line (log-data/2018/11/2018-11-01-events.json), at any scale,
+for etl.py --local-data and benchmark.py.  The scale is set by the number of songs,
+users and events per day, the share of paid users and the match rate, the share of
+song plays whose title and artist are in the song catalog.  The same seed gives the
+same files """
+
+import argparse
+import datetime
+import json
+import os
+import random
+import string
+import time
+
+DEFAULT_START_DATE = '2018-11-01'
+
+# songs of each artist, on average
+SONGS_PER_ARTIST = 4
+
+# share of the events that are song plays (page NextSong), the rest are other pages
+NEXT_SONG_SHARE = 0.8
+OTHER_PAGES = ['Home', 'Settings', 'Help', 'Logout']
+
+# chance that a session ends after an event, the next event starts a new one
+SESSION_END_SHARE = 0.1
+
+# chance that a user changes level from one day to the next
+LEVEL_CHANGE_SHARE = 0.05
+
+# share of the artists with a location, the others have an empty one
+LOCATED_ARTIST_SHARE = 0.5
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def get_track_id(rng: random.Random, number: int) -> str:
+    """ Track ID like TRAAAAK128F9318786, the 3rd to 5th letters are its directories """
+
+    return ('TR' + ''.join(rng.choice(string.ascii_uppercase) for _ in range(3)) +
+            f"{number:013d}")
+
+
+def make_songs(rng: random.Random, songs: int) -> list:
+    """ The song records of the catalog """
+
+    artists = max(songs // SONGS_PER_ARTIST, 1)
+    records = []
+    for number in range(songs):
+        artist = rng.randrange(artists)
+        located = artist % 100 < LOCATED_ARTIST_SHARE * 100
+        records.append({
+            'num_songs': 1,
+            'artist_id': f"AR{artist:016d}",
+            'artist_latitude': float(artist * 37 % 130 - 60) if located else None,
+            'artist_longitude': float(artist * 53 % 360 - 180) if located else None,
+            'artist_location': f"City {artist % 500}" if located else '',
+            'artist_name': f"Artist {artist}",
+            'song_id': f"SO{number:016d}",
+            'title': f"Song {number}",
+            'duration': round(rng.uniform(90, 420), 5),
+            'year': rng.choice([0] + list(range(1960, 2019)))})
+
+    return records
+
+
+def write_songs(output_dir: str, rng: random.Random, songs: list):
+    """ One file per song, in song-data/<3rd>/<4th>/<5th letter of the track ID> """
+
+    for number, song in enumerate(songs):
+        track_id = get_track_id(rng, number)
+        directory = os.path.join(output_dir, 'song-data', *track_id[2:5])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, track_id + '.json'), 'w', encoding='utf-8') as file:
+            json.dump(song, file)
+
+
+def make_users(rng: random.Random, users: int, paid_share: float,
+               start_date: datetime.datetime) -> list:
+    """ The users, with their (first day's) level """
+
+    return [{'userId': str(number + 1),
+             'firstName': f"First{number + 1}",
+             'lastName': f"Last{number + 1}",
+             'gender': rng.choice('FM'),
+             'location': f"Town {number % 200}",
+             'userAgent': f"Agent {number % 20}",
+             'registration': float(int((start_date - EPOCH).total_seconds() * 1000) -
+                                   rng.randrange(1, 365) * 86400000),
+             'level': 'paid' if rng.random() < paid_share else 'free'}
+            for number in range(users)]
+
+
+def make_day_events(rng: random.Random, day: datetime.datetime, users: list, songs: list,
+                    events: int, match_rate: float, first_session: int) -> tuple:
+    """ The events of a day, in time order, in sessions of one user each.
+    Returns the events and the next free session id """
+
+    day_ms = int((day - EPOCH).total_seconds() * 1000)
+    times = sorted(rng.randrange(86400000) for _ in range(events))
+
+    records = []
+    session_id = first_session
+    item = 0
+    user = None
+    for index, time_ms in enumerate(times):
+        if user is None or rng.random() < SESSION_END_SHARE:
+            user = rng.choice(users)
+            session_id += 1
+            item = 0
+
+        record = {'artist': None, 'auth': 'Logged In', 'firstName': user['firstName'],
+                  'gender': user['gender'], 'itemInSession': item,
+                  'lastName': user['lastName'], 'length': None, 'level': user['level'],
+                  'location': user['location'], 'method': 'GET', 'page': None,
+                  'registration': user['registration'], 'sessionId': session_id,
+                  'song': None, 'status': 200, 'ts': day_ms + time_ms,
+                  'userAgent': user['userAgent'], 'userId': user['userId']}
+
+        if rng.random() < NEXT_SONG_SHARE:
+            record['method'] = 'PUT'
+            record['page'] = 'NextSong'
+            if rng.random() < match_rate:
+                song = rng.choice(songs)
+                record['song'] = song['title']
+                record['artist'] = song['artist_name']
+                record['length'] = song['duration']
+            else:
+                record['song'] = f"Unknown Song {day_ms + index}"
+                record['artist'] = f"Unknown Artist {rng.randrange(1000)}"
+                record['length'] = round(rng.uniform(90, 420), 5)
+        else:
+            record['page'] = rng.choice(OTHER_PAGES)
+
+        records.append(record)
+        item += 1
+
+    return records, session_id + 1
+
+
+def write_events(output_dir: str, rng: random.Random, users: list, songs: list,
+                 start_date: datetime.datetime, days: int, events_per_day: int,
+                 paid_share: float, match_rate: float) -> int:
+    """ One file of events per day, returns the number of events """
+
+    total = 0
+    session_id = 0
+    for day_number in range(days):
+        day = start_date + datetime.timedelta(days=day_number)
+
+        for user in users:
+            if rng.random() < LEVEL_CHANGE_SHARE:
+                user['level'] = 'paid' if rng.random() < paid_share else 'free'
+
+        records, session_id = make_day_events(rng, day, users, songs, events_per_day,
+                                              match_rate, session_id)
+
+        directory = os.path.join(output_dir, 'log-data', f"{day:%Y}", f"{day:%m}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{day:%Y-%m-%d}-events.json"), 'w',
+                  encoding='utf-8') as file:
+            for record in records:
+                file.write(json.dumps(record) + '\n')
+        total += len(records)
+
+    return total
+
+
+def generate_dataset(output_dir: str, songs: int = 1000, users: int = 100,
+                     events_per_day: int = 1000, days: int = 30, paid_share: float = 0.2,
+                     match_rate: float = 0.8, seed: int = 0,
+                     start_date: str = DEFAULT_START_DATE) -> dict:
+    """ Write the song and log files into output_dir (which should be empty),
+    returns the number of songs, users and events written """
+
+    rng = random.Random(seed)
+    start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d')
+
+    song_records = make_songs(rng, songs)
+    write_songs(output_dir, rng, song_records)
+
+    user_records = make_users(rng, users, paid_share, start_date)
+    events = write_events(output_dir, rng, user_records, song_records, start_date, days,
+                          events_per_day, paid_share, match_rate)
+
+    return {'songs': songs, 'users': users, 'events': events}
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """ Command line options """
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0].strip())
+    parser.add_argument('output_dir',
+                        help='directory the song-data and log-data directories are written to')
+    parser.add_argument('--songs', type=int, default=1000,
+                        help='songs in the catalog, one file each (default 1000)')
+    parser.add_argument('--users', type=int, default=100, help='users (default 100)')
+    parser.add_argument('--events-per-day', type=int, default=1000,
+                        help='events in each day\'s log file (default 1000)')
+    parser.add_argument('--days', type=int, default=30,
+                        help='days of log files (default 30)')
+    parser.add_argument('--start-date', default=DEFAULT_START_DATE,
+                        help=f"first day of the log files (default {DEFAULT_START_DATE})")
+    parser.add_argument('--paid-share', type=float, default=0.2,
+                        help='share of the users on the paid level (default 0.2)')
+    parser.add_argument('--match-rate', type=float, default=0.8,
+                        help='share of the song plays whose song is in the catalog '
+                             '(default 0.8)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed, the same seed writes the same files (default 0)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """ Generate a synthetic dataset """
+
+    args = parse_args(argv)
+
+    start_time = time.time()
+    counts = generate_dataset(args.output_dir, args.songs, args.users, args.events_per_day,
+                              args.days, args.paid_share, args.match_rate, args.seed,
+                              args.start_date)
+    print(f"Wrote {counts['songs']} songs and {counts['events']} events of " +
+          f"{counts['users']} users to {args.output_dir} in " +
+          f"{time.time() - start_time:.1f} seconds.")
+
+
+if __name__ == "__main__":
+    main()
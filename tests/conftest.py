@@ -0,0 +1,32 @@
+""" The tests import the project's modules from the repository root and run there,
+where the modules read dwh.cfg and dwh_iac.cfg """
+
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, REPO_DIR)
+os.chdir(REPO_DIR)
+
+
+@pytest.fixture
+def duckdb_conn(tmp_path, monkeypatch):
+    """ Connection to a new DuckDB database with all the tables, the modules
+    translate their SQL for DuckDB """
+
+    import dialects
+    import duckdb_engine
+    import utilities
+    from sql_queries import get_create_table_queries
+
+    monkeypatch.setattr(utilities, 'get_db_dialect', lambda: 'duckdb')
+    conn = duckdb_engine.connect(str(tmp_path / 'sparkify.duckdb'))
+    cur = conn.cursor()
+    for query in get_create_table_queries():
+        cur.execute(dialects.translate(query, 'duckdb'))
+    conn.commit()
+    yield conn
+    conn.close()
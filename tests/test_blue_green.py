@@ -0,0 +1,89 @@
+""" Blue / green generations on a DuckDB database: checks of the new generation,
+swaps and rollbacks """
+
+import pytest
+import blue_green
+from sql_queries import generation_tables, NEXT_SUFFIX, PREVIOUS_SUFFIX
+
+
+def fill(cur, table: str, rows: int):
+    """ Add rows of default values to the table """
+
+    for _ in range(rows):
+        cur.execute(f"INSERT INTO {table} DEFAULT VALUES;")
+
+
+def build_generations(conn, current_rows: dict, next_rows: dict):
+    """ Current and _next tables with the given rows per table, 10 where not given """
+
+    cur = conn.cursor()
+    blue_green.create_next_tables(cur, conn)
+    for table in generation_tables:
+        fill(cur, table, current_rows.get(table, 10))
+        fill(cur, table + NEXT_SUFFIX, next_rows.get(table, 10))
+    conn.commit()
+    return cur
+
+
+def test_pending_songplays_may_shrink(duckdb_conn):
+    cur = build_generations(duckdb_conn, {'songplays_pending': 10}, {'songplays_pending': 1})
+
+    blue_green.validate_next_tables(cur, duckdb_conn)
+
+
+def test_shrinking_table_is_not_swapped_in(duckdb_conn):
+    cur = build_generations(duckdb_conn, {'songs': 10}, {'songs': 5})
+
+    with pytest.raises(blue_green.ValidationError, match='songs below 90% of current'):
+        blue_green.validate_next_tables(cur, duckdb_conn)
+
+
+def test_empty_required_table_is_not_swapped_in(duckdb_conn):
+    cur = build_generations(duckdb_conn, {'users': 0}, {'users': 0})
+
+    with pytest.raises(blue_green.ValidationError, match='users empty'):
+        blue_green.validate_next_tables(cur, duckdb_conn)
+
+
+def get_loaded_files(cur) -> list:
+    """ The keys of the loaded files recorded in the control table """
+
+    cur.execute("SELECT s3_key FROM etl_loaded_files ORDER BY s3_key;")
+    return [row[0] for row in cur.fetchall()]
+
+
+def record_next_file(cur):
+    """ Control rows of the new generation """
+
+    cur.execute("DELETE FROM etl_loaded_files;")
+    cur.execute("INSERT INTO etl_loaded_files (source, s3_key) VALUES ('log_data', 'next.json');")
+
+
+def test_swap_and_roll_back(duckdb_conn):
+    cur = build_generations(duckdb_conn, {'songs': 10}, {'songs': 12})
+    cur.execute("INSERT INTO etl_loaded_files (source, s3_key) "
+                "VALUES ('log_data', 'current.json');")
+    duckdb_conn.commit()
+
+    blue_green.swap_in_next_tables(cur, duckdb_conn, record_next_file)
+    duckdb_conn.commit()
+    assert blue_green.get_row_counts(cur)['songs'] == 12
+    assert blue_green.get_row_counts(cur, PREVIOUS_SUFFIX)['songs'] == 10
+    assert get_loaded_files(cur) == ['next.json']
+
+    blue_green.roll_back(cur, duckdb_conn)
+    assert blue_green.get_row_counts(cur)['songs'] == 10
+    assert blue_green.get_row_counts(cur, NEXT_SUFFIX)['songs'] == 12
+    assert get_loaded_files(cur) == ['current.json']
+
+    with pytest.raises(blue_green.RollbackError, match='no previous generation'):
+        blue_green.roll_back(cur, duckdb_conn)
+    assert blue_green.get_row_counts(cur)['songs'] == 10
+
+
+def test_nothing_to_roll_back_to(duckdb_conn):
+    cur = duckdb_conn.cursor()
+
+    with pytest.raises(blue_green.RollbackError, match='missing songplays_previous'):
+        blue_green.roll_back(cur, duckdb_conn)
+    assert blue_green.get_missing_tables(cur, generation_tables) == []
@@ -0,0 +1,75 @@
+""" Translation of the Redshift SQL for PostgreSQL and DuckDB """
+
+import pytest
+import dialects
+from sql_queries import STAGING_EVENTS_JSON_FIELDS
+
+
+@pytest.mark.parametrize('query, dialect, expected', [
+    # physical design
+    ("CREATE TABLE t (a INT ENCODE az64, b VARCHAR ENCODE zstd)\n"
+     "    DISTSTYLE KEY\n    DISTKEY(a)\n    COMPOUND SORTKEY(a, b);",
+     'postgres', "CREATE TABLE t (a INT, b VARCHAR);"),
+    ("CREATE TABLE t (a INT)\n    DISTSTYLE ALL\n    SORTKEY AUTO;",
+     'duckdb', "CREATE TABLE t (a INT);"),
+    ("CREATE TABLE t (a INT)\n    INTERLEAVED SORTKEY(a);",
+     'duckdb', "CREATE TABLE t (a INT);"),
+    # primary keys
+    ("CREATE TABLE t (a INT PRIMARY KEY, b INT);",
+     'postgres', "CREATE TABLE t (a INT, b INT);"),
+    ("CREATE TABLE t (a INT PRIMARY KEY, b INT);",
+     'duckdb', "CREATE TABLE t (a INT, b INT);"),
+    # identity columns
+    ("CREATE TABLE t (id BIGINT IDENTITY(0, 1), a INT);", 'postgres',
+     "CREATE TABLE t (id BIGINT GENERATED BY DEFAULT AS IDENTITY "
+     "(START WITH 0 INCREMENT BY 1 MINVALUE 0), a INT);"),
+    ("CREATE TABLE t (id BIGINT IDENTITY(0, 1), a INT);", 'duckdb',
+     "CREATE OR REPLACE SEQUENCE t_id_seq START 0 INCREMENT BY 1 MINVALUE 0;"
+     "CREATE TABLE t (id BIGINT DEFAULT nextval('t_id_seq'), a INT);"),
+    # functions
+    ("SELECT GETDATE();", 'postgres', "SELECT CURRENT_TIMESTAMP;"),
+    ("SELECT GETDATE();", 'duckdb', "SELECT CURRENT_TIMESTAMP;"),
+    ("SELECT EXTRACT(WEEKDAY FROM start_time);",
+     'postgres', "SELECT EXTRACT(DOW FROM start_time);"),
+    ("SELECT EXTRACT(WEEKDAY FROM start_time);",
+     'duckdb', "SELECT EXTRACT(WEEKDAY FROM start_time);"),
+    ("SELECT REGEXP_REPLACE(title, '[[:space:]]+', ' ');",
+     'postgres', "SELECT REGEXP_REPLACE(title, '[[:space:]]+', ' ', 'g');"),
+    ("SELECT REGEXP_REPLACE(title, '[[:space:]]+', ' ');",
+     'duckdb', "SELECT REGEXP_REPLACE(title, '[[:space:]]+', ' ', 'g');"),
+    ("SELECT FNV_HASH(LOWER(TRIM(title)));",
+     'postgres', "SELECT hashtextextended(LOWER(TRIM(title)), 0);"),
+    ("SELECT FNV_HASH(LOWER(TRIM(title)));",
+     'duckdb', "SELECT CAST(hash(LOWER(TRIM(title))) >> 1 AS BIGINT);"),
+    # COPY is left alone outside DuckDB
+    ("COPY staging_events FROM 's3://bucket/log_data' IAM_ROLE 'arn' JSON 'auto';",
+     'postgres', "COPY staging_events FROM 's3://bucket/log_data' IAM_ROLE 'arn' JSON 'auto';"),
+    # Redshift is the source dialect
+    ("SELECT FNV_HASH(a), GETDATE() FROM t\n    DISTKEY(a);",
+     'redshift', "SELECT FNV_HASH(a), GETDATE() FROM t\n    DISTKEY(a);"),
+])
+def test_translate(query, dialect, expected):
+    assert dialects.translate(query, dialect) == expected
+
+
+@pytest.mark.parametrize('path, expected_path', [
+    ('/data/log_data/2018-11-01-events.json', '/data/log_data/2018-11-01-events.json'),
+    ('/data/log_data/', '/data/log_data/**/*.json'),
+    ('/data/log_data', '/data/log_data/**/*.json'),
+])
+def test_duckdb_copy_reads_json(path, expected_path):
+    query = dialects.translate(
+        f"COPY staging_events FROM '{path}'\n    IAM_ROLE 'arn'\n    JSON 'auto'\n    "
+        f"MAXERROR 10;", 'duckdb')
+
+    assert query.startswith(
+        f"INSERT INTO staging_events ({', '.join(STAGING_EVENTS_JSON_FIELDS)}) SELECT ")
+    assert f"FROM read_json('{expected_path}', format = 'newline_delimited', " in query
+    assert 'TRY_CAST(TRY_CAST("ts" AS DOUBLE) AS BIGINT)' in query
+    assert '"artist", ' in query
+    assert 'IAM_ROLE' not in query and 'MAXERROR' not in query
+
+
+def test_unknown_dialect():
+    with pytest.raises(ValueError, match='Unknown SQL dialect'):
+        dialects.translate("SELECT 1;", 'oracle')
@@ -0,0 +1,105 @@
+""" Incremental loads: which files are copied, which loads record a new data version,
+and a late file loaded after newer ones ends up like a full load of every file
+(etl.py on local synthetic data and DuckDB) """
+
+import os
+import shutil
+import subprocess
+import sys
+import duckdb
+import pytest
+import dialects
+import dimensions
+import etl
+import result_cache
+import synthetic_data
+from conftest import REPO_DIR
+from sql_queries import incremental_insert_table_steps
+
+CONFIG = """[CLUSTER]
+dialect = duckdb
+duckdb_path = {}
+
+[IAM_ROLE]
+arn = arn:aws:iam::0:role/none
+
+[S3]
+manifest_path =
+"""
+
+FIRST_DAY = os.path.join('log-data', '2018', '11', '2018-11-01-events.json')
+
+
+def test_level_only_change_records_a_data_version(duckdb_conn):
+    cur = duckdb_conn.cursor()
+    cur.execute("INSERT INTO users (user_id, first_name, level) VALUES (1, 'Ann', 'paid');")
+    cur.execute("INSERT INTO user_levels (user_id, first_name, level, valid_from) "
+                "VALUES (1, 'Ann', 'paid', 2000);")
+    # a late event: Ann was free before she paid, her users row stays as it is
+    cur.execute("INSERT INTO staging_events (userId, firstName, level, ts) "
+                "VALUES (1, 'Ann', 'free', 1000);")
+    for step in incremental_insert_table_steps:
+        cur.execute(dialects.translate(step['query'], 'duckdb'), {'time_grain_ms': 3600000})
+
+    etl.update_control_tables(cur, {'log_data': ['late.json']}, 2000)
+    duckdb_conn.commit()
+
+    user_changes = dimensions.get_dimension_changes(cur)['users']
+    assert user_changes['insert'] + user_changes['update'] == 0
+    assert result_cache.get_data_version(duckdb_conn) is not None
+
+
+def test_new_directories_are_copied_whole():
+    all_keys = ['log-data/2018/11/a.json', 'log-data/2018/11/b.json',
+                'log-data/2018/12/c.json', 'log-data/2018/12/d.json']
+
+    assert etl.get_copy_prefixes(all_keys[1:], all_keys, 'log-data') == [
+        'log-data/2018/11/b.json', 'log-data/2018/12']
+    assert etl.get_copy_prefixes(all_keys, all_keys, 'log-data') == ['log-data']
+    assert etl.get_copy_prefixes(all_keys, all_keys, 'log-data', split_root=True) == [
+        'log-data/2018']
+    assert etl.get_copy_prefixes([], all_keys, 'log-data') == []
+
+
+@pytest.fixture
+def warehouse(tmp_path):
+    """ Directory with a dwh.cfg for a DuckDB database and three days of synthetic data """
+
+    synthetic_data.generate_dataset(str(tmp_path / 'data'), songs=40, users=8,
+                                    events_per_day=60, days=3)
+    (tmp_path / 'dwh.cfg').write_text(CONFIG.format(tmp_path / 'sparkify.duckdb'))
+    return tmp_path
+
+
+def run(warehouse, program: str, *args):
+    """ Run one of the programs in the warehouse directory """
+
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, program)] + list(args),
+                   cwd=warehouse, env=env, check=True, capture_output=True)
+
+
+def get_rows(warehouse) -> dict:
+    """ The songplays (without their id), users and level periods of the database """
+
+    queries = {'songplays': "SELECT start_time, user_id, song_id, session_id FROM songplays",
+               'users': "SELECT * FROM users",
+               'user_levels': "SELECT * FROM user_levels"}
+    with duckdb.connect(str(warehouse / 'sparkify.duckdb'), read_only=True) as conn:
+        return {table: sorted(conn.execute(query).fetchall(), key=repr)
+                for table, query in queries.items()}
+
+
+def test_late_file_is_loaded(warehouse):
+    data = warehouse / 'data'
+    shutil.move(data / FIRST_DAY, warehouse / 'late.json')
+    run(warehouse, 'create_tables.py')
+    run(warehouse, 'etl.py', '--local-data', str(data), '--full-refresh')
+    shutil.move(warehouse / 'late.json', data / FIRST_DAY)
+
+    run(warehouse, 'etl.py', '--local-data', str(data))
+    incremental_rows = get_rows(warehouse)
+    run(warehouse, 'create_tables.py')
+    run(warehouse, 'etl.py', '--local-data', str(data), '--full-refresh')
+
+    assert incremental_rows == get_rows(warehouse)
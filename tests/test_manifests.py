@@ -0,0 +1,46 @@
+""" Splitting the listed song files into COPY manifest batches """
+
+import manifests
+
+
+def get_objects(count: int) -> list:
+    """ (key, size) objects with distinct sizes """
+
+    return [(f"song_data/{index:05d}.json", 1000 + index) for index in range(count)]
+
+
+def test_batches_are_capped_and_even():
+    objects = get_objects(1000)
+
+    batches = manifests.get_batches(objects, slices=4, files_per_slice=64)
+
+    assert len(batches) == 4
+    assert [len(batch) for batch in batches] == [250, 250, 250, 250]
+    assert sorted(key for batch in batches for key in batch) == [key for key, _ in objects]
+
+
+def test_batch_sizes_differ_by_at_most_one_file():
+    batches = manifests.get_batches(get_objects(1001), slices=4, files_per_slice=64)
+
+    assert len(batches) == 4
+    assert max(map(len, batches)) <= 4 * 64
+    assert max(map(len, batches)) - min(map(len, batches)) <= 1
+    assert sum(map(len, batches)) == 1001
+
+
+def test_largest_files_are_dealt_out_first():
+    objects = [('small', 1), ('large', 100), ('medium', 10), ('tiny', 0)]
+
+    assert manifests.get_batches(objects, slices=1, files_per_slice=2) == [
+        ['large', 'small'], ['medium', 'tiny']]
+
+
+def test_fewer_files_than_slices_is_one_batch():
+    batches = manifests.get_batches(get_objects(3), slices=16)
+
+    assert len(batches) == 1
+    assert sorted(batches[0]) == [key for key, _ in get_objects(3)]
+
+
+def test_no_files_is_no_batches():
+    assert manifests.get_batches([], slices=16) == []
@@ -0,0 +1,39 @@
+""" Keyset pagination of the sample queries over results with NULL sort keys """
+
+import pytest
+import analysis
+import dialects
+from sql_queries import get_page_query
+
+ROWS = [(3, 'a'), (3, 'b'), (3, None), (2, 'a'), (2, None),
+        (None, 'a'), (None, 'c'), (None, None), (1, 'b'), (1, 'c')]
+
+
+def read_pages(conn, entry: dict) -> list:
+    """ Every row of the entry, one page after the other """
+
+    cur = conn.cursor()
+    rows, after = [], None
+    while True:
+        query, params = get_page_query(entry, after)
+        cur.execute(dialects.translate(query, 'duckdb'), params)
+        page = cur.fetchall()
+        rows += page
+        after = analysis.get_next_page_key(entry, [desc[0] for desc in cur.description], page)
+        if after is None:
+            return rows
+
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 4, 10, 11])
+def test_pages_hold_every_row_once(duckdb_conn, limit):
+    cur = duckdb_conn.cursor()
+    cur.execute("CREATE TABLE plays (play_count INT, title VARCHAR);")
+    for row in ROWS:
+        cur.execute("INSERT INTO plays VALUES (%s, %s);", row)
+    entry = {'query': "SELECT play_count, title FROM plays ORDER BY play_count DESC, title;",
+             'limit': limit, 'order_by': [('play_count', 'DESC'), ('title', 'ASC')]}
+
+    rows = read_pages(duckdb_conn, entry)
+
+    assert rows == [(3, 'a'), (3, 'b'), (3, None), (2, 'a'), (2, None), (1, 'b'), (1, 'c'),
+                    (None, 'a'), (None, 'c'), (None, None)]
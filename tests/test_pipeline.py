@@ -0,0 +1,101 @@
+""" Dependencies between the SQL steps and the order the pipeline runs them in """
+
+import threading
+import time
+import pytest
+import pipeline
+
+
+def step(name: str, inputs: list, outputs: list, query: str = 'SELECT 1;') -> dict:
+    """ A step as listed in sql_queries.py """
+
+    return {'name': name, 'query': query, 'inputs': inputs, 'outputs': outputs}
+
+
+class RecordingRunner:
+    """ Stands in for parallel.StatementRunner: records when each step starts
+    and finishes, steps whose query is 'fail' raise """
+
+    events = []
+    cancelled = False
+
+    def __init__(self, pool, journal=None):
+        self.lock = threading.Lock()
+
+    def run(self, name: str, query: str, params=None) -> float:
+        with self.lock:
+            self.events.append(('start', name))
+        time.sleep(0.02)
+        if query == 'fail':
+            raise RuntimeError(f"{name} failed")
+        with self.lock:
+            self.events.append(('end', name))
+        return 0.02
+
+    def cancel_running(self):
+        RecordingRunner.cancelled = True
+
+
+@pytest.fixture
+def runner(monkeypatch):
+    RecordingRunner.events = []
+    RecordingRunner.cancelled = False
+    monkeypatch.setattr(pipeline, 'StatementRunner', RecordingRunner)
+    return RecordingRunner
+
+
+def test_read_after_write():
+    steps = [step('users', ['staging_events'], ['users']),
+             step('report', ['users'], ['report'])]
+
+    assert pipeline.get_dependencies(steps) == {'users': [], 'report': ['users']}
+
+
+def test_write_after_write():
+    steps = [step('songs', ['staging_songs'], ['songs']),
+             step('songs_fix', ['staging_events'], ['songs'])]
+
+    assert pipeline.get_dependencies(steps)['songs_fix'] == ['songs']
+
+
+def test_write_after_read():
+    steps = [step('songplays', ['songs', 'staging_events'], ['songplays']),
+             step('songs_cleanup', [], ['songs'])]
+
+    assert pipeline.get_dependencies(steps)['songs_cleanup'] == ['songplays']
+
+
+def test_independent_steps_do_not_wait():
+    steps = [step('users', ['staging_events'], ['users']),
+             step('songs', ['staging_songs'], ['songs']),
+             step('artists', ['staging_songs'], ['artists'])]
+
+    assert pipeline.get_dependencies(steps) == {'users': [], 'songs': [], 'artists': []}
+
+
+def test_steps_start_after_their_dependencies(runner):
+    steps = [step('songs', ['staging_songs'], ['songs']),
+             step('artists', ['staging_songs'], ['artists']),
+             step('songplays', ['songs', 'artists', 'staging_events'], ['songplays']),
+             step('users', ['staging_events'], ['users']),
+             step('time', ['songplays'], ['time'])]
+
+    pipeline.run_pipeline(None, steps, max_workers=4)
+
+    events = runner.events
+    for name, dependencies in pipeline.get_dependencies(steps).items():
+        for dependency in dependencies:
+            assert events.index(('end', dependency)) < events.index(('start', name))
+    assert events.index(('start', 'users')) < events.index(('end', 'songs'))
+
+
+def test_failing_step_is_raised_and_its_dependents_never_run(runner):
+    steps = [step('songs', ['staging_songs'], ['songs'], query='fail'),
+             step('users', ['staging_events'], ['users']),
+             step('songplays', ['songs', 'staging_events'], ['songplays'])]
+
+    with pytest.raises(RuntimeError, match='songs failed'):
+        pipeline.run_pipeline(None, steps, max_workers=2)
+
+    assert ('start', 'songplays') not in runner.events
+    assert runner.cancelled
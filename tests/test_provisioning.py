@@ -0,0 +1,107 @@
+""" Provisioning with fake boto3 clients: the ingress rule waits for the security group """
+
+import pytest
+import iac_create
+import ingress_rule
+
+WORKGROUP = ingress_rule.get_workgroup_name()
+
+
+class FakeIam:
+    """ IAM client that creates the role """
+
+    def create_role(self, **kwargs):
+        return {}
+
+    def attach_role_policy(self, **kwargs):
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    def get_role(self, RoleName):
+        return {'Role': {'Arn': f"arn:aws:iam::123456789012:role/{RoleName}"}}
+
+
+class FakeRedshiftServerless:
+    """ Redshift Serverless client whose new workgroup is listed without a security group
+    for the first listings_without_group listings """
+
+    def __init__(self, listings_without_group: int = 2):
+        self.listings_without_group = listings_without_group
+        self.workgroup_created = False
+
+    def list_namespaces(self):
+        return {'namespaces': []}
+
+    def create_namespace(self, **kwargs):
+        return {}
+
+    def get_namespace(self, namespaceName):
+        return {'namespace': {'status': 'AVAILABLE'}}
+
+    def create_workgroup(self, **kwargs):
+        self.workgroup_created = True
+        return {}
+
+    def list_workgroups(self):
+        if not self.workgroup_created:
+            return {'workgroups': []}
+        if self.listings_without_group > 0:
+            self.listings_without_group -= 1
+            return {'workgroups': [{'workgroupName': WORKGROUP, 'securityGroupIds': []}]}
+        return {'workgroups': [{'workgroupName': WORKGROUP, 'securityGroupIds': ['sg-1']}]}
+
+    def get_workgroup(self, workgroupName):
+        return {'workgroup': {'status': 'AVAILABLE',
+                              'endpoint': {'address': 'sparkify.example.com'}}}
+
+
+class FakeEc2:
+    """ EC2 client that records the ingress rules added """
+
+    def __init__(self):
+        self.rules = []
+
+    def describe_security_groups(self, GroupIds):
+        return {'SecurityGroups': []}
+
+    def authorize_security_group_ingress(self, **kwargs):
+        self.rules.append(kwargs)
+        return {}
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(iac_create, 'INITIAL_POLL_DELAY', 0.01)
+    monkeypatch.setattr(iac_create, 'MAX_POLL_DELAY', 0.01)
+
+
+def test_security_group_of_unlisted_workgroup():
+    with pytest.raises(ingress_rule.SecurityGroupError):
+        ingress_rule.get_security_group_id(FakeRedshiftServerless())
+
+
+def test_security_group_of_workgroup_without_one():
+    client = FakeRedshiftServerless()
+    client.workgroup_created = True
+    with pytest.raises(ingress_rule.SecurityGroupError):
+        ingress_rule.get_security_group_id(client)
+
+
+def test_ingress_rule_waits_for_security_group():
+    ec2_client = FakeEc2()
+    role_arn, host = iac_create.provision(FakeIam(), FakeRedshiftServerless(), ec2_client,
+                                          deadline_seconds=10,
+                                          get_cidr_ip=lambda: '203.0.113.7/32')
+
+    assert role_arn.endswith(iac_create.get_iac_setting("DWH_IAM_ROLE_NAME"))
+    assert host == 'sparkify.example.com'
+    assert [rule['GroupId'] for rule in ec2_client.rules] == ['sg-1']
+    assert ec2_client.rules[0]['IpPermissions'][0]['IpRanges'] == [{'CidrIp': '203.0.113.7/32'}]
+
+
+def test_missing_security_group_fails_at_deadline():
+    ec2_client = FakeEc2()
+    with pytest.raises(iac_create.ProvisioningError):
+        iac_create.provision(FakeIam(), FakeRedshiftServerless(listings_without_group=10 ** 6),
+                             ec2_client, deadline_seconds=0.2,
+                             get_cidr_ip=lambda: '203.0.113.7/32')
+    assert not ec2_client.rules
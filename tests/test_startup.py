@@ -0,0 +1,42 @@
+""" The single entry point answers --help without the heavy imports or a config file,
+and the programs read their config when they run, not when they are imported """
+
+import os
+import subprocess
+import sys
+import sparkify
+from conftest import REPO_DIR
+
+PROGRAMS = {module for module, _, _ in
+            list(sparkify.COMMANDS.values()) + list(sparkify.IAC_COMMANDS.values())}
+
+
+def get_imported_modules(code: str, directory: str) -> set:
+    """ Run the code in a fresh interpreter in the directory,
+    returns the names of the modules it imported """
+
+    result = subprocess.run(
+        [sys.executable, '-c', f"import sys\n{code}\nprint(' '.join(sys.modules))"],
+        cwd=directory, env=dict(os.environ, PYTHONPATH=REPO_DIR), capture_output=True,
+        text=True, check=True)
+    return set(result.stdout.splitlines()[-1].split())
+
+
+def test_help_defers_the_heavy_imports(tmp_path):
+    modules = get_imported_modules(
+        "import sparkify\n"
+        "try:\n"
+        "    sparkify.main(['--help'])\n"
+        "except SystemExit:\n"
+        "    pass", str(tmp_path))
+
+    assert 'sparkify' in modules
+    assert not set(sparkify.DEFERRED_MODULES) & modules
+    assert not PROGRAMS & modules
+
+
+def test_programs_import_without_config(tmp_path):
+    modules = get_imported_modules(
+        f"import {', '.join(sorted(PROGRAMS))}", str(tmp_path))
+
+    assert PROGRAMS <= modules
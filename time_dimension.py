@@ -0,0 +1,55 @@
+""" Calendar time dimension
+
+Instead of extracting the calendar units from every event with SELECT DISTINCT, the
+time table holds one row per period (TIME_GRAIN in the ETL section of dwh.cfg, an
+hour by default) for the range of staging_events.ts.  The rows are generated in the
+warehouse by one INSERT ... SELECT over the numbers of the periods in the range.
+songplays refers to them by time_key, the number of the period since the epoch """
+
+import time
+import psycopg2
+import utilities
+import dialects
+from sql_queries import (get_time_grain, TIME_GRAINS, STAGING_EVENTS_TS_RANGE,
+                         get_time_table_fill_insert, rename_generation_tables)
+
+
+def get_time_key(ts: int, grain_ms: int) -> int:
+    """ Period of an events.ts (milliseconds since the epoch) for periods of grain_ms,
+    the same as songplays.time_key """
+
+    return ts // grain_ms
+
+
+def load_time_dimension(cur: psycopg2.extensions.cursor, conn: psycopg2.extensions.connection,
+                        suffix: str = '') -> int:
+    """ Add the periods covered by staging_events that the time table does not
+    have yet, returns the number of rows added.  With a suffix (e.g. _next)
+    the rows go to that generation of the time table, see blue_green.py """
+
+    dialect = utilities.get_db_dialect()
+    time_grain = get_time_grain()
+    grain_seconds = TIME_GRAINS[time_grain]
+    start_time = time.time()
+
+    cur.execute(dialects.translate(STAGING_EVENTS_TS_RANGE, dialect))
+    min_ts, max_ts = cur.fetchone()
+    if min_ts is None:
+        print("time: no events in staging, nothing to add")
+        return 0
+
+    first_key = get_time_key(min_ts, grain_seconds * 1000)
+    last_key = get_time_key(max_ts, grain_seconds * 1000)
+    period_count = last_key - first_key + 1
+
+    query = get_time_table_fill_insert(len(str(period_count - 1)))
+    cur.execute(dialects.translate(rename_generation_tables(query, suffix), dialect),
+                {'first_key': first_key, 'last_key': last_key,
+                 'grain_seconds': grain_seconds})
+    added = cur.rowcount
+    conn.commit()
+
+    print(f"time: added {added} {time_grain} rows ({period_count - added} already there) " +
+          f"in {utilities.get_duration_string(start_time)}")
+
+    return added
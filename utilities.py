@@ -1,14 +1,21 @@
 """ Utility Functions """
 
 import configparser
+import functools
 import time
 import psycopg2
+from psycopg2.extras import execute_values
+import connections
 
 
 def get_duration_string(start_time):
     """ Create printable string of how long a process has taken so far"""
 
-    duration = time.time() - start_time
+    return format_duration(time.time() - start_time)
+
+
+def format_duration(duration):
+    """ Create printable string of a duration in seconds """
 
     duration_minutes = int(duration // 60)
     duration_seconds = int(duration % 60)
@@ -23,20 +30,89 @@ def get_duration_string(start_time):
     return duration_string
 
 
-def get_db_connection():
-    """ Replace any existing tables with all new empty tables, 
-    staging and fact-dimension tables """
+@functools.lru_cache(maxsize=None)
+def get_config() -> configparser.ConfigParser:
+    """ dwh.cfg, read once """
 
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
+    return config
+
+
+def get_config_value(section: str, option: str, default):
+    """ A setting of dwh.cfg converted to the type of its default, the default if unset """
+
+    value = get_config().get(section, option, fallback=None)
+    return default if value is None else type(default)(value)
+
+
+def get_db_dsn():
+    """ Build the psycopg2 connection string from the CLUSTER section of dwh.cfg """
+
+    config = get_config()
     HOST = config.get("CLUSTER", "HOST")
     DB_NAME = config.get("CLUSTER", "DB_NAME")
     DB_USER = config.get("CLUSTER", "DB_USER")
     DB_PASSWORD = config.get("CLUSTER", "DB_PASSWORD")
     DB_PORT = config.get("CLUSTER", "DB_PORT")
 
-    conn = psycopg2.connect(
-        f"host={HOST} dbname={DB_NAME} user={DB_USER} " +
-        f"password={DB_PASSWORD} port={DB_PORT}")
+    return (f"host={HOST} dbname={DB_NAME} user={DB_USER} " +
+            f"password={DB_PASSWORD} port={DB_PORT}")
+
+
+def get_db_dialect():
+    """ SQL dialect of the database in dwh.cfg ('redshift' unless the
+    CLUSTER section says otherwise, e.g. dialect = postgres for a local database) """
+
+    return get_config().get("CLUSTER", "DIALECT", fallback='redshift')
+
+
+def get_duckdb_path():
+    """ DuckDB database file, for dialect = duckdb (CLUSTER duckdb_path in dwh.cfg) """
+
+    return get_config().get("CLUSTER", "DUCKDB_PATH", fallback='sparkify.duckdb')
+
+
+def get_db_connection():
+    """ Open a connection to the database, with TCP keepalives,
+    retrying while it cannot be opened (see connections.py) """
+
+    if get_db_dialect() == 'duckdb':
+        # optional dependency, only needed to run in-process on DuckDB
+        import duckdb_engine
+        return duckdb_engine.connect(get_duckdb_path())
+
+    conn = connections.connect(get_db_dsn())
 
     return conn
+
+
+def get_db_connection_pool(max_connections):
+    """ Thread safe pool of up to max_connections connections to the database,
+    for running independent statements at the same time (see connections.py) """
+
+    if get_db_dialect() == 'duckdb':
+        import duckdb_engine
+        return duckdb_engine.DuckDBPool(get_duckdb_path())
+
+    return connections.ConnectionPool(get_db_dsn(), max_connections)
+
+
+def is_transient_error(error: Exception) -> bool:
+    """ True for errors of a lost or refused connection, that a retry on a new
+    connection may not get (not for SQL errors or cancelled statements) """
+
+    if isinstance(error, psycopg2.extensions.QueryCanceledError):
+        return False
+    return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+
+def insert_rows(cur, values_query, row_query, rows):
+    """ Insert many rows at once, values_query has a single VALUES %s
+    (psycopg2's execute_values), row_query one %s per column for databases
+    without it (DuckDB, which takes executemany) """
+
+    if get_db_dialect() == 'duckdb':
+        cur.executemany(row_query, rows)
+    else:
+        execute_values(cur, values_query, rows)